@@ -0,0 +1,311 @@
+"""Benchmark the dataset engine on synthetic local Delta tables.
+
+Builds a Delta table per size in a temporary directory, then measures
+`add_to_dataset` plus writing the result for each scenario:
+
+- `append`: No merge columns; the batch is appended.
+- `merge-single`: Merge on a single unique key column.
+- `merge-multi`: Merge on two key columns, the first with low cardinality.
+
+Like the tests, S3 is replaced by local directories. Each run happens in a
+fresh process, so that peak RSS is measured per run.
+
+Results are compared with `benchmarks/baselines/dataset.json`, and the
+script exits with a non-zero status if a run is slower, uses more memory or
+writes more data than its baseline allows. Baselines are machine specific;
+regenerate them with `--update-baselines` on the machine used for
+comparisons.
+
+    python -m benchmarks.dataset --rows 10000 100000 1000000
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), "baselines", "dataset.json")
+
+BASELINE_METRICS = ["wall_s", "peak_rss_mb", "bytes_written"]
+WALL_SLACK_S = 0.05
+
+SCENARIOS = {
+    "append": [],
+    "merge-single": ["id"],
+    "merge-multi": ["key_a", "key_b"],
+}
+
+DISTRICTS = ["Gamle Oslo", "Grünerløkka", "Sagene", "St. Hanshaugen", "Frogner"]
+STATUSES = ["OK", "PENDING", "FAILED"]
+
+
+def _batch(rows, width, key_cardinality, datetime_columns, start, update_fraction):
+    """Return `rows` events as a list of dicts, like the events API gets them.
+
+    A fraction `update_fraction` of the events have keys already present in a
+    table of `start` rows (i.e. they update existing rows on merge); the rest
+    are new.
+    """
+    updates = min(int(rows * update_fraction), start)
+    step = start // updates if updates else 1
+    ids = [k * step for k in range(updates)]
+    ids += range(start, start + rows - updates)
+
+    events = []
+    for i in ids:
+        event = {
+            "id": i,
+            "key_a": i % key_cardinality,
+            "key_b": i // key_cardinality,
+        }
+        for c in range(width):
+            if c < datetime_columns:
+                event[f"col_{c}"] = (
+                    f"2024-{1 + i % 12:02}-{1 + i % 28:02}T{i % 24:02}:"
+                    f"{i % 60:02}:{(i + c) % 60:02}.{i % 1000000:06}"
+                )
+            elif c % 3 == 0:
+                event[f"col_{c}"] = i * (c + 1)
+            elif c % 3 == 1:
+                event[f"col_{c}"] = i / (c + 1) + 0.5
+            else:
+                event[f"col_{c}"] = (DISTRICTS + STATUSES)[(i + c) % 8]
+        events.append(event)
+    return events
+
+
+def _existing_table(rows, width, key_cardinality, datetime_columns, schema):
+    """Return a pyarrow table of `rows` rows with the given `schema`.
+
+    Built column-wise with numpy, since building tens of millions of rows
+    through `dataframe_from_dict` would take far longer than the benchmark.
+    """
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+
+    i = np.arange(rows, dtype=np.int64)
+    columns = {"id": i, "key_a": i % key_cardinality, "key_b": i // key_cardinality}
+    for c in range(width):
+        name = f"col_{c}"
+        if c < datetime_columns:
+            columns[name] = pd.Timestamp("2024-01-01", tz="UTC") + pd.to_timedelta(
+                i, unit="s"
+            )
+        elif c % 3 == 0:
+            columns[name] = i * (c + 1)
+        elif c % 3 == 1:
+            columns[name] = i / (c + 1) + 0.5
+        else:
+            labels = np.array(DISTRICTS + STATUSES, dtype=object)
+            columns[name] = labels[(i + c) % 8]
+
+    return pa.table(
+        {field.name: pa.array(columns[field.name], type=field.type) for field in schema}
+    )
+
+
+def _write_local(path, df, mode="overwrite", merge_on=[]):
+    """Write `df` to `path` the way the engine writes merged data."""
+    import deltalake as dl
+    import pyarrow as pa
+
+    from uploader.encoding import writer_properties
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    dl.write_deltalake(
+        path,
+        table,
+        mode=mode,
+        schema_mode="merge",
+        writer_properties=writer_properties(table.schema, merge_on),
+    )
+
+
+def _read_local(path, **kwargs):
+    """Stand-in for `wr.s3.read_deltalake` with the pyarrow dtype backend."""
+    import deltalake as dl
+    import pandas as pd
+
+    return dl.DeltaTable(path).to_pyarrow_table().to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _dirs, files in os.walk(path)
+        for f in files
+    )
+
+
+def _events(params):
+    return _batch(
+        params["batch_rows"],
+        params["width"],
+        params["key_cardinality"],
+        params["datetime_columns"],
+        params["rows"],
+        params["update_fraction"],
+    )
+
+
+def _build(path, params):
+    """Write the existing table for `params` to `path`."""
+    import deltalake as dl
+    import pyarrow as pa
+
+    from uploader.inference import dataframe_from_dict
+
+    # Match the schema the engine infers for incoming events.
+    schema = pa.Table.from_pandas(
+        dataframe_from_dict(_events(params)), preserve_index=False
+    ).schema
+    dl.write_deltalake(
+        path,
+        _existing_table(
+            params["rows"],
+            params["width"],
+            params["key_cardinality"],
+            params["datetime_columns"],
+            schema,
+        ),
+    )
+
+
+def _run(source, target, params):
+    """Run a single benchmark; meant to be run in a fresh process."""
+    import awswrangler as wr
+
+    from uploader.dataset import add_to_dataset
+
+    events = _events(params)
+
+    with patch.object(wr.s3, "read_deltalake", side_effect=_read_local):
+        start = time.perf_counter()
+        merged, _new_columns = add_to_dataset(
+            source, events, SCENARIOS[params["scenario"]]
+        )
+        merged_at = time.perf_counter()
+        _write_local(target, merged, merge_on=SCENARIOS[params["scenario"]])
+        written_at = time.perf_counter()
+
+    # ru_maxrss is in KiB on Linux.
+    return {
+        "merge_s": round(merged_at - start, 3),
+        "write_s": round(written_at - merged_at, 3),
+        "wall_s": round(written_at - start, 3),
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "bytes_written": _dir_size(target),
+        "result_rows": len(merged),
+    }
+
+
+def _key(params):
+    return (
+        f"{params['scenario']}/rows={params['rows']}/width={params['width']}"
+        f"/keys={params['key_cardinality']}/datetimes={params['datetime_columns']}"
+        f"/batch={params['batch_rows']}/updates={params['update_fraction']}"
+    )
+
+
+def _regressions(result, baseline, tolerance):
+    # Short runs are noisy; allow some absolute slack on top of the tolerance.
+    slack = {"wall_s": WALL_SLACK_S}
+    return [
+        f"{metric} {result[metric]} > {baseline[metric]} (+{tolerance:.0%})"
+        for metric in BASELINE_METRICS
+        if metric in baseline
+        and result[metric] > baseline[metric] * (1 + tolerance) + slack.get(metric, 0)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--width", type=int, default=10)
+    parser.add_argument("--key-cardinality", type=int, default=100)
+    parser.add_argument("--datetime-columns", type=int, default=2)
+    parser.add_argument("--batch-rows", type=int, default=1000)
+    parser.add_argument("--update-fraction", type=float, default=0.5)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--update-baselines", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        with open(BASELINES_FILE) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    # Use fresh processes, both for per-run peak RSS and to avoid fork issues
+    # with the threads started by pyarrow.
+    ctx = multiprocessing.get_context("spawn")
+    failures = []
+
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "latest")
+            params = {
+                "rows": rows,
+                "width": args.width,
+                "key_cardinality": args.key_cardinality,
+                "datetime_columns": min(args.datetime_columns, args.width),
+                "batch_rows": args.batch_rows,
+                "update_fraction": args.update_fraction,
+            }
+            with ctx.Pool(1, maxtasksperchild=1) as pool:
+                pool.apply(_build, (source, params))
+
+            for scenario in args.scenarios:
+                params["scenario"] = scenario
+                target = os.path.join(tmp, scenario)
+                with ctx.Pool(1, maxtasksperchild=1) as pool:
+                    result = pool.apply(_run, (source, target, params))
+
+                    key = _key(params)
+                    regressions = _regressions(
+                        result, baselines.get(key, {}), args.tolerance
+                    )
+                    print(
+                        f"{key}: {result['wall_s']:.3f} s "
+                        f"(merge {result['merge_s']:.3f} s, write {result['write_s']:.3f} s), "
+                        f"peak RSS {result['peak_rss_mb']:.0f} MB, "
+                        f"{result['bytes_written']} bytes written"
+                        + (
+                            f"  REGRESSED: {'; '.join(regressions)}"
+                            if regressions
+                            else ""
+                        )
+                    )
+
+                    if args.update_baselines:
+                        baselines[key] = {
+                            m: result[m]
+                            for m in ["wall_s", "peak_rss_mb", "bytes_written"]
+                        }
+                    elif regressions:
+                        failures.append(key)
+
+    if args.update_baselines:
+        os.makedirs(os.path.dirname(BASELINES_FILE), exist_ok=True)
+        with open(BASELINES_FILE, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    if failures:
+        print(f"{len(failures)} benchmark(s) regressed", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
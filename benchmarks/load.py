@@ -0,0 +1,434 @@
+"""Load test the handlers end to end, without touching any real environment.
+
+Runs the handlers as deployed (including their logging and status wrappers)
+in worker processes, one per concurrent Lambda container, against:
+
+- A local moto server standing in for S3, SQS, DynamoDB and SSM.
+- A local stub of the metadata API, the status API, Keycloak and the email
+  API.
+
+Scenarios:
+
+- `signed-post`: `generate_signed_post.handler`.
+- `events-v1`: `push_dataset_events.handler`, writing synchronously, with
+  conflicting writes to a dataset retried.
+- `events-v2`: `push_dataset_events.handler`, queueing the events.
+- `event-queue`: `handle_queue.event_queue_handler`. Like the FIFO queue
+  does, records for one dataset are handled one at a time, so concurrency is
+  bounded by `--datasets` as well.
+
+Reports throughput, p50/p95/p99 latency and status codes per scenario, plus
+write conflicts for `events-v1`. Workers are warmed up (i.e. have
+imported the handlers) before measuring, so cold starts aren't included.
+Requires `moto[server]`.
+
+    python -m benchmarks.load --concurrency 8 --requests 200 --datasets 2
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCENARIOS = ["signed-post", "events-v1", "events-v2", "event-queue"]
+
+FILE_DATASET = "load-file"
+EVENT_DATASET = "load-events"
+EDITION = "20240101T000000"
+TOKEN = "load-test"
+
+# Keep clear of any real credentials.
+AWS_CONFIG = """[profile load-test]
+aws_access_key_id = mock
+aws_secret_access_key = mock
+region = eu-west-1
+"""
+
+
+class _StubAPI(BaseHTTPRequestHandler):
+    """Stub of the metadata API, status API, Keycloak and email API."""
+
+    editions = itertools.count(1)
+    distributions = itertools.count(1)
+
+    def _respond(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if m := re.fullmatch(r"/metadata/datasets/([^/]+)", self.path):
+            dataset_id = m[1]
+            source_type = "file" if dataset_id == FILE_DATASET else "event"
+            return self._respond(
+                {
+                    "Id": dataset_id,
+                    "accessRights": "public",
+                    "source": {"type": source_type},
+                }
+            )
+        if m := re.fullmatch(r"/metadata/datasets/(.+)", self.path):
+            # Versions and editions; the ID is what's being validated.
+            return self._respond({"Id": "/".join(m[1].split("/")[0::2])})
+        self._respond({"message": "Not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+
+        if self.path.endswith("/protocol/openid-connect/token"):
+            # Serves both the resource authorizer and the SDK.
+            return self._respond(
+                {"result": True, "access_token": TOKEN, "expires_in": 3600}
+            )
+        if m := re.fullmatch(
+            r"/metadata/datasets/([^/]+)/versions/([^/]+)/editions", self.path
+        ):
+            return self._respond(
+                {"Id": f"{m[1]}/{m[2]}/{EDITION}-{next(self.editions)}"}, 201
+            )
+        if m := re.fullmatch(r"/metadata/datasets/(.+)/distributions", self.path):
+            parts = m[1].split("/")[0::2]
+            return self._respond(
+                {"Id": "/".join([*parts, str(next(self.distributions))])}, 201
+            )
+        if self.path.startswith(("/status-api/", "/email")):
+            return self._respond({})
+        self._respond({"message": "Not found"}, 404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def _start_moto():
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f"http://{host}:{port}"
+
+
+def _configure_environment(tmp, moto_url, stub_url):
+    """Point everything the handlers talk to at the local stand-ins."""
+    config_file = os.path.join(tmp, "aws-config")
+    with open(config_file, "w") as f:
+        f.write(AWS_CONFIG)
+
+    for name in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"]:
+        os.environ.pop(name, None)
+
+    # A named profile is used rather than plain credentials, since
+    # awswrangler passes the profile name on to deltalake.
+    os.environ.update(
+        {
+            "AWS_CONFIG_FILE": config_file,
+            "AWS_SHARED_CREDENTIALS_FILE": os.devnull,
+            "AWS_PROFILE": "load-test",
+            "AWS_REGION": "eu-west-1",
+            "AWS_ENDPOINT_URL": moto_url,
+            "AWS_ALLOW_HTTP": "true",
+            "AWS_XRAY_SDK_ENABLED": "false",
+            "METADATA_API_URL": f"{stub_url}/metadata",
+            "KEYCLOAK_SERVER": stub_url,
+            "EMAIL_API_URL": f"{stub_url}/email",
+            "OKDATA_ENVIRONMENT": "dev",
+        }
+    )
+    for name, value in {
+        "BUCKET": "testbucket",
+        "ENABLE_AUTH": "true",
+        "KEYCLOAK_REALM": "mock",
+        "RESOURCE_SERVER_CLIENT_ID": "resource-server",
+        "OKDATA_CLIENT_ID": "mock",
+        "SERVICE_NAME": "data-uploader",
+        "EVENT_QUEUE_NAME": "DatasetEvents.fifo",
+        "STATUS_QUEUE_NAME": "DatasetStatusTraces",
+        "ALERT_QUEUE_NAME": "DatasetColumnAlerts",
+    }.items():
+        os.environ.setdefault(name, value)
+
+
+def _create_resources():
+    import boto3
+
+    region = os.environ["AWS_REGION"]
+
+    boto3.client("s3", region_name=region).create_bucket(
+        Bucket=os.environ["BUCKET"],
+        CreateBucketConfiguration={"LocationConstraint": region},
+    )
+
+    sqs = boto3.client("sqs", region_name=region)
+    sqs.create_queue(QueueName=os.environ["STATUS_QUEUE_NAME"])
+    sqs.create_queue(QueueName=os.environ["ALERT_QUEUE_NAME"])
+    sqs.create_queue(
+        QueueName=os.environ["EVENT_QUEUE_NAME"],
+        Attributes={"FifoQueue": "true", "ContentBasedDeduplication": "true"},
+    )
+
+    dynamodb = boto3.client("dynamodb", region_name=region)
+    dynamodb.create_table(
+        TableName="dataset-subscriptions",
+        KeySchema=[{"AttributeName": "DatasetId", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "DatasetId", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+    ssm = boto3.client("ssm", region_name=region)
+    for name in [
+        "/dataplatform/data-uploader/keycloak-client-secret",
+        "/dataplatform/shared/email-api-key",
+    ]:
+        ssm.put_parameter(Name=name, Value="mock", Type="SecureString")
+
+
+class _Conflicts(logging.Handler):
+    """Count the writes to a dataset that conflicted with another write."""
+
+    count = 0
+
+    def emit(self, record):
+        if "conflicted with another write" in record.getMessage():
+            self.count += 1
+
+
+_handlers = {}
+_conflicts = _Conflicts()
+
+
+def _init_worker(stub_url, ready):
+    # Keep the handlers' logs (and awswrangler's experimental API warnings)
+    # out of the report.
+    sys.stdout = open(os.devnull, "w")
+    warnings.simplefilter("ignore")
+
+    from uploader.common import sdk_config
+    from uploader.handlers import generate_signed_post, handle_queue
+    from uploader.handlers import push_dataset_events
+
+    config = sdk_config().config
+    config["keycloakServerUrl"] = f"{stub_url}/auth"
+    config["datasetUrl"] = f"{stub_url}/metadata/datasets"
+    config["statusApiUrl"] = f"{stub_url}/status-api/status"
+
+    logging.getLogger().addHandler(_conflicts)
+
+    _handlers.update(
+        {
+            "signed-post": generate_signed_post.handler,
+            "events-v1": push_dataset_events.handler,
+            "events-v2": push_dataset_events.handler,
+            "event-queue": handle_queue.event_queue_handler,
+        }
+    )
+    ready.wait()
+
+
+def _request_body(params, i):
+    dataset_id = f"{EVENT_DATASET}-{i % params['datasets']}"
+    events = []
+    for j in range(params["events"]):
+        n = i * params["events"] + j
+        event = {"id": n, "timestamp": f"2024-01-01T00:00:{n % 60:02}Z"}
+        for c in range(params["width"]):
+            event[f"col_{c}"] = n * (c + 1) if c % 2 else f"value-{n % 7}"
+        events.append(event)
+    return {"datasetId": dataset_id, "mergeOn": ["id"], "events": events}
+
+
+def _event(params, scenario, i):
+    request_context = {"authorizer": {"principalId": "load-test-user"}}
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+
+    if scenario == "signed-post":
+        body = {"editionId": f"{FILE_DATASET}/1/{EDITION}", "filename": f"{i}.csv"}
+    elif scenario == "event-queue":
+        body = _request_body(params, i)
+        return {
+            "Records": [
+                {
+                    "messageId": str(i),
+                    "body": json.dumps(body),
+                    "messageAttributes": {
+                        "trace_id": {
+                            "stringValue": f"{body['datasetId']}-{i}",
+                            "dataType": "String",
+                        }
+                    },
+                    "eventSource": "aws:sqs",
+                }
+            ]
+        }
+    else:
+        body = _request_body(params, i)
+        if scenario == "events-v2":
+            body["apiVersion"] = 2
+
+    return {
+        "body": json.dumps(body),
+        "headers": headers,
+        "requestContext": request_context,
+    }
+
+
+def _invoke(params, scenario, indexes):
+    """Invoke the handler for `scenario` once per index, in sequence."""
+    handler = _handlers[scenario]
+    results = []
+
+    for i in indexes:
+        event = _event(params, scenario, i)
+        conflicts = _conflicts.count
+        start = time.perf_counter()
+        try:
+            status = handler(event, None)["statusCode"]
+        except Exception:
+            status = "exception"
+        results.append(
+            {
+                "latency_s": time.perf_counter() - start,
+                "status": status,
+                "conflicts": _conflicts.count - conflicts,
+            }
+        )
+    return results
+
+
+def _tasks(params, scenario):
+    indexes = range(params["requests"])
+    if scenario == "event-queue":
+        # One task per dataset (i.e. message group), like the FIFO queue.
+        return [
+            indexes[d :: params["datasets"]]
+            for d in range(min(params["datasets"], params["requests"]))
+        ]
+    return [[i] for i in indexes]
+
+
+def _percentile(values, q):
+    # Nearest-rank percentile of sorted `values`.
+    return values[max(0, -(-len(values) * q // 100) - 1)]
+
+
+def _summary(results, wall_s):
+    latencies = sorted(r["latency_s"] * 1000 for r in results)
+    conflicts = [r["conflicts"] for r in results]
+    return {
+        "requests": len(results),
+        "wall_s": round(wall_s, 3),
+        "throughput_rps": round(len(results) / wall_s, 1),
+        "p50_ms": round(_percentile(latencies, 50), 1),
+        "p95_ms": round(_percentile(latencies, 95), 1),
+        "p99_ms": round(_percentile(latencies, 99), 1),
+        "max_ms": round(latencies[-1], 1),
+        "status_codes": dict(Counter(str(r["status"]) for r in results)),
+        "conflicts": sum(conflicts),
+        "conflicted_requests": sum(1 for c in conflicts if c),
+    }
+
+
+def _report(scenario, summary):
+    print(
+        f"{scenario}: {summary['requests']} requests in {summary['wall_s']:.2f} s, "
+        f"{summary['throughput_rps']:.1f} req/s, "
+        f"p50 {summary['p50_ms']:.0f} ms, p95 {summary['p95_ms']:.0f} ms, "
+        f"p99 {summary['p99_ms']:.0f} ms, max {summary['max_ms']:.0f} ms, "
+        f"status codes {summary['status_codes']}"
+    )
+    if scenario == "events-v1":
+        print(
+            f"  write conflicts: {summary['conflicts']} retry(s) in "
+            f"{summary['conflicted_requests']} request(s), "
+            f"{summary['status_codes'].get('409', 0)} gave up"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--events", type=int, default=100, help="events per request")
+    parser.add_argument("--width", type=int, default=5, help="extra columns per event")
+    parser.add_argument(
+        "--datasets",
+        type=int,
+        default=1,
+        help="event datasets to spread requests over; fewer means more contention",
+    )
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    params = {
+        "events": args.events,
+        "width": args.width,
+        "datasets": args.datasets,
+        "requests": args.requests,
+    }
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stub, stub_url = _start_stub()
+        moto, moto_url = _start_moto()
+        try:
+            _configure_environment(tmp, moto_url, stub_url)
+            _create_resources()
+
+            ctx = multiprocessing.get_context("spawn")
+            ready = ctx.Barrier(args.concurrency + 1)
+            with ctx.Pool(
+                args.concurrency,
+                initializer=_init_worker,
+                initargs=(stub_url, ready),
+            ) as pool:
+                ready.wait()
+                for scenario in args.scenarios:
+                    start = time.perf_counter()
+                    chunks = pool.starmap(
+                        _invoke,
+                        [(params, scenario, t) for t in _tasks(params, scenario)],
+                        chunksize=1,
+                    )
+                    wall_s = time.perf_counter() - start
+
+                    results[scenario] = _summary(
+                        [r for chunk in chunks for r in chunk], wall_s
+                    )
+                    _report(scenario, results[scenario])
+        finally:
+            moto.stop()
+            stub.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"params": {**params, "concurrency": args.concurrency}, **results},
+                f,
+                indent=2,
+            )
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Compare the native presigned POST signer with boto3's.
+
+The boto3 path builds a new S3 client per call, as `generate_signed_post`
+used to do.
+
+    python -m benchmarks.presign
+"""
+
+import gc
+import os
+import timeit
+
+import boto3
+from botocore.client import Config as BotoConfig
+
+from uploader.presign import generate_presigned_post
+
+BUCKET = "testbucket"
+KEY = "raw/green/foo/version=1/edition=20200101T000000/data.csv"
+FIELDS = {"acl": "private"}
+CONDITIONS = [{"acl": "private"}]
+NUMBER = 200
+
+
+def _boto3():
+    s3 = boto3.client(
+        "s3",
+        region_name=os.environ["AWS_REGION"],
+        config=BotoConfig(signature_version="s3v4", s3={"addressing_style": "path"}),
+    )
+    return s3.generate_presigned_post(
+        BUCKET, KEY, Fields=FIELDS, Conditions=CONDITIONS, ExpiresIn=300
+    )
+
+
+def _native():
+    return generate_presigned_post(
+        BUCKET, KEY, fields=FIELDS, conditions=CONDITIONS, expires_in=300
+    )
+
+
+def main():
+    results = {}
+    for name, fn in [("native", _native), ("boto3", _boto3)]:
+        fn()  # Warm up caches
+        gc.collect()
+        results[name] = min(timeit.repeat(fn, number=NUMBER, repeat=3)) / NUMBER
+        print(f"{name:>8}: {results[name] * 1e6:10.1f} µs/call")
+
+    print(f"{'speedup':>8}: {results['boto3'] / results['native']:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
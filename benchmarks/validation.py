@@ -0,0 +1,63 @@
+"""Per-request cost of validating request bodies.
+
+Compares the precompiled validators in `uploader.schema` with reading,
+parsing and checking the schema on every request, as was done before.
+
+    python -m benchmarks.validation
+"""
+
+import json
+import timeit
+
+import jsonschema
+
+from uploader.schema import MODELS_DIR, validate
+
+NUMBER = 200
+
+
+def _events_body(size):
+    """Return a `pushEventsRequest` body of roughly `size` bytes."""
+    event = {
+        "id": 123456,
+        "timestamp": "2024-10-22T14:43:47.764186",
+        "district": "Gamle Oslo",
+        "status": "OK",
+        "value": 1.5,
+    }
+    count = max(1, size // len(json.dumps(event)))
+    return {
+        "datasetId": "my-dataset",
+        "version": "1",
+        "events": [dict(event, id=i) for i in range(count)],
+    }
+
+
+def _per_request_schema(body):
+    with open(f"{MODELS_DIR}/pushEventsRequest.json") as f:
+        jsonschema.validate(body, json.loads(f.read()))
+
+
+def _precompiled(body):
+    validate(body, "pushEventsRequest")
+
+
+def main():
+    for label, size in [("typical", 2 * 2**10), ("250 KiB", 250 * 2**10)]:
+        body = _events_body(size)
+        results = {}
+        for name, fn in [
+            ("per-request", _per_request_schema),
+            ("precompiled", _precompiled),
+        ]:
+            results[name] = (
+                min(timeit.repeat(lambda: fn(body), number=NUMBER, repeat=3)) / NUMBER
+            )
+        print(
+            f"{label:>8} ({len(json.dumps(body)) / 2**10:.0f} KiB): "
+            + ", ".join(f"{k} {v * 1e6:.1f} µs" for k, v in results.items())
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ import deltalake as dl
 from moto import mock_aws
 from pytest import fixture
 
-from uploader.dataset import dataframe_from_dict
+from uploader.inference import dataframe_from_dict
 
 
 @fixture
@@ -85,3 +85,19 @@ def dynamodb(dataset):
             Item={"DatasetId": dataset["Id"], "Subscribers": ["test@example.org"]}
         )
         yield dynamodb
+
+
+@fixture
+def status_queue():
+    """Create a mock SQS queue for status traces."""
+    with mock_aws():
+        sqs = boto3.resource("sqs", region_name=os.environ["AWS_REGION"])
+        yield sqs.create_queue(QueueName=os.environ["STATUS_QUEUE_NAME"])
+
+
+@fixture
+def alert_queue():
+    """Create a mock SQS queue for new column alerts."""
+    with mock_aws():
+        sqs = boto3.resource("sqs", region_name=os.environ["AWS_REGION"])
+        yield sqs.create_queue(QueueName=os.environ["ALERT_QUEUE_NAME"])
@@ -1,6 +1,7 @@
-import re
 import json
+import os
 
+import boto3
 import pytest
 from freezegun import freeze_time
 from okdata.resource_auth import ResourceAuthorizer
@@ -9,7 +10,12 @@ from uploader.common import error_response, split_edition_id
 from uploader.errors import InvalidDatasetEditionError
 from uploader.handlers.generate_signed_post import (
     ENABLE_AUTH,
+    batch_handler,
     handler,
+    multipart_abort_handler,
+    multipart_complete_handler,
+    multipart_handler,
+    multipart_parts_handler,
 )
 
 
@@ -25,6 +31,18 @@ def authorizer(monkeypatch):
     monkeypatch.setattr(ResourceAuthorizer, "has_access", check_token)
 
 
+@pytest.fixture(autouse=True)
+def aws(status_queue):
+    yield
+
+
+def _queued_status_traces(queue):
+    return [
+        json.loads(m.body)
+        for m in queue.receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=0)
+    ]
+
+
 @pytest.fixture
 def api_gateway_event():
     """
@@ -169,7 +187,7 @@ def test_handler_invalid_source_type(api_gateway_event, requests_mock):
 
 
 @freeze_time("2020-11-02T19:54:14.123456+00:00")
-def test_handler(api_gateway_event, requests_mock):
+def test_handler(api_gateway_event, requests_mock, status_queue):
     url = "https://api.data-dev.oslo.systems/metadata/datasets/datasetid"
     response = json.dumps({"accessRights": "restricted", "source": {"type": "file"}})
     requests_mock.register_uri("GET", url, text=response, status_code=200)
@@ -178,32 +196,78 @@ def test_handler(api_gateway_event, requests_mock):
     response = json.dumps({"Id": "datasetid/1/20190101T125959"})
     requests_mock.register_uri("GET", url, text=response, status_code=200)
 
-    url = "https://api.data-dev.oslo.systems/status-api/status/*"
-    matcher = re.compile(url)
-    trace_id = "my-dataset-00a1bcd2-e3f4-5a6b-c678-9c1defa234b5"
-    m = requests_mock.register_uri(
-        "POST", matcher, json={"trace_id": trace_id}, status_code=200
-    )
-
     event = api_gateway_event()
     ret = handler(event, None)
 
+    response_body = json.loads(ret["body"])
+    trace_id = response_body["trace_id"]
+
     assert ret["statusCode"] == 200
-    assert m.called_once
-    assert m.last_request.json() == {
-        "domain": "dataset",
-        "domain_id": "datasetid/1",
-        "component": "data-uploader",
-        "operation": "upload",
-        "user": "abc123456",
-        "start_time": "2020-11-02T19:54:14.123456+00:00",
-        "s3_path": "raw/yellow/datasetid/version=1/edition=20190101T125959/datastuff.txt",
-        "end_time": "2020-11-02T19:54:14.123456+00:00",
-    }
+    assert trace_id.startswith("datasetid-")
+    assert response_body["fields"]["x-amz-meta-trace-id"] == trace_id
+    assert _queued_status_traces(status_queue) == [
+        {
+            "trace_id": trace_id,
+            "trace_status": "STARTED",
+            "domain": "dataset",
+            "domain_id": "datasetid/1",
+            "component": "data-uploader",
+            "operation": "upload",
+            "user": "abc123456",
+            "start_time": "2020-11-02T19:54:14.123456+00:00",
+            "s3_path": "raw/yellow/datasetid/version=1/edition=20190101T125959/datastuff.txt",
+            "end_time": "2020-11-02T19:54:14.123456+00:00",
+        }
+    ]
+    assert response_body["status_response"] == trace_id
+
+
+@freeze_time("2020-11-02T19:54:14.123456+00:00")
+def test_handler_defer_edition(api_gateway_event, requests_mock, status_queue):
+    url = "https://api.data-dev.oslo.systems/metadata/datasets/datasetid"
+    response = json.dumps({"accessRights": "restricted", "source": {"type": "file"}})
+    requests_mock.register_uri("GET", url, text=response, status_code=200)
+
+    event = api_gateway_event(
+        body=json.dumps(
+            {
+                "editionId": "datasetid/1/",
+                "filename": "datastuff.txt",
+                "deferEdition": True,
+            }
+        )
+    )
+    ret = handler(event, None)
 
+    assert ret["statusCode"] == 200
     response_body = json.loads(ret["body"])
-    assert response_body["status_response"] == trace_id
-    assert response_body["trace_id"] == trace_id
+    trace_id = response_body["trace_id"]
+    s3_path = f"staging/datasetid/version=1/{trace_id}/datastuff.txt"
+    assert response_body["fields"]["key"] == s3_path
+    # Only the dataset was looked up; the edition is left for later.
+    assert requests_mock.call_count == 1
+    [status] = _queued_status_traces(status_queue)
+    assert status["trace_id"] == trace_id
+    assert status["s3_path"] == s3_path
+
+
+def test_multipart_handler_defer_edition(api_gateway_event, requests_mock):
+    url = "https://api.data-dev.oslo.systems/metadata/datasets/datasetid"
+    response = json.dumps({"accessRights": "restricted", "source": {"type": "file"}})
+    requests_mock.register_uri("GET", url, text=response, status_code=200)
+
+    event = api_gateway_event(
+        body=json.dumps(
+            {
+                "editionId": "datasetid/1/",
+                "filename": "datastuff.txt",
+                "deferEdition": True,
+            }
+        )
+    )
+    ret = multipart_handler(event, None)
+
+    assert ret["statusCode"] == 400
 
 
 def test_handler_404_response(api_gateway_event, requests_mock):
@@ -228,13 +292,6 @@ def test_s3_confidentiality_path_yellow(api_gateway_event, requests_mock):
     response = json.dumps({"Id": "alder-distribusjon-status/1/20190101T125959"})
     requests_mock.register_uri("GET", url, text=response, status_code=200)
 
-    url = "https://api.data-dev.oslo.systems/status-api/status/*"
-    matcher = re.compile(url)
-    trace_id = "my-dataset-00a1bcd2-e3f4-5a6b-c678-9c1defa234b5"
-    requests_mock.register_uri(
-        "POST", matcher, json={"trace_id": trace_id}, status_code=200
-    )
-
     event = api_gateway_event()
     postBody = json.loads(event["body"])
     postBody["editionId"] = "alder-distribusjon-status/1/20190101T125959"
@@ -244,8 +301,7 @@ def test_s3_confidentiality_path_yellow(api_gateway_event, requests_mock):
     response_body = json.loads(ret["body"])
     key = response_body["fields"]["key"]
     assert "/yellow/" in key
-    assert response_body["status_response"] == trace_id
-    assert response_body["trace_id"] == trace_id
+    assert response_body["status_response"] == response_body["trace_id"]
 
 
 def test_s3_confidentiality_path_green(api_gateway_event, requests_mock):
@@ -257,13 +313,6 @@ def test_s3_confidentiality_path_green(api_gateway_event, requests_mock):
     response = json.dumps({"Id": "badetemperatur/1/20190101T125959"})
     requests_mock.register_uri("GET", url, text=response, status_code=200)
 
-    url = "https://api.data-dev.oslo.systems/status-api/status/*"
-    matcher = re.compile(url)
-    trace_id = "my-dataset-00a1bcd2-e3f4-5a6b-c678-9c1defa234b5"
-    requests_mock.register_uri(
-        "POST", matcher, json={"trace_id": trace_id}, status_code=200
-    )
-
     event = api_gateway_event()
     postBody = json.loads(event["body"])
     postBody["editionId"] = "badetemperatur/1/20190101T125959"
@@ -273,8 +322,7 @@ def test_s3_confidentiality_path_green(api_gateway_event, requests_mock):
     response_body = json.loads(ret["body"])
     key = response_body["fields"]["key"]
     assert "/green/" in key
-    assert response_body["status_response"] == trace_id
-    assert response_body["trace_id"] == trace_id
+    assert response_body["status_response"] == response_body["trace_id"]
 
 
 def test_s3_confidentiality_path_no_access_rights_response(
@@ -288,13 +336,6 @@ def test_s3_confidentiality_path_no_access_rights_response(
     response = json.dumps({"Id": "badetemperatur/1/20190101T125959"})
     requests_mock.register_uri("GET", url, text=response, status_code=200)
 
-    url = "https://api.data-dev.oslo.systems/status-api/status/*"
-    matcher = re.compile(url)
-    trace_id = "my-dataset-00a1bcd2-e3f4-5a6b-c678-9c1defa234b5"
-    requests_mock.register_uri(
-        "POST", matcher, json={"trace_id": trace_id}, status_code=200
-    )
-
     event = api_gateway_event()
     postBody = json.loads(event["body"])
     postBody["editionId"] = "badetemperatur/1/20190101T125959"
@@ -302,3 +343,250 @@ def test_s3_confidentiality_path_no_access_rights_response(
 
     ret = handler(event, None)
     assert ret["statusCode"] == 400
+
+
+@freeze_time("2020-11-02T19:54:14.123456+00:00")
+def test_batch_handler(api_gateway_event, requests_mock, status_queue):
+    url = "https://api.data-dev.oslo.systems/metadata/datasets/datasetid"
+    response = json.dumps({"accessRights": "restricted", "source": {"type": "file"}})
+    dataset_matcher = requests_mock.register_uri(
+        "GET", url, text=response, status_code=200
+    )
+
+    url = "https://api.data-dev.oslo.systems/metadata/datasets/datasetid/versions/1/editions/20190101T125959"
+    response = json.dumps({"Id": "datasetid/1/20190101T125959"})
+    edition_matcher = requests_mock.register_uri(
+        "GET", url, text=response, status_code=200
+    )
+
+    filenames = [f"part-{i}.csv" for i in range(50)]
+    event = api_gateway_event(
+        body=json.dumps(
+            {"editionId": "datasetid/1/20190101T125959", "filenames": filenames}
+        )
+    )
+    ret = batch_handler(event, None)
+
+    assert ret["statusCode"] == 200
+    assert dataset_matcher.call_count == 1
+    assert edition_matcher.call_count == 1
+
+    response_body = json.loads(ret["body"])
+    assert _queued_status_traces(status_queue) == [
+        {
+            "trace_id": response_body["trace_id"],
+            "trace_status": "STARTED",
+            "domain": "dataset",
+            "domain_id": "datasetid/1",
+            "component": "data-uploader",
+            "operation": "upload",
+            "user": "abc123456",
+            "start_time": "2020-11-02T19:54:14.123456+00:00",
+            "s3_path": "raw/yellow/datasetid/version=1/edition=20190101T125959",
+            "end_time": "2020-11-02T19:54:14.123456+00:00",
+        }
+    ]
+    assert [p["filename"] for p in response_body["posts"]] == filenames
+    assert [p["fields"]["key"] for p in response_body["posts"]] == [
+        f"raw/yellow/datasetid/version=1/edition=20190101T125959/{f}" for f in filenames
+    ]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {"editionId": "datasetid/1/20190101T125959"},
+        {"editionId": "datasetid/1/20190101T125959", "filenames": []},
+        {"editionId": "datasetid/1/20190101T125959", "filenames": ["a", "a"]},
+        {"editionId": "datasetid/1/20190101T125959", "filenames": [""]},
+        {"editionId": "datasetid/1/20190101T125959", "filename": "a"},
+    ],
+)
+def test_batch_handler_invalid_json(api_gateway_event, body):
+    event = api_gateway_event(body=json.dumps(body))
+    ret = batch_handler(event, None)
+    assert ret["statusCode"] == 400
+    assert (
+        json.loads(ret["body"])["message"]
+        == "JSON document does not conform to the given schema"
+    )
+
+
+@pytest.fixture
+def s3(status_queue):
+    s3 = boto3.client("s3", region_name=os.environ["AWS_REGION"])
+    s3.create_bucket(
+        Bucket=os.environ["BUCKET"],
+        CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_REGION"]},
+    )
+    return s3
+
+
+@pytest.fixture
+def metadata_api(requests_mock):
+    url = "https://api.data-dev.oslo.systems/metadata/datasets/datasetid"
+    response = json.dumps({"accessRights": "restricted", "source": {"type": "file"}})
+    requests_mock.register_uri("GET", url, text=response, status_code=200)
+
+    url = "https://api.data-dev.oslo.systems/metadata/datasets/datasetid/versions/1/editions/20190101T125959"
+    response = json.dumps({"Id": "datasetid/1/20190101T125959"})
+    requests_mock.register_uri("GET", url, text=response, status_code=200)
+
+
+MULTIPART_KEY = "raw/yellow/datasetid/version=1/edition=20190101T125959/datastuff.txt"
+
+
+def _create_multipart_upload(api_gateway_event):
+    ret = multipart_handler(api_gateway_event(), None)
+    assert ret["statusCode"] == 200
+    return json.loads(ret["body"])
+
+
+def _multipart_body(upload_id, **kwargs):
+    return json.dumps(
+        {
+            "editionId": "datasetid/1/20190101T125959",
+            "filename": "datastuff.txt",
+            "uploadId": upload_id,
+            **kwargs,
+        }
+    )
+
+
+def test_multipart_handler(api_gateway_event, metadata_api, s3):
+    response_body = _create_multipart_upload(api_gateway_event)
+
+    assert response_body["editionId"] == "datasetid/1/20190101T125959"
+    assert response_body["key"] == MULTIPART_KEY
+    assert response_body["trace_id"].startswith("datasetid-")
+
+    uploads = s3.list_multipart_uploads(Bucket=os.environ["BUCKET"])["Uploads"]
+    assert [(u["UploadId"], u["Key"]) for u in uploads] == [
+        (response_body["uploadId"], MULTIPART_KEY)
+    ]
+
+
+def test_multipart_parts_handler(api_gateway_event, metadata_api, s3):
+    upload_id = _create_multipart_upload(api_gateway_event)["uploadId"]
+
+    ret = multipart_parts_handler(
+        api_gateway_event(body=_multipart_body(upload_id, firstPart=2, lastPart=4)),
+        None,
+    )
+
+    assert ret["statusCode"] == 200
+    parts = json.loads(ret["body"])["parts"]
+    assert [p["partNumber"] for p in parts] == [2, 3, 4]
+    for p in parts:
+        assert p["url"].startswith(
+            "https://s3.eu-west-1.amazonaws.com/testbucket/raw/yellow/datasetid/"
+        )
+        assert f"partNumber={p['partNumber']}" in p["url"]
+        assert f"uploadId={upload_id}" in p["url"]
+
+
+@pytest.mark.parametrize("first_part,last_part", [(3, 2), (1, 1001)])
+def test_multipart_parts_handler_invalid_range(
+    api_gateway_event, metadata_api, first_part, last_part
+):
+    ret = multipart_parts_handler(
+        api_gateway_event(
+            body=_multipart_body("upload-id", firstPart=first_part, lastPart=last_part)
+        ),
+        None,
+    )
+    assert ret["statusCode"] == 400
+
+
+def test_multipart_parts_handler_invalid_json(api_gateway_event):
+    ret = multipart_parts_handler(
+        api_gateway_event(body=_multipart_body("upload-id", firstPart=0, lastPart=1)),
+        None,
+    )
+    assert ret["statusCode"] == 400
+
+
+@pytest.mark.parametrize(
+    "handler_func,kwargs",
+    [
+        (multipart_parts_handler, {"firstPart": 1, "lastPart": 2}),
+        (multipart_complete_handler, {"parts": [{"partNumber": 1, "etag": "x"}]}),
+        (multipart_abort_handler, {}),
+    ],
+)
+def test_multipart_handlers_edition_not_found(
+    api_gateway_event, metadata_api, requests_mock, handler_func, kwargs
+):
+    url = "https://api.data-dev.oslo.systems/metadata/datasets/datasetid/versions/1/editions/no-such-edition"
+    requests_mock.register_uri("GET", url, text="{}", status_code=404)
+
+    ret = handler_func(
+        api_gateway_event(
+            body=_multipart_body(
+                "upload-id", editionId="datasetid/1/no-such-edition", **kwargs
+            )
+        ),
+        None,
+    )
+
+    assert ret["statusCode"] == 400
+    assert json.loads(ret["body"])["message"] == "Incorrect dataset edition"
+
+
+def test_multipart_complete_handler(api_gateway_event, metadata_api, s3):
+    upload = _create_multipart_upload(api_gateway_event)
+    upload_id = upload["uploadId"]
+
+    parts = []
+    for part_number, body in [(2, b"world"), (1, b"hello " * 2**20)]:
+        res = s3.upload_part(
+            Bucket=os.environ["BUCKET"],
+            Key=MULTIPART_KEY,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        parts.append({"partNumber": part_number, "etag": res["ETag"]})
+
+    ret = multipart_complete_handler(
+        api_gateway_event(body=_multipart_body(upload_id, parts=parts)), None
+    )
+
+    assert ret["statusCode"] == 200
+    assert json.loads(ret["body"]) == {"uploadId": upload_id, "key": MULTIPART_KEY}
+
+    obj = s3.get_object(Bucket=os.environ["BUCKET"], Key=MULTIPART_KEY)
+    assert obj["Body"].read() == b"hello " * 2**20 + b"world"
+    # Tagged with the trace of the upload.
+    assert obj["Metadata"] == {"trace-id": upload["trace_id"]}
+
+
+def test_multipart_abort_handler_no_such_upload(api_gateway_event, metadata_api, s3):
+    ret = multipart_abort_handler(
+        api_gateway_event(body=_multipart_body("no-such-upload")), None
+    )
+    assert ret["statusCode"] == 404
+
+
+def test_multipart_abort_handler(api_gateway_event, metadata_api, s3):
+    upload_id = _create_multipart_upload(api_gateway_event)["uploadId"]
+
+    ret = multipart_abort_handler(
+        api_gateway_event(body=_multipart_body(upload_id)), None
+    )
+
+    assert ret["statusCode"] == 200
+    assert "Uploads" not in s3.list_multipart_uploads(Bucket=os.environ["BUCKET"])
+
+
+@pytest.mark.skipif(not ENABLE_AUTH, reason="Auth is disabled")
+def test_multipart_abort_handler_403_when_not_authenticated(
+    api_gateway_event, metadata_api
+):
+    ret = multipart_abort_handler(
+        api_gateway_event(
+            authorization_header="Snusk", body=_multipart_body("upload-id")
+        ),
+        None,
+    )
+    assert ret["statusCode"] == 403
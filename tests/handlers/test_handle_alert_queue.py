@@ -0,0 +1,59 @@
+import json
+from unittest.mock import call, patch
+
+from uploader.errors import AlertEmailError
+from uploader.handlers.handle_alert_queue import alert_queue_handler
+
+
+def _record(message_id, dataset_id, new_columns):
+    return {
+        "messageId": message_id,
+        "body": json.dumps(
+            {
+                "dataset_id": dataset_id,
+                "new_columns": new_columns,
+                "detected_at": "2024-05-01T12:00:00+00:00",
+            }
+        ),
+        "eventSource": "aws:sqs",
+    }
+
+
+@patch("uploader.handlers.handle_alert_queue.send_alert_digest")
+def test_alert_queue_handler(send_alert_digest):
+    send_alert_digest.return_value = True
+    event = {
+        "Records": [
+            _record("1", "foo", ["a"]),
+            _record("2", "bar", ["x"]),
+            _record("3", "foo", ["a", "b"]),
+        ]
+    }
+
+    assert alert_queue_handler(event, None) == {"batchItemFailures": []}
+
+    send_alert_digest.assert_has_calls(
+        [call("foo", {"a", "b"}), call("bar", {"x"})], any_order=True
+    )
+    assert send_alert_digest.call_count == 2
+
+
+@patch("uploader.handlers.handle_alert_queue.send_alert_digest")
+def test_alert_queue_handler_email_error(send_alert_digest):
+    def send(dataset_id, new_columns):
+        if dataset_id == "foo":
+            raise AlertEmailError("Could not alert")
+        return True
+
+    send_alert_digest.side_effect = send
+    event = {
+        "Records": [
+            _record("1", "foo", ["a"]),
+            _record("2", "bar", ["x"]),
+            _record("3", "foo", ["b"]),
+        ]
+    }
+
+    assert alert_queue_handler(event, None) == {
+        "batchItemFailures": [{"itemIdentifier": "1"}, {"itemIdentifier": "3"}]
+    }
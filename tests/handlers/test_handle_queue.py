@@ -1,7 +1,13 @@
+import base64
 import json
 from unittest.mock import patch
 
+import pyarrow as pa
 import pytest
+from okdata.aws.status import TraceEventStatus, TraceStatus
+
+from uploader.errors import DatasetTooLargeError
+from uploader.formats import ARROW_STREAM, write_ipc
 
 with patch("uploader.common.get_secret") as get_secret:
     get_secret.return_value = "top-secret"
@@ -63,7 +69,58 @@ def test_event_queue_handler(
         ["id"],
         "s3://testbucket/processed/red/test-dataset/version=1/latest",
         [{"id": 1, "value": 5}],
+        [],
+        dedup="last",
     )
 
     assert res["statusCode"] == 200
     assert json.loads(res["body"])["editionId"] == "new-edition"
+
+
+@patch("uploader.handlers.handle_queue.get_and_validate_dataset")
+@patch("uploader.handlers.handle_queue.handle_events")
+@patch("uploader.handlers.handle_queue.status_add")
+def test_event_queue_handler_dataset_too_large(
+    status_add, handle_events, get_and_validate_dataset, mock_event
+):
+    get_and_validate_dataset.return_value = {
+        "Id": "test-dataset",
+        "accessRights": "non-public",
+    }
+    handle_events.side_effect = DatasetTooLargeError("Too large")
+
+    # Doesn't raise, so that the message isn't retried.
+    res = event_queue_handler(mock_event, None)
+
+    assert res["statusCode"] == 413
+    status = status_add.call_args.kwargs
+    assert status["trace_event_status"] == TraceEventStatus.FAILED
+    assert status["trace_status"] == TraceStatus.FINISHED
+    assert status["errors"][0]["message"]["en"]
+
+
+@patch("uploader.handlers.handle_queue.get_and_validate_dataset")
+@patch("uploader.handlers.handle_queue.handle_events")
+@patch("uploader.handlers.handle_queue.status_add")
+def test_event_queue_handler_columnar(
+    status_add, handle_events, get_and_validate_dataset, mock_event
+):
+    get_and_validate_dataset.return_value = {
+        "Id": "test-dataset",
+        "accessRights": "non-public",
+    }
+    handle_events.return_value = "new-edition"
+    table = pa.table({"id": [1], "value": [5]})
+    mock_event["Records"][0]["body"] = json.dumps(
+        {
+            "datasetId": "test-dataset",
+            "mergeOn": ["id"],
+            "contentType": ARROW_STREAM,
+            "data": base64.b64encode(write_ipc(table)).decode(),
+        }
+    )
+
+    res = event_queue_handler(mock_event, None)
+
+    assert res["statusCode"] == 200
+    assert handle_events.call_args.args[4].equals(table)
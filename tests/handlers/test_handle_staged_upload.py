@@ -0,0 +1,162 @@
+import os
+from unittest.mock import patch
+
+import boto3
+import pytest
+from moto import mock_aws
+from okdata.aws.status import TraceEventStatus, TraceStatus
+
+from uploader.errors import DatasetNotFoundError
+
+with patch("uploader.common.get_secret") as get_secret:
+    get_secret.return_value = "top-secret"
+    from uploader.handlers import handle_staged_upload
+    from uploader.handlers.handle_staged_upload import staged_upload_handler
+
+STAGED_KEY = "staging/test-dataset/version=1/test-dataset-abc/my+file.csv"
+CLAIM_KEY = "staging-claims/test-dataset/version=1/test-dataset-abc/my file.csv"
+
+
+@pytest.fixture(autouse=True)
+def sdk_config():
+    with patch("uploader.handlers.handle_staged_upload.sdk_config") as sdk_config:
+        yield sdk_config
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        handle_staged_upload._s3_client.cache_clear()
+        s3 = boto3.client("s3", region_name=os.environ["AWS_REGION"])
+        s3.create_bucket(
+            Bucket=os.environ["BUCKET"],
+            CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_REGION"]},
+        )
+        s3.put_object(
+            Bucket=os.environ["BUCKET"],
+            Key="staging/test-dataset/version=1/test-dataset-abc/my file.csv",
+            Body=b"a,b\n1,2\n",
+        )
+        yield s3
+        handle_staged_upload._s3_client.cache_clear()
+
+
+@pytest.fixture
+def s3_event():
+    return {
+        "Records": [
+            {
+                "eventSource": "aws:s3",
+                "eventName": "ObjectCreated:Post",
+                "s3": {
+                    "bucket": {"name": os.environ["BUCKET"]},
+                    "object": {"key": STAGED_KEY, "size": 8},
+                },
+            }
+        ]
+    }
+
+
+def _keys(s3):
+    return [
+        o["Key"]
+        for o in s3.list_objects_v2(Bucket=os.environ["BUCKET"]).get("Contents", [])
+    ]
+
+
+@patch("uploader.handlers.handle_staged_upload.get_and_validate_dataset")
+@patch("uploader.handlers.handle_staged_upload.Dataset")
+@patch("uploader.handlers.handle_staged_upload.status_add")
+def test_staged_upload_handler(
+    status_add, Dataset, get_and_validate_dataset, s3, s3_event
+):
+    get_and_validate_dataset.return_value = {
+        "Id": "test-dataset",
+        "accessRights": "non-public",
+    }
+    auto_create_edition = Dataset.return_value.auto_create_edition
+    auto_create_edition.return_value = {"Id": "test-dataset/1/20240101T120000"}
+
+    res = staged_upload_handler(s3_event, None)
+
+    assert res["statusCode"] == 200
+    auto_create_edition.assert_called_once_with("test-dataset", "1")
+    s3_path = "raw/red/test-dataset/version=1/edition=20240101T120000/my file.csv"
+    assert _keys(s3) == [s3_path, CLAIM_KEY]
+    body = s3.get_object(Bucket=os.environ["BUCKET"], Key=s3_path)["Body"].read()
+    assert body == b"a,b\n1,2\n"
+    status_add.assert_any_call(
+        trace_id="test-dataset-abc", domain="dataset", domain_id="test-dataset/1"
+    )
+    status_add.assert_called_with(s3_path=s3_path)
+
+
+@patch("uploader.handlers.handle_staged_upload.get_and_validate_dataset")
+@patch("uploader.handlers.handle_staged_upload.Dataset")
+@patch("uploader.handlers.handle_staged_upload.status_add")
+def test_staged_upload_handler_already_moved(
+    status_add, Dataset, get_and_validate_dataset, s3, s3_event
+):
+    s3.delete_object(
+        Bucket=os.environ["BUCKET"],
+        Key="staging/test-dataset/version=1/test-dataset-abc/my file.csv",
+    )
+
+    res = staged_upload_handler(s3_event, None)
+
+    assert res["statusCode"] == 200
+    Dataset.return_value.auto_create_edition.assert_not_called()
+
+
+@patch("uploader.handlers.handle_staged_upload.get_and_validate_dataset")
+@patch("uploader.handlers.handle_staged_upload.Dataset")
+@patch("uploader.handlers.handle_staged_upload.status_add")
+def test_staged_upload_handler_already_claimed(
+    status_add, Dataset, get_and_validate_dataset, s3, s3_event
+):
+    # Another notification of the same file is being handled.
+    s3.put_object(Bucket=os.environ["BUCKET"], Key=CLAIM_KEY, Body=b"")
+
+    res = staged_upload_handler(s3_event, None)
+
+    assert res["statusCode"] == 200
+    Dataset.return_value.auto_create_edition.assert_not_called()
+    assert "staging/test-dataset/version=1/test-dataset-abc/my file.csv" in _keys(s3)
+
+
+@patch("uploader.handlers.handle_staged_upload.get_and_validate_dataset")
+@patch("uploader.handlers.handle_staged_upload.Dataset")
+@patch("uploader.handlers.handle_staged_upload.status_add")
+def test_staged_upload_handler_failed(
+    status_add, Dataset, get_and_validate_dataset, s3, s3_event
+):
+    get_and_validate_dataset.return_value = {
+        "Id": "test-dataset",
+        "accessRights": "non-public",
+    }
+    Dataset.return_value.auto_create_edition.side_effect = Exception("Oops")
+
+    with pytest.raises(Exception, match="Oops"):
+        staged_upload_handler(s3_event, None)
+
+    # Released for the retry.
+    assert _keys(s3) == ["staging/test-dataset/version=1/test-dataset-abc/my file.csv"]
+
+
+@patch("uploader.handlers.handle_staged_upload.get_and_validate_dataset")
+@patch("uploader.handlers.handle_staged_upload.Dataset")
+@patch("uploader.handlers.handle_staged_upload.status_add")
+def test_staged_upload_handler_dataset_not_found(
+    status_add, Dataset, get_and_validate_dataset, s3, s3_event
+):
+    get_and_validate_dataset.side_effect = DatasetNotFoundError
+
+    # Doesn't raise, so that the event isn't retried.
+    res = staged_upload_handler(s3_event, None)
+
+    assert res["statusCode"] == 400
+    Dataset.return_value.auto_create_edition.assert_not_called()
+    assert _keys(s3) == [CLAIM_KEY]
+    status = status_add.call_args.kwargs
+    assert status["trace_event_status"] == TraceEventStatus.FAILED
+    assert status["trace_status"] == TraceStatus.FINISHED
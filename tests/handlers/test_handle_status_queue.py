@@ -0,0 +1,49 @@
+import json
+from unittest.mock import patch
+
+from requests.exceptions import HTTPError
+
+with patch("uploader.common.get_secret") as get_secret:
+    get_secret.return_value = "top-secret"
+    from uploader.handlers.handle_status_queue import status_queue_handler
+
+
+def _mock_event(trace_ids):
+    return {
+        "Records": [
+            {
+                "messageId": f"message-{trace_id}",
+                "body": json.dumps({"trace_id": trace_id, "domain": "dataset"}),
+                "eventSource": "aws:sqs",
+            }
+            for trace_id in trace_ids
+        ]
+    }
+
+
+@patch("uploader.handlers.handle_status_queue.sdk_config")
+@patch("uploader.handlers.handle_status_queue.Status")
+def test_status_queue_handler(Status, sdk_config):
+    res = status_queue_handler(_mock_event(["a", "b"]), None)
+
+    assert res == {"batchItemFailures": []}
+    assert [c.args[:2] for c in Status.return_value.update_status.call_args_list] == [
+        ("a", {"trace_id": "a", "domain": "dataset"}),
+        ("b", {"trace_id": "b", "domain": "dataset"}),
+    ]
+
+
+@patch("uploader.handlers.handle_status_queue.sdk_config")
+@patch("uploader.handlers.handle_status_queue.Status")
+def test_status_queue_handler_partial_failure(Status, sdk_config):
+    def update_status(trace_id, data, retries=0):
+        if trace_id == "b":
+            raise HTTPError("500 Server Error")
+        return {}
+
+    Status.return_value.update_status.side_effect = update_status
+
+    res = status_queue_handler(_mock_event(["a", "b", "c"]), None)
+
+    assert res == {"batchItemFailures": [{"itemIdentifier": "message-b"}]}
+    assert Status.return_value.update_status.call_count == 3
@@ -1,12 +1,15 @@
+import base64
 import concurrent.futures
 import json
-import os
 from unittest.mock import patch
 
-import boto3
+import pyarrow as pa
+import pytest
 from moto import mock_aws
 
-from uploader.handlers.push_dataset_events import handler
+from uploader.errors import ConcurrentWriteError, DatasetTooLargeError
+from uploader.formats import ARROW_STREAM, write_ipc
+from uploader.handlers.push_dataset_events import handle_events, handler
 
 
 def _mock_event(body):
@@ -14,19 +17,12 @@ def _mock_event(body):
     return {"body": json.dumps(body), "headers": {"Authorization": ""}}
 
 
-def _mock_dynamodb():
-    """Create a mock DynamoDB table named `delta-write-lock`.
+@patch("uploader.dataset.handle_events")
+def test_handle_events_proxy(dataset_handle_events):
+    dataset_handle_events.return_value = "new-edition"
 
-    Mimics the properties of the real `delta-write-lock`.
-    """
-    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
-    dynamodb.create_table(
-        TableName="delta-write-lock",
-        KeySchema=[{"AttributeName": "DatasetId", "KeyType": "HASH"}],
-        AttributeDefinitions=[{"AttributeName": "DatasetId", "AttributeType": "S"}],
-        ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1},
-    )
-    return dynamodb
+    assert handle_events("dataset", "1", [], "s3://foo", []) == "new-edition"
+    dataset_handle_events.assert_called_once_with("dataset", "1", [], "s3://foo", [])
 
 
 def test_handler_missing_dataset_id():
@@ -52,19 +48,16 @@ def test_handler_unauthorized(has_access):
 
 
 @mock_aws
+@patch("uploader.handlers.push_dataset_events.handle_events")
 @patch("uploader.handlers.push_dataset_events.resource_authorizer.has_access")
 @patch("uploader.handlers.push_dataset_events.get_and_validate_dataset")
-@patch("uploader.handlers.push_dataset_events.LOCK_WAIT_SECONDS", 1)  # quicker tests
-@patch("uploader.handlers.push_dataset_events.LOCK_RETRIES", 3)  # quicker tests
-def test_handler_dataset_locked(get_and_validate_dataset, has_access):
+def test_handler_concurrent_write(get_and_validate_dataset, has_access, handle_events):
     has_access.return_value = True
     get_and_validate_dataset.return_value = {"Id": "foo", "accessRights": "non-public"}
-    dynamodb = _mock_dynamodb()
-
-    lock_table = dynamodb.Table("delta-write-lock")
-    lock_table.put_item(Item={"DatasetId": "foo"})
+    handle_events.side_effect = ConcurrentWriteError("Conflicting writes")
 
     res = handler(_mock_event({"datasetId": "foo", "events": [{"a": 1}]}), None)
+
     assert res["statusCode"] == 409
 
 
@@ -78,12 +71,75 @@ def test_handler_single_valid_event(
     has_access.return_value = True
     get_and_validate_dataset.return_value = {"Id": "foo", "accessRights": "non-public"}
     handle_events.return_value = "new-edition"
-    _mock_dynamodb()
 
     res = handler(_mock_event({"datasetId": "foo", "events": [{"a": 1}]}), None)
     assert res["statusCode"] == 201
 
 
+@mock_aws
+@patch("uploader.handlers.push_dataset_events.handle_events")
+@patch("uploader.handlers.push_dataset_events.resource_authorizer.has_access")
+@patch("uploader.handlers.push_dataset_events.get_and_validate_dataset")
+def test_handler_deletes(get_and_validate_dataset, has_access, handle_events):
+    has_access.return_value = True
+    dataset = {"Id": "foo", "accessRights": "non-public"}
+    get_and_validate_dataset.return_value = dataset
+    handle_events.return_value = "new-edition"
+
+    res = handler(
+        _mock_event({"datasetId": "foo", "mergeOn": ["id"], "deletes": [{"id": 1}]}),
+        None,
+    )
+
+    assert res["statusCode"] == 201
+    assert json.loads(res["body"]) == {"editionId": "new-edition"}
+    handle_events.assert_called_once_with(
+        dataset,
+        "1",
+        ["id"],
+        "s3://testbucket/processed/red/foo/version=1/latest",
+        [],
+        [{"id": 1}],
+        dedup="last",
+    )
+
+
+@mock_aws
+@patch("uploader.handlers.push_dataset_events.handle_events")
+@patch("uploader.handlers.push_dataset_events.resource_authorizer.has_access")
+@patch("uploader.handlers.push_dataset_events.get_and_validate_dataset")
+def test_handler_deletes_no_data(get_and_validate_dataset, has_access, handle_events):
+    has_access.return_value = True
+    get_and_validate_dataset.return_value = {"Id": "foo", "accessRights": "non-public"}
+    # Nothing to delete from.
+    handle_events.return_value = None
+
+    res = handler(
+        _mock_event({"datasetId": "foo", "mergeOn": ["id"], "deletes": [{"id": 1}]}),
+        None,
+    )
+
+    assert res["statusCode"] == 200
+    body = json.loads(res["body"])
+    assert body["unchanged"] is True
+    assert "editionId" not in body
+
+
+@mock_aws
+@patch("uploader.handlers.push_dataset_events.handle_events")
+@patch("uploader.handlers.push_dataset_events.resource_authorizer.has_access")
+@patch("uploader.handlers.push_dataset_events.get_and_validate_dataset")
+def test_handler_dataset_too_large(get_and_validate_dataset, has_access, handle_events):
+    has_access.return_value = True
+    get_and_validate_dataset.return_value = {"Id": "foo", "accessRights": "non-public"}
+    handle_events.side_effect = DatasetTooLargeError("Too large")
+
+    res = handler(_mock_event({"datasetId": "foo", "events": [{"a": 1}]}), None)
+
+    assert res["statusCode"] == 413
+    assert json.loads(res["body"])["message"] == "Too large"
+
+
 @mock_aws
 @patch("uploader.handlers.push_dataset_events.handle_events")
 @patch("uploader.handlers.push_dataset_events.resource_authorizer.has_access")
@@ -94,7 +150,6 @@ def test_handler_multipe_valid_events_in_parallel(
     has_access.return_value = True
     get_and_validate_dataset.return_value = {"Id": "foo", "accessRights": "non-public"}
     handle_events.return_value = "new-edition"
-    _mock_dynamodb()
 
     def run_handler(i):
         # Unwrap the handler from `logging_wrapper` since `logging_wrapper`
@@ -109,3 +164,98 @@ def test_handler_multipe_valid_events_in_parallel(
 
     assert all(f.result()["statusCode"] == 201 for f in futures)
     assert handle_events.call_count == 20
+
+
+def _columnar_event(payload, content_type, params, base64_encoded=True):
+    return {
+        "body": base64.b64encode(payload).decode() if base64_encoded else payload,
+        "isBase64Encoded": base64_encoded,
+        "headers": {"Authorization": "", "Content-Type": content_type},
+        "queryStringParameters": params,
+    }
+
+
+@mock_aws
+@patch("uploader.handlers.push_dataset_events.handle_events")
+@patch("uploader.handlers.push_dataset_events.resource_authorizer.has_access")
+@patch("uploader.handlers.push_dataset_events.get_and_validate_dataset")
+def test_handler_arrow_stream(get_and_validate_dataset, has_access, handle_events):
+    has_access.return_value = True
+    dataset = {"Id": "foo", "accessRights": "non-public"}
+    get_and_validate_dataset.return_value = dataset
+    handle_events.return_value = "new-edition"
+    table = pa.table({"id": [1, 2], "a": ["x", "y"]})
+
+    res = handler(
+        _columnar_event(
+            write_ipc(table),
+            ARROW_STREAM,
+            {
+                "datasetId": "foo",
+                "mergeOn": "id,a",
+                "version": "2",
+                "dedup": "coalesce",
+            },
+        ),
+        None,
+    )
+
+    assert res["statusCode"] == 201
+    args = handle_events.call_args.args
+    assert args[:4] == (
+        dataset,
+        "2",
+        ["id", "a"],
+        "s3://testbucket/processed/red/foo/version=2/latest",
+    )
+    assert args[4].equals(table)
+    assert handle_events.call_args.kwargs["dedup"] == "coalesce"
+
+
+@mock_aws
+@patch("uploader.handlers.push_dataset_events.handle_events")
+@patch("uploader.handlers.push_dataset_events.resource_authorizer.has_access")
+@patch("uploader.handlers.push_dataset_events.get_and_validate_dataset")
+def test_handler_ndjson(get_and_validate_dataset, has_access, handle_events):
+    has_access.return_value = True
+    get_and_validate_dataset.return_value = {"Id": "foo", "accessRights": "non-public"}
+    handle_events.return_value = "new-edition"
+
+    res = handler(
+        _columnar_event(
+            '{"id": 1}\n{"id": 2}\n',
+            "application/x-ndjson; charset=utf-8",
+            {"datasetId": "foo"},
+            base64_encoded=False,
+        ),
+        None,
+    )
+
+    assert res["statusCode"] == 201
+    assert handle_events.call_args.args[4].to_pylist() == [{"id": 1}, {"id": 2}]
+
+
+@pytest.mark.parametrize(
+    "payload,content_type,params,status_code",
+    [
+        (b"a,b\n1,2", "text/csv", {"datasetId": "foo"}, 415),
+        (b"nope", ARROW_STREAM, {"datasetId": "foo"}, 400),
+        (write_ipc(pa.table({"a": [1]})), ARROW_STREAM, None, 400),
+        (
+            write_ipc(pa.table({"a": [1]})),
+            ARROW_STREAM,
+            {"datasetId": "foo", "apiVersion": "two"},
+            400,
+        ),
+        (
+            write_ipc(pa.table({"a": [1]})),
+            ARROW_STREAM,
+            {"datasetId": "foo", "dedup": "any"},
+            400,
+        ),
+    ],
+)
+def test_handler_columnar_invalid(payload, content_type, params, status_code):
+    res = handler(_columnar_event(payload, content_type, params), None)
+
+    assert res["statusCode"] == status_code
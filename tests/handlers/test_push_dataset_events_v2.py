@@ -4,13 +4,18 @@ Can be merged into `test_push_dataset_events` once version 2 becomes the
 default.
 """
 
+import base64
+import io
 import json
 import os
 from unittest.mock import patch
 
 import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
 from moto import mock_aws
 
+from uploader.formats import PARQUET
 from uploader.handlers.push_dataset_events import handler
 
 
@@ -73,7 +78,7 @@ def test_handler_single_valid_event(
 ):
     has_access.return_value = True
     get_and_validate_dataset.return_value = {"Id": "foo", "accessRights": "non-public"}
-    create_status_trace.return_value = {"trace_id": "abc-123"}
+    create_status_trace.return_value = "abc-123"
     _mock_sqs()
 
     res = handler(_mock_event({"datasetId": "foo", "events": [{"a": 1}]}), None)
@@ -91,3 +96,44 @@ def test_handler_event_too_large(get_and_validate_dataset, has_access):
         _mock_event({"datasetId": "foo", "events": [{"a": "x" * (256 * 2**10)}]}), None
     )
     assert res["statusCode"] == 400
+
+
+@mock_aws
+@patch("uploader.handlers.push_dataset_events.resource_authorizer.has_access")
+@patch("uploader.handlers.push_dataset_events.get_and_validate_dataset")
+@patch("uploader.handlers.push_dataset_events.create_status_trace")
+def test_handler_parquet(create_status_trace, get_and_validate_dataset, has_access):
+    has_access.return_value = True
+    get_and_validate_dataset.return_value = {"Id": "foo", "accessRights": "non-public"}
+    create_status_trace.return_value = "abc-123"
+    sqs = _mock_sqs()
+    sink = io.BytesIO()
+    pq.write_table(pa.table({"id": [1, 2]}), sink)
+
+    res = handler(
+        {
+            "body": base64.b64encode(sink.getvalue()).decode(),
+            "isBase64Encoded": True,
+            "headers": {"Authorization": "", "content-type": PARQUET},
+            "queryStringParameters": {
+                "datasetId": "foo",
+                "mergeOn": "id",
+                "apiVersion": "2",
+            },
+            "requestContext": {"authorizer": {"principalId": "test"}},
+        },
+        None,
+    )
+
+    assert res["statusCode"] == 200
+    queue = sqs.get_queue_by_name(QueueName=os.environ["EVENT_QUEUE_NAME"])
+    [message] = queue.receive_messages()
+    body = json.loads(message.body)
+    assert body == {
+        "datasetId": "foo",
+        "version": "1",
+        "mergeOn": ["id"],
+        "apiVersion": 2,
+        "contentType": PARQUET,
+        "data": base64.b64encode(sink.getvalue()).decode(),
+    }
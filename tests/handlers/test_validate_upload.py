@@ -0,0 +1,170 @@
+import json
+import os
+from unittest.mock import patch
+
+import boto3
+import pyarrow as pa
+import pytest
+from moto import mock_aws
+from okdata.aws.status import TraceEventStatus
+
+from uploader import validation
+
+with patch("uploader.common.get_secret") as get_secret:
+    get_secret.return_value = "top-secret"
+    from uploader.handlers import validate_upload
+    from uploader.handlers.validate_upload import upload_validation_handler
+
+KEY = "raw/red/test-dataset/version=1/edition=20240101T120000/upload.json"
+
+
+@pytest.fixture(autouse=True)
+def sdk_config():
+    with patch("uploader.handlers.validate_upload.sdk_config") as sdk_config:
+        yield sdk_config
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        validate_upload._s3_client.cache_clear()
+        validation._s3_client.cache_clear()
+        s3 = boto3.client("s3", region_name=os.environ["AWS_REGION"])
+        s3.create_bucket(
+            Bucket=os.environ["BUCKET"],
+            CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_REGION"]},
+        )
+        yield s3
+        validate_upload._s3_client.cache_clear()
+        validation._s3_client.cache_clear()
+
+
+def _upload(s3, events, key=KEY, metadata={"trace-id": "test-dataset-abc"}):
+    s3.put_object(
+        Bucket=os.environ["BUCKET"],
+        Key=key,
+        Body=json.dumps(events).encode(),
+        Metadata=metadata,
+    )
+    return {
+        "Records": [
+            {
+                "eventSource": "aws:s3",
+                "eventName": "ObjectCreated:Post",
+                "s3": {
+                    "bucket": {"name": os.environ["BUCKET"]},
+                    "object": {"key": key},
+                },
+            }
+        ]
+    }
+
+
+@pytest.fixture
+def dataset():
+    with (
+        patch(
+            "uploader.handlers.validate_upload.get_and_validate_dataset",
+            return_value={"Id": "test-dataset", "accessRights": "non-public"},
+        ),
+        patch(
+            "uploader.handlers.validate_upload.dataset_schema",
+            return_value={"id": pa.int64(), "name": pa.string()},
+        ) as dataset_schema,
+    ):
+        yield dataset_schema
+
+
+@patch("uploader.handlers.validate_upload.status_add")
+def test_upload_validation_handler(status_add, s3, dataset):
+    event = _upload(s3, [{"id": 1, "name": "foo", "new": True}])
+
+    res = upload_validation_handler(event, None)
+
+    assert res["statusCode"] == 200
+    dataset.assert_called_once_with(
+        "s3://testbucket/processed/red/test-dataset/version=1/latest"
+    )
+    status_add.assert_any_call(
+        trace_id="test-dataset-abc", domain="dataset", domain_id="test-dataset/1"
+    )
+    status_add.assert_called_with(
+        status_body={
+            "schema": {"id": "int64", "name": "string", "new": "bool"},
+            "mismatches": [],
+            "new_columns": ["new"],
+        }
+    )
+
+
+@patch("uploader.handlers.validate_upload.status_add")
+def test_upload_validation_handler_mismatch(status_add, s3, dataset):
+    event = _upload(s3, [{"id": "one", "name": "foo"}])
+
+    res = upload_validation_handler(event, None)
+
+    assert res["statusCode"] == 200
+    status = status_add.call_args.kwargs
+    assert status["trace_event_status"] == TraceEventStatus.FAILED
+    assert "id (string, int64)" in status["errors"][0]["message"]["en"]
+
+
+@patch("uploader.handlers.validate_upload.file_schema")
+@patch("uploader.handlers.validate_upload.status_add")
+def test_upload_validation_handler_no_table(status_add, file_schema, s3, dataset):
+    # E.g. a file dataset, whose files aren't merged into a Delta table.
+    dataset.return_value = None
+    event = _upload(s3, [{"id": 1}])
+
+    res = upload_validation_handler(event, None)
+
+    assert res["statusCode"] == 200
+    file_schema.assert_not_called()
+    assert not any("status_body" in c.kwargs for c in status_add.call_args_list)
+
+
+@patch("uploader.handlers.validate_upload.status_add")
+def test_upload_validation_handler_untraced(status_add, s3, dataset):
+    # E.g. the raw data of an event dataset edition.
+    event = _upload(s3, [{"id": 1}], metadata={})
+
+    res = upload_validation_handler(event, None)
+
+    assert res["statusCode"] == 200
+    status_add.assert_not_called()
+    dataset.assert_not_called()
+
+
+@pytest.mark.parametrize("filename", ["data.json", "deletes.json"])
+@patch("uploader.handlers.validate_upload._s3_client")
+@patch("uploader.handlers.validate_upload.status_add")
+def test_upload_validation_handler_raw_events(
+    status_add, _s3_client, dataset, filename
+):
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": os.environ["BUCKET"]},
+                    "object": {"key": KEY.replace("upload.json", filename)},
+                }
+            }
+        ]
+    }
+
+    res = upload_validation_handler(event, None)
+
+    assert res["statusCode"] == 200
+    _s3_client.assert_not_called()
+    status_add.assert_not_called()
+
+
+@patch("uploader.handlers.validate_upload.status_add")
+def test_upload_validation_handler_unreadable(status_add, s3, dataset):
+    event = _upload(s3, [{"id": 1}], key=KEY.replace(".json", ".parquet"))
+
+    res = upload_validation_handler(event, None)
+
+    assert res["statusCode"] == 400
+    status = status_add.call_args.kwargs
+    assert status["trace_event_status"] == TraceEventStatus.FAILED
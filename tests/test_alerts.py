@@ -1,9 +1,13 @@
+import json
 import os
 from unittest.mock import patch
 
 import pytest
+from freezegun import freeze_time
+from moto import mock_aws
 
-from uploader.alerts import _send_email, alert_if_new_columns
+from uploader import alerts
+from uploader.alerts import _send_email, alert_if_new_columns, send_alert_digest
 from uploader.errors import AlertEmailError
 
 
@@ -30,26 +34,57 @@ def test_send_email_error(get_secret, requests_mock):
     )
 
 
-@patch("uploader.alerts._send_email")
-def test_alert_if_new_columns_no_new_columns(send_email, dataset, dynamodb):
+@pytest.fixture(autouse=True)
+def clear_caches():
+    yield
+    alerts._subscriptions.clear()
+    alerts._subscriptions_table.cache_clear()
+    alerts._sqs_client.cache_clear()
+    alerts._queue_url.cache_clear()
+
+
+def _queued_alerts(queue):
+    return [json.loads(m.body) for m in queue.receive_messages(MaxNumberOfMessages=10)]
+
+
+@freeze_time("2024-05-01T12:00:00Z")
+def test_alert_if_new_columns(alert_queue, dataset):
+    alert_if_new_columns(dataset["Id"], {"b_col", "a_col"})
+
+    assert _queued_alerts(alert_queue) == [
+        {
+            "dataset_id": "test-dataset",
+            "new_columns": ["a_col", "b_col"],
+            "detected_at": "2024-05-01T12:00:00+00:00",
+        }
+    ]
+
+
+def test_alert_if_new_columns_no_new_columns(alert_queue, dataset):
     alert_if_new_columns(dataset["Id"], set())
 
-    send_email.assert_not_called()
+    assert _queued_alerts(alert_queue) == []
+
+
+@mock_aws
+def test_alert_if_new_columns_no_queue(dataset):
+    # Doesn't raise.
+    alert_if_new_columns(dataset["Id"], {"new_column"})
 
 
 @patch("uploader.alerts._send_email")
-def test_alert_if_new_columns_no_subscribers(send_email, dataset, dynamodb):
+def test_send_alert_digest_no_subscribers(send_email, dataset, dynamodb):
     table = dynamodb.Table("dataset-subscriptions")
     table.delete_item(Key={"DatasetId": dataset["Id"]})
 
-    alert_if_new_columns(dataset["Id"], {"new_column"})
+    assert not send_alert_digest(dataset["Id"], {"new_column"})
 
     send_email.assert_not_called()
 
 
 @patch("uploader.alerts._send_email")
-def test_alert_if_new_columns_single_new_column(send_email, dataset, dynamodb):
-    alert_if_new_columns(dataset["Id"], {"new_column"})
+def test_send_alert_digest_single_new_column(send_email, dataset, dynamodb):
+    assert send_alert_digest(dataset["Id"], {"new_column"})
 
     send_email.assert_called_once_with(
         ["test@example.org"],
@@ -58,10 +93,26 @@ def test_alert_if_new_columns_single_new_column(send_email, dataset, dynamodb):
 
 
 @patch("uploader.alerts._send_email")
-def test_alert_if_new_columns_multiple_new_columns(send_email, dataset, dynamodb):
-    alert_if_new_columns(dataset["Id"], {"b_col", "a_col"})
+def test_send_alert_digest_multiple_new_columns(send_email, dataset, dynamodb):
+    assert send_alert_digest(dataset["Id"], {"b_col", "a_col"})
 
     send_email.assert_called_once_with(
         ["test@example.org"],
         "Nye kolonner har blitt lagt til datasettet 'test-dataset':\n- a_col\n- b_col",
     )
+
+
+@patch("uploader.alerts._send_email")
+def test_send_alert_digest_cached_subscribers(send_email, dataset, dynamodb):
+    send_alert_digest(dataset["Id"], {"a_col"})
+    dynamodb.Table("dataset-subscriptions").put_item(
+        Item={"DatasetId": dataset["Id"], "Subscribers": ["new@example.org"]}
+    )
+    send_alert_digest(dataset["Id"], {"b_col"})
+
+    assert send_email.call_args.args[0] == ["test@example.org"]
+
+    with patch("uploader.alerts.SUBSCRIPTIONS_TTL", -1):
+        send_alert_digest(dataset["Id"], {"c_col"})
+
+    assert send_email.call_args.args[0] == ["new@example.org"]
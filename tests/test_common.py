@@ -1,4 +1,5 @@
 import json
+from unittest.mock import patch
 
 import pytest
 
@@ -10,6 +11,10 @@ from uploader.common import (
     edition_missing,
     create_edition,
     generate_s3_path,
+    generate_staging_path,
+    sdk_config,
+    split_s3_path,
+    split_staging_path,
 )
 from uploader.errors import (
     DataExistsError,
@@ -88,6 +93,47 @@ def test_generate_s3_path_absolute():
     )
 
 
+@pytest.mark.parametrize(
+    "s3_path,parts",
+    [
+        (
+            "raw/green/foo/version=1/edition=20200501/bar/baz.csv",
+            ("foo", "1", "20200501", "bar/baz.csv"),
+        ),
+        (
+            "raw/green/parent/foo/version=1/edition=20200501",
+            ("foo", "1", "20200501", None),
+        ),
+        ("processed/red/foo/version=2/latest", ("foo", "2", "latest", None)),
+    ],
+)
+def test_split_s3_path(s3_path, parts):
+    assert split_s3_path(s3_path) == parts
+
+
+@pytest.mark.parametrize(
+    "s3_path", ["raw/green/foo/version=1/bar.csv", "raw/green/foo/bar.csv"]
+)
+def test_split_s3_path_invalid(s3_path):
+    with pytest.raises(ValueError):
+        split_s3_path(s3_path)
+
+
+def test_staging_path():
+    path = generate_staging_path("foo", "1", "foo-abc", "bar/baz.csv")
+    assert path == "staging/foo/version=1/foo-abc/bar/baz.csv"
+    assert split_staging_path(path) == ("foo", "1", "foo-abc", "bar/baz.csv")
+
+
+@pytest.mark.parametrize(
+    "key",
+    ["staging/foo/version=1/foo-abc", "raw/foo/version=1/foo-abc/bar.csv"],
+)
+def test_split_staging_path_invalid(key):
+    with pytest.raises(ValueError):
+        split_staging_path(key)
+
+
 def test_generate_s3_path_parent_id_is_null(requests_mock):
     dataset = {"Id": "my-dataset", "accessRights": "public", "parent_id": None}
     editionId = "my-dataset/1/20200501"
@@ -235,3 +281,14 @@ def test_get_and_validate_dataset_not_found(requests_mock):
 
     with pytest.raises(DatasetNotFoundError):
         get_and_validate_dataset(dataset_id)
+
+
+@patch("uploader.common.get_secret")
+def test_sdk_config_rotated_secret(get_secret):
+    get_secret.side_effect = ["old-secret", "new-secret"]
+
+    config = sdk_config()
+    assert config.config["client_secret"] == "old-secret"
+
+    assert sdk_config() is config
+    assert config.config["client_secret"] == "new-secret"
@@ -1,15 +1,43 @@
+import datetime
+import json
 import os
+import shutil
 from unittest.mock import Mock, patch
 
 import boto3
+import deltalake as dl
 import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
+from deltalake.exceptions import CommitFailedError
 from moto import mock_aws
 
-from uploader.dataset import add_to_dataset, dataframe_from_dict, handle_events
-from uploader.errors import InvalidTypeError, MissingMergeColumnsError
+from conftest import read_deltalake, write_deltalake
+from uploader import alerts
+from uploader.dataset import (
+    _merge_events,
+    _write_in_memory,
+    add_to_dataset,
+    data_files,
+    deduplicate,
+    delete_from_dataset,
+    handle_events,
+    prepare_chunked_add,
+    upsert,
+    vacuum,
+    write_chunked_add,
+)
+from uploader.errors import (
+    ConcurrentWriteError,
+    InvalidTypeError,
+    MissingMergeColumnsError,
+    PartitionChangedError,
+)
+from uploader.formats import NDJSON, read_events
+from uploader.inference import dataframe_from_dict
+from uploader.partitioning import add_partition_columns, partition_names
 
 
 def _mock_s3():
@@ -20,13 +48,32 @@ def _mock_s3():
     )
 
 
+@pytest.fixture
+def delta_writes():
+    # deltalake doesn't go through boto3, so its writes can't reach moto.
+    with (
+        patch("uploader.dataset.open_table", return_value=None),
+        patch("uploader.dataset.table_partitions", return_value=None),
+        patch("uploader.dataset.dl.write_deltalake") as write_deltalake,
+        patch("uploader.dataset.vacuum") as vacuum,
+    ):
+        yield write_deltalake, vacuum
+
+
 @mock_aws
+@patch("uploader.dataset.sdk_config")
 @patch("uploader.dataset.add_to_dataset")
 @patch("uploader.dataset.Dataset")
-@patch("uploader.dataset.wr.s3.to_deltalake")
 @patch("uploader.dataset.alert_if_new_columns")
+@patch("uploader.dataset.data_files")
 def test_handle_events_alert_if_new_columns(
-    alert_if_new_columns, to_deltalake, Dataset, add_to_dataset, dataset
+    data_files,
+    alert_if_new_columns,
+    Dataset,
+    add_to_dataset,
+    sdk_config,
+    dataset,
+    delta_writes,
 ):
     _mock_s3()
 
@@ -53,14 +100,16 @@ def test_handle_events_alert_if_new_columns(
 
 
 @mock_aws
-@patch("uploader.alerts.get_secret")
+@patch("uploader.dataset.sdk_config")
 @patch("uploader.dataset.add_to_dataset")
 @patch("uploader.dataset.Dataset")
-@patch("uploader.dataset.wr.s3.to_deltalake")
-def test_handle_events_email_error(
-    to_deltalake, Dataset, add_to_dataset, get_secret, requests_mock, dynamodb, dataset
+@patch("uploader.dataset.data_files")
+def test_handle_events_alert_queue_error(
+    data_files, Dataset, add_to_dataset, sdk_config, dataset, delta_writes
 ):
     _mock_s3()
+    alerts._sqs_client.cache_clear()
+    alerts._queue_url.cache_clear()
 
     edition_id = f"{dataset['Id']}/1/new-edition"
 
@@ -75,12 +124,8 @@ def test_handle_events_email_error(
         [{"id": 1, "new_col": 2}]
     ), set("new_col")
 
-    get_secret.return_value = "mega-secret"
-
-    requests_mock.register_uri("POST", os.environ["EMAIL_API_URL"], status_code=500)
-
     # Most importantly test that the call doesn't raise an exception even if
-    # the HTTP call to the email API returned a 500 error response.
+    # the alert couldn't be queued (there is no alert queue).
     assert (
         handle_events(
             dataset,
@@ -93,61 +138,111 @@ def test_handle_events_email_error(
     )
 
 
-@pytest.mark.parametrize(
-    "data,schema",
-    [
-        # https://arrow.apache.org/docs/python/api/datatypes.html
-        ([{"a": 2, "b": "bar", "c": None}], {"a": pa.int64(), "b": pa.string()}),
-        (
-            [
-                {"a": 2, "b": "bar", "c": "baz"},
-                {"a": 2, "b": "bar", "c": None},
-            ],
-            {"a": pa.int64(), "b": pa.string(), "c": pa.string()},
-        ),
-        ([{"a": 0}, {"a": 5000000000000}], {"a": pa.int64()}),
-        ([{"a": 1}, {"a": 1.123}], {"a": pa.float64()}),
-        ([{"a": True}, {"a": False}, {"a": None}], {"a": pa.bool_()}),
-        # Incomplete dates should be strings.
-        ([{"a": "2024"}], {"a": pa.string()}),
-        ([{"a": "2024-10"}], {"a": pa.string()}),
-        (
-            [{"a": "2024-10-01"}, {"a": "1999-10-01"}],
-            {"a": pa.date64()},
-        ),
-        (
-            [{"a": "2024-10-01"}, {"a": "foo"}],
-            {"a": pa.string()},
-        ),
-        ([{"a": "2024-10-22T14:43:47"}], {"a": pa.timestamp("us", tz="UTC")}),
-        ([{"a": "2024-10-22T14:43:47Z"}], {"a": pa.timestamp("us", tz="UTC")}),
-        ([{"a": "2024-10-22T14:43:47+02:00"}], {"a": pa.timestamp("us", tz="UTC")}),
-        ([{"a": "2024-10-22T14:43:47.764186"}], {"a": pa.timestamp("us", tz="UTC")}),
-        ([{"a": "2025-01-16T08:21:07.61978Z"}], {"a": pa.timestamp("us", tz="UTC")}),
-        (
-            [{"a": "2024-10-22T14:44:41.038797+02:00"}],
-            {"a": pa.timestamp("us", tz="UTC")},
-        ),
-        # Mixed formats fallback to strings.
-        (
-            [
-                {"a": "2024-10-22T14:43:47.764186"},
-                {"a": "2024-10-22T14:44:41.038797+02:00"},
-            ],
-            {"a": pa.string()},
-        ),
-        (
-            [{"a": "2024-10-22T14:43:47.764186"}, {"a": "2024-10-22"}],
-            {"a": pa.string()},
-        ),
-    ],
-)
-def test_dataframe_from_dict(data, schema):
-    df = dataframe_from_dict(data)
+@mock_aws
+@patch("uploader.dataset.sdk_config")
+@patch("uploader.dataset.add_to_dataset")
+@patch("uploader.dataset.Dataset")
+@patch("uploader.dataset.alert_if_new_columns")
+@patch("uploader.dataset.data_files")
+def test_handle_events_distribution_filenames(
+    data_files,
+    alert_if_new_columns,
+    Dataset,
+    add_to_dataset,
+    sdk_config,
+    dataset,
+    delta_writes,
+):
+    _mock_s3()
+
+    sdk = Mock()
+    sdk.auto_create_edition.return_value = {"Id": f"{dataset['Id']}/1/new-edition"}
+    sdk.create_distribution.return_value = {
+        "Id": f"{dataset['Id']}/1/new-edition/bec60adb3f560543"
+    }
+    Dataset.return_value = sdk
+    add_to_dataset.return_value = pd.DataFrame.from_dict([{"id": 1}]), set()
+    data_files.return_value = ["part-00001-foo.parquet"]
+
+    handle_events(
+        dataset,
+        "1",
+        [],
+        f"s3://{os.environ['BUCKET']}/{dataset['Id']}/1/old-edition",
+        {"id": 1},
+    )
+
+    data_files.assert_called_once_with(
+        "s3://testbucket/processed/green/test-dataset/version=1/edition=new-edition"
+    )
+    assert sdk.create_distribution.call_args.kwargs["data"]["filenames"] == [
+        "part-00001-foo.parquet"
+    ]
+
 
-    for col in df.columns:
-        dtype = df[col].dtype
-        assert dtype == pd.ArrowDtype(schema[col])
+@mock_aws
+@patch("uploader.dataset.sdk_config")
+@patch("uploader.dataset.add_to_dataset")
+@patch("uploader.dataset.Dataset")
+@patch("uploader.dataset.alert_if_new_columns")
+@patch("uploader.dataset.data_files")
+def test_handle_events_table(
+    data_files,
+    alert_if_new_columns,
+    Dataset,
+    add_to_dataset,
+    sdk_config,
+    dataset,
+    delta_writes,
+):
+    _mock_s3()
+    sdk = Mock()
+    sdk.auto_create_edition.return_value = {"Id": f"{dataset['Id']}/1/new-edition"}
+    sdk.create_distribution.return_value = {"Id": "distribution"}
+    Dataset.return_value = sdk
+    add_to_dataset.return_value = pd.DataFrame.from_dict([{"id": 1}]), set()
+    events = pa.table({"id": [1]})
+
+    handle_events(dataset, "1", [], "s3://testbucket/latest", events)
+
+    assert add_to_dataset.call_args.args[1] is events
+    s3 = boto3.client("s3", region_name=os.environ["AWS_REGION"])
+    raw = s3.get_object(
+        Bucket=os.environ["BUCKET"],
+        Key="raw/green/test-dataset/version=1/edition=new-edition/data.arrows",
+    )
+    assert pa.ipc.open_stream(raw["Body"].read()).read_all().equals(events)
+
+
+def test_data_files(temp_dir):
+    write_deltalake(temp_dir, [{"id": 1}])
+    write_deltalake(temp_dir, [{"id": 2}], mode="overwrite")
+    write_deltalake(temp_dir, [{"id": 3}], mode="append")
+
+    files = data_files(temp_dir)
+
+    # Only the files of the current version; not the log, nor the file
+    # that was overwritten.
+    assert len(files) == 2
+    assert set(files) < set(os.listdir(temp_dir))
+    assert all(f.endswith(".parquet") for f in files)
+
+
+def test_data_files_partitioned(temp_dir):
+    write_deltalake(
+        temp_dir,
+        [{"id": 1, "district": "Gamle Oslo"}, {"id": 2, "district": "Grünerløkka"}],
+        partition_by=["district"],
+    )
+
+    files = data_files(temp_dir)
+
+    # Partition directories are escaped once, the paths in the log twice.
+    assert sorted(f.split("/")[0] for f in files) == [
+        "district=Gamle%20Oslo",
+        "district=Gr%C3%BCnerl%C3%B8kka",
+    ]
+    assert all(os.path.exists(os.path.join(temp_dir, f)) for f in files)
 
 
 @pytest.mark.parametrize(
@@ -231,6 +326,195 @@ def test_merge_on_single_column(
     )
 
 
+@pytest.mark.parametrize(
+    "strategy,expected",
+    [
+        ("first", [{"id": 1, "a": 1, "b": "x"}, {"id": 2, "a": 3, "b": None}]),
+        ("last", [{"id": 2, "a": 3, "b": None}, {"id": 1, "a": None, "b": "y"}]),
+        ("coalesce", [{"id": 1, "a": 1, "b": "y"}, {"id": 2, "a": 3, "b": None}]),
+    ],
+)
+def test_deduplicate(strategy, expected):
+    events = dataframe_from_dict(
+        [
+            {"id": 1, "a": 1, "b": "x"},
+            {"id": 2, "a": 3},
+            {"id": 1, "b": "y"},
+        ]
+    )
+
+    deduplicated = deduplicate(events, ["id"], strategy)
+
+    assert (
+        deduplicated.astype(object).where(deduplicated.notna(), None).to_dict("records")
+        == expected
+    )
+
+
+def test_deduplicate_multiple_columns():
+    events = dataframe_from_dict(
+        [
+            {"k1": 1, "k2": "x", "a": 1},
+            {"k1": 1, "k2": "y", "a": 2},
+            {"k1": 1, "k2": "x", "a": 3},
+        ]
+    )
+
+    assert deduplicate(events, ["k1", "k2"])["a"].tolist() == [2, 3]
+
+
+def test_deduplicate_missing_merge_column():
+    with pytest.raises(MissingMergeColumnsError):
+        deduplicate(dataframe_from_dict([{"a": 1}]), ["id"])
+
+
+def test_merge_duplicate_events(temp_dir):
+    existing_data = [{"id": 1, "a": 1}, {"id": 2, "a": 2}]
+    new_data = [{"id": 1, "a": 5}, {"id": 1, "a": 6}]
+
+    with patch(
+        "uploader.dataset.wr.s3.read_deltalake",
+        return_value=dataframe_from_dict(existing_data),
+    ):
+        merged_df, _ = add_to_dataset("s3://foo/bar", new_data, ["id"])
+
+    assert merged_df.to_dict("records") == [{"id": 1, "a": 6}, {"id": 2, "a": 2}]
+
+
+def _combine_first(existing, events, merge_on):
+    # The merge `upsert` replaces.
+    return (
+        events.set_index(merge_on)
+        .combine_first(existing.set_index(merge_on))
+        .reset_index()
+    )
+
+
+def _sorted(df, merge_on):
+    return df.sort_values(merge_on, kind="stable").reset_index(drop=True)
+
+
+def _random_events(rng, n, unique):
+    events = [
+        {
+            "k1": int(rng.integers(0, 20)),
+            "k2": str(rng.choice(["a", "b", None])),
+            "x": int(rng.integers(0, 100)),
+            "y": None if rng.random() < 0.3 else float(rng.random()),
+            "z": str(rng.choice(["foo", "bar", None])),
+        }
+        for _ in range(n)
+    ]
+    if unique:
+        events = list({(e["k1"], e["k2"]): e for e in events}.values())
+    return events
+
+
+@pytest.mark.parametrize(
+    "existing_data,new_data,merge_on",
+    [
+        (
+            [{"id": 1, "a": 1, "b": "x"}, {"id": 2, "a": 2, "b": "y"}],
+            [{"id": 2, "a": 5}, {"id": 3, "b": "z"}],
+            ["id"],
+        ),
+        # New columns on both sides, and integers promoted to floats.
+        (
+            [{"id": 1, "a": 1, "c": "x"}, {"id": 2, "a": 2}],
+            [{"id": 1, "a": 1.5, "b": True}, {"id": 3, "b": False}],
+            ["id"],
+        ),
+        # Duplicate keys in the existing rows.
+        (
+            [{"id": 1, "a": 1}, {"id": 1, "a": 2}, {"id": 2, "a": 3}],
+            [{"id": 1, "a": 5}],
+            ["id"],
+        ),
+        (
+            [{"k1": 1, "k2": "a", "v": 1}, {"k1": 1, "k2": "b", "v": 2}],
+            [{"k1": 1, "k2": "b", "v": 3}, {"k1": 2, "k2": "a", "v": 4}],
+            ["k1", "k2"],
+        ),
+        (
+            [{"id": "b", "t": "2020-01-01T00:00:00Z"}, {"id": "a"}],
+            [{"id": "a", "t": "2021-01-01T00:00:00Z"}, {"id": "c"}],
+            ["id"],
+        ),
+        (
+            _random_events(np.random.default_rng(0), 200, unique=False),
+            _random_events(np.random.default_rng(1), 50, unique=True),
+            ["k1", "k2"],
+        ),
+    ],
+)
+def test_upsert_matches_combine_first(existing_data, new_data, merge_on):
+    existing = dataframe_from_dict(existing_data)
+    events = dataframe_from_dict(new_data)
+
+    merged, _inserted, _updated = upsert(existing, events, merge_on)
+
+    pd.testing.assert_frame_equal(
+        _sorted(merged, merge_on),
+        _sorted(_combine_first(existing, events, merge_on), merge_on),
+    )
+
+
+def test_upsert_order():
+    existing = dataframe_from_dict([{"id": 3, "a": 1}, {"id": 1, "a": 2}])
+    events = dataframe_from_dict([{"id": 4, "a": 3}, {"id": 1, "a": 4}])
+
+    merged, _inserted, _updated = upsert(existing, events, ["id"])
+
+    # Existing rows stay in place, with new rows after them.
+    assert merged.to_dict("records") == [
+        {"id": 3, "a": 1},
+        {"id": 1, "a": 4},
+        {"id": 4, "a": 3},
+    ]
+
+
+@pytest.mark.parametrize(
+    "new_data,inserted,updated",
+    [
+        ([{"id": 1, "a": 1}, {"id": 2, "a": 5}, {"id": 3, "a": 3}], 1, 1),
+        ([{"id": 1, "a": 1}, {"id": 2}], 0, 0),
+        # All rows change along with the dtype of `a`.
+        ([{"id": 1, "a": 1.5}], 0, 2),
+    ],
+)
+def test_upsert_counts(new_data, inserted, updated):
+    existing = dataframe_from_dict([{"id": 1, "a": 1}, {"id": 2, "a": 2}])
+    events = dataframe_from_dict(new_data)
+
+    _merged, *counts = upsert(existing, events, ["id"])
+
+    assert counts == [inserted, updated]
+
+
+def test_upsert_hash_collision():
+    existing = dataframe_from_dict([{"id": 1, "a": 1}, {"id": 2, "a": 2}])
+    events = dataframe_from_dict([{"id": 2, "a": 5}, {"id": 3, "a": 3}])
+
+    hash_pandas_object = pd.util.hash_pandas_object
+
+    def colliding_keys(df, index):
+        if list(df.columns) == ["id"]:
+            return pd.Series(np.zeros(len(df), dtype="uint64"))
+        return hash_pandas_object(df, index=index)
+
+    with patch(
+        "uploader.dataset.pd.util.hash_pandas_object", side_effect=colliding_keys
+    ):
+        merged, inserted, updated = upsert(existing, events, ["id"])
+
+    assert merged.to_dict("records") == [
+        {"id": 1, "a": 1},
+        {"id": 2, "a": 5},
+        {"id": 3, "a": 3},
+    ]
+    assert (inserted, updated) == (1, 1)
+
+
 @pytest.mark.parametrize(
     "existing_data,new_data",
     [
@@ -366,3 +650,784 @@ def test_add_to_dataset_with_merge_no_new_columns(
 ):
     _, new_columns = add_to_dataset("s3://foo/bar", new_data, ["id"])
     assert new_columns == set()
+
+
+def _add_chunked(path, existing_data, new_data, merge_on):
+    write_deltalake(f"{path}/latest", existing_data)
+    prepared = prepare_chunked_add(f"{path}/latest", new_data, merge_on)
+    rows = write_chunked_add(prepared, f"{path}/edition")
+    return read_deltalake(f"{path}/edition"), prepared["new_columns"], rows
+
+
+@pytest.mark.parametrize(
+    "existing_data,new_data,merge_on",
+    [
+        ([{"id": 1, "a": 1}], [{"id": 2, "a": 2}], []),
+        ([{"id": 1, "a": 1}], [{"id": 2, "b": "foo"}], []),
+        ([{"id": 1, "a": 1}, {"id": 2, "a": 2}], [{"id": 2, "a": 5}], ["id"]),
+        ([{"id": 1, "a": 1}], [{"id": 1, "b": "foo"}, {"id": 3, "a": 3}], ["id"]),
+        ([{"id": 1, "a": 1}], [{"id": 1}, {"id": 2, "a": 2}], ["id"]),
+        ([{"id": 1, "a": 1}, {"id": 1, "a": 2}], [{"id": 1, "a": 5}], ["id"]),
+        ([{"id": 1, "a": 1}], [{"id": 2, "a": 2}, {"id": 2, "a": 3}], ["id"]),
+        (
+            [{"k1": 1, "k2": "x", "a": 1}, {"k1": 1, "k2": "y", "a": 2}],
+            [{"k1": 1, "k2": "y", "a": 3}, {"k1": 2, "k2": "x", "a": 4}],
+            ["k1", "k2"],
+        ),
+    ],
+)
+def test_chunked_add_matches_add_to_dataset(
+    temp_dir, existing_data, new_data, merge_on
+):
+    chunked, new_columns, rows = _add_chunked(
+        temp_dir, existing_data, new_data, merge_on
+    )
+
+    with patch(
+        "uploader.dataset.wr.s3.read_deltalake",
+        side_effect=lambda *args, **kwargs: read_deltalake(f"{temp_dir}/latest"),
+    ):
+        in_memory, in_memory_new_columns = add_to_dataset(
+            f"{temp_dir}/latest", new_data, merge_on
+        )
+
+    # Row order isn't preserved when streaming.
+    columns = sorted(in_memory.columns)
+    assert new_columns == in_memory_new_columns
+    assert rows == len(in_memory)
+    pd.testing.assert_frame_equal(
+        chunked[columns].sort_values(columns).reset_index(drop=True),
+        in_memory[columns].sort_values(columns).reset_index(drop=True),
+        check_dtype=False,
+    )
+
+
+@pytest.mark.parametrize(
+    "existing_data,new_data,merge_on,error",
+    [
+        ([{"id": 1}], [{"data": 2}], ["id"], MissingMergeColumnsError),
+        ([{"data": 1}], [{"id": 1}], ["id"], MissingMergeColumnsError),
+        ([{"id": 1, "a": 1}], [{"id": 2, "a": "foo"}], [], InvalidTypeError),
+        ([{"id": 1}], [{"id": 2, "a": 1}, {"id": 3, "a": "x"}], [], InvalidTypeError),
+    ],
+)
+def test_prepare_chunked_add_invalid(
+    temp_dir, existing_data, new_data, merge_on, error
+):
+    with pytest.raises(error):
+        _add_chunked(temp_dir, existing_data, new_data, merge_on)
+
+
+PARTITION_BY = [{"name": "date", "column": "time", "transform": "day"}]
+
+
+def _events(*rows):
+    return [
+        {"id": id, "time": f"2024-05-0{day}T12:00:00", "value": value}
+        for id, day, value in rows
+    ]
+
+
+@pytest.fixture
+def partitioned(temp_dir):
+    latest = f"{temp_dir}/latest"
+    df = add_partition_columns(
+        dataframe_from_dict(_events((1, 1, 1), (2, 2, 2), (3, 3, 3))),
+        PARTITION_BY,
+    )
+    dl.write_deltalake(
+        latest, pa.Table.from_pandas(df, preserve_index=False), partition_by=["date"]
+    )
+    return latest
+
+
+def test_add_to_dataset_scoped(partitioned):
+    merged_data, new_columns = add_to_dataset(
+        partitioned,
+        _events((2, 2, 20), (4, 2, 4), (5, 4, 5)),
+        ["id"],
+        PARTITION_BY,
+        scoped=True,
+    )
+
+    # Only the partitions among the events were read.
+    assert sorted(merged_data["id"].tolist()) == [2, 4, 5]
+    assert sorted(merged_data["date"].tolist()) == [
+        "2024-05-02",
+        "2024-05-02",
+        "2024-05-04",
+    ]
+    assert new_columns == set()
+
+
+def test_write_scoped(partitioned, temp_dir):
+    untouched = {
+        f
+        for f in data_files(partitioned)
+        if not f.startswith(("date=2024-05-02", "date=2024-05-04"))
+    }
+    merged_data, _new_columns = add_to_dataset(
+        partitioned,
+        _events((2, 2, 20), (4, 2, 4), (5, 4, 5)),
+        ["id"],
+        PARTITION_BY,
+        scoped=True,
+    )
+
+    _write_in_memory(
+        merged_data,
+        partitioned,
+        f"{temp_dir}/edition",
+        PARTITION_BY,
+        scoped=True,
+        latest=dl.DeltaTable(partitioned),
+    )
+
+    expected = [(1, 1), (2, 20), (3, 3), (4, 4), (5, 5)]
+    for path in [partitioned, f"{temp_dir}/edition"]:
+        df = read_deltalake(path).sort_values("id")
+        assert list(zip(df["id"], df["value"])) == expected
+        assert dl.DeltaTable(path).metadata().partition_columns == ["date"]
+
+    # The other partitions were left alone.
+    assert untouched < set(data_files(partitioned))
+
+
+def test_add_to_dataset_scoped_moved(partitioned):
+    # Row 1 moves from the first to the second partition.
+    with pytest.raises(PartitionChangedError):
+        add_to_dataset(
+            partitioned,
+            _events((1, 2, 10), (2, 2, 20)),
+            ["id"],
+            PARTITION_BY,
+            scoped=True,
+        )
+
+
+@mock_aws
+@patch("uploader.dataset.sdk_config")
+@patch("uploader.dataset.Dataset")
+@patch("uploader.dataset.status_add")
+@patch("uploader.dataset.alert_if_new_columns")
+@patch("uploader.dataset.data_files")
+@patch("uploader.dataset.generate_s3_path")
+def test_handle_events_scoped_twice(
+    generate_s3_path,
+    data_files,
+    alert_if_new_columns,
+    status_add,
+    Dataset,
+    sdk_config,
+    partitioned,
+    temp_dir,
+):
+    _mock_s3()
+    sdk = Mock()
+    sdk.auto_create_edition.return_value = {"Id": "test-dataset/1/new-edition"}
+    sdk.get_latest_edition.return_value = {"Id": "test-dataset/1/new-edition"}
+    sdk.create_distribution.return_value = {"Id": "distribution"}
+    Dataset.return_value = sdk
+    generate_s3_path.side_effect = lambda dataset, edition_id, stage, **kwargs: (
+        f"{temp_dir}/edition" if stage == "processed" else "raw/edition"
+    )
+    dataset = {
+        "Id": "test-dataset",
+        "accessRights": "public",
+        "source": {"partitionBy": PARTITION_BY},
+    }
+    events = _events((2, 2, 20))
+
+    for _ in range(2):
+        assert (
+            handle_events(dataset, "1", ["id"], partitioned, events)
+            == "test-dataset/1/new-edition"
+        )
+
+    # The second push changed nothing.
+    sdk.auto_create_edition.assert_called_once()
+    status_add.assert_called_with(
+        status_body={"unchanged": True, "editionId": "test-dataset/1/new-edition"}
+    )
+    df = read_deltalake(partitioned).sort_values("id")
+    assert list(zip(df["id"], df["value"])) == [(1, 1), (2, 20), (3, 3)]
+
+
+@patch("uploader.dataset.log_add")
+def test_write_scoped_moved(log_add, partitioned, temp_dir):
+    with patch(
+        "uploader.dataset.wr.s3.read_deltalake",
+        side_effect=lambda *args, **kwargs: read_deltalake(partitioned),
+    ):
+        merged_data, _new_columns, scoped = _merge_events(
+            partitioned,
+            _events((1, 2, 10), (2, 2, 20)),
+            ["id"],
+            PARTITION_BY,
+            scoped=True,
+            dedup="last",
+            chunked=False,
+            table_version=None,
+        )
+
+    # The whole dataset is rewritten instead.
+    assert not scoped
+    log_add.assert_any_call(partition_scoped=False)
+
+    _write_in_memory(
+        merged_data,
+        partitioned,
+        f"{temp_dir}/edition",
+        PARTITION_BY,
+        scoped=scoped,
+        latest=dl.DeltaTable(partitioned),
+    )
+
+    df = read_deltalake(partitioned).sort_values("id")
+    assert list(zip(df["id"], df["value"], df["date"])) == [
+        (1, 10, "2024-05-02"),
+        (2, 20, "2024-05-02"),
+        (3, 3, "2024-05-03"),
+    ]
+
+
+DAY_RATIO = [{"name": c, "column": c, "transform": None} for c in ("day", "ratio")]
+DAY_RATIO_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("day", pa.date32()),
+        ("ratio", pa.float64()),
+        ("value", pa.int64()),
+    ]
+)
+
+
+@pytest.fixture
+def day_ratio(temp_dir):
+    latest = f"{temp_dir}/latest"
+    dl.write_deltalake(
+        latest,
+        pa.Table.from_pylist(
+            [
+                {"id": 1, "day": datetime.date(2024, 5, 1), "ratio": 0.5, "value": 1},
+                {"id": 2, "day": datetime.date(2024, 5, 2), "ratio": 1.5, "value": 2},
+            ],
+            DAY_RATIO_SCHEMA,
+        ),
+        partition_by=partition_names(DAY_RATIO),
+    )
+    return latest
+
+
+def test_write_scoped_date_float(day_ratio, temp_dir):
+    untouched = {f for f in data_files(day_ratio) if f.startswith("day=2024-05-01")}
+    update = pa.Table.from_pylist(
+        [{"id": 2, "day": datetime.date(2024, 5, 2), "ratio": 1.5, "value": 20}],
+        DAY_RATIO_SCHEMA,
+    )
+
+    merged_data, _new_columns = add_to_dataset(
+        day_ratio, update, ["id"], DAY_RATIO, scoped=True
+    )
+    _write_in_memory(
+        merged_data,
+        day_ratio,
+        f"{temp_dir}/edition",
+        DAY_RATIO,
+        scoped=True,
+        latest=dl.DeltaTable(day_ratio),
+    )
+
+    df = read_deltalake(day_ratio).sort_values("id")
+    assert list(zip(df["id"], df["value"])) == [(1, 1), (2, 20)]
+    assert untouched < set(data_files(day_ratio))
+
+
+@patch("uploader.dataset.log_add")
+def test_merge_events_unsupported_partition(log_add, day_ratio):
+    with patch(
+        "uploader.dataset.wr.s3.read_deltalake",
+        side_effect=lambda *args, **kwargs: read_deltalake(day_ratio),
+    ):
+        # The dates of the events are inferred as timestamps, which can't be
+        # put in a predicate.
+        merged_data, _new_columns, scoped = _merge_events(
+            day_ratio,
+            [{"id": 2, "day": "2024-05-02", "ratio": 1.5, "value": 20}],
+            ["id"],
+            DAY_RATIO,
+            scoped=True,
+            dedup="last",
+            chunked=False,
+            table_version=None,
+        )
+
+    assert not scoped
+    log_add.assert_any_call(partition_scoped=False)
+    assert sorted(merged_data["id"].tolist()) == [1, 2]
+
+
+def test_add_to_dataset_repartition(temp_dir):
+    latest = f"{temp_dir}/latest"
+    write_deltalake(latest, _events((1, 1, 1), (2, 2, 2)))
+
+    with patch(
+        "uploader.dataset.wr.s3.read_deltalake",
+        side_effect=lambda *args, **kwargs: read_deltalake(latest),
+    ):
+        merged_data, new_columns = add_to_dataset(
+            latest, _events((3, 3, 3)), [], PARTITION_BY
+        )
+
+    # Existing rows are partitioned too.
+    assert merged_data["date"].tolist() == ["2024-05-01", "2024-05-02", "2024-05-03"]
+    assert new_columns == {"date"}
+
+
+def test_chunked_add_partitioned(temp_dir):
+    latest = f"{temp_dir}/latest"
+    write_deltalake(latest, _events((1, 1, 1), (2, 2, 2)))
+
+    prepared = prepare_chunked_add(latest, _events((2, 2, 20)), ["id"], PARTITION_BY)
+    write_chunked_add(prepared, f"{temp_dir}/edition")
+
+    edition = dl.DeltaTable(f"{temp_dir}/edition")
+    df = read_deltalake(f"{temp_dir}/edition").sort_values("id")
+    assert edition.metadata().partition_columns == ["date"]
+    assert list(zip(df["id"], df["value"], df["date"])) == [
+        (1, 1, "2024-05-01"),
+        (2, 20, "2024-05-02"),
+    ]
+
+
+def test_add_to_dataset_ndjson(temp_dir):
+    events = [
+        {"id": 1, "time": "2024-01-01T12:00:00Z", "date": "2024-01-01", "n": 1.5},
+        {"id": 2, "time": "2024-01-02T12:00:00Z", "date": "2024-01-02", "n": 2.5},
+    ]
+    write_deltalake(temp_dir, events[:1])
+    body = "\n".join(json.dumps(e) for e in events[1:]).encode()
+
+    with patch(
+        "uploader.dataset.wr.s3.read_deltalake",
+        side_effect=lambda path, **kwargs: read_deltalake(path),
+    ):
+        from_json, _ = add_to_dataset(temp_dir, events[1:], ["id"])
+        from_ndjson, _ = add_to_dataset(temp_dir, read_events(body, NDJSON), ["id"])
+
+    assert from_ndjson.dtypes.to_dict() == from_json.dtypes.to_dict()
+    assert from_ndjson["time"].dtype == pd.ArrowDtype(pa.timestamp("us", tz="UTC"))
+
+
+@patch("uploader.encoding.DICTIONARY_MIN_ROWS", 10)
+def test_add_to_dataset_compact(temp_dir):
+    latest = f"{temp_dir}/latest"
+    write_deltalake(
+        latest,
+        [{"id": i, "status": ["OK", "FAILED"][i % 2], "value": i} for i in range(100)],
+    )
+    schema = dl.DeltaTable(latest).schema().to_arrow()
+
+    with patch(
+        "uploader.dataset.wr.s3.read_deltalake",
+        side_effect=lambda path, **kwargs: read_deltalake(path),
+    ):
+        merged_data, _new_columns = add_to_dataset(
+            latest, [{"id": 1, "status": "PENDING"}, {"id": 100, "value": 5}], ["id"]
+        )
+
+    # The status column was merged as a dictionary, and the narrowed value
+    # column widened again.
+    assert merged_data["status"].dtype == pd.ArrowDtype(
+        pa.dictionary(pa.int32(), pa.string())
+    )
+    assert merged_data["value"].dtype == "int64[pyarrow]"
+    assert merged_data.iloc[1].tolist() == [1, "PENDING", 1]
+    assert merged_data.iloc[-1].tolist() == [100, pd.NA, 5]
+
+    _write_in_memory(
+        merged_data,
+        latest,
+        f"{temp_dir}/edition",
+        latest=dl.DeltaTable(latest),
+        merge_on=["id"],
+    )
+
+    # Neither changes the schema of the table.
+    assert dl.DeltaTable(latest).schema().to_arrow() == schema
+    assert dl.DeltaTable(f"{temp_dir}/edition").schema().to_arrow() == schema
+    [filename] = data_files(f"{temp_dir}/edition")
+    metadata = pq.read_metadata(f"{temp_dir}/edition/{filename}").row_group(0)
+    assert "DELTA_BINARY_PACKED" in metadata.column(0).encodings
+    assert "RLE_DICTIONARY" in metadata.column(1).encodings
+
+
+def test_write_in_memory_overwrites_latest(temp_dir):
+    latest = f"{temp_dir}/latest"
+    write_deltalake(latest, [{"id": 1, "a": 1}])
+    old_files = data_files(latest)
+
+    _write_in_memory(
+        dataframe_from_dict([{"id": 1, "a": "x", "b": 2}]),
+        latest,
+        f"{temp_dir}/edition",
+        latest=dl.DeltaTable(latest),
+    )
+
+    # `latest` was replaced in a single commit, schema and all, leaving the
+    # previous version readable until vacuumed.
+    table = dl.DeltaTable(latest)
+    assert table.version() == 1
+    assert read_deltalake(latest).to_dict("records") == [{"id": 1, "a": "x", "b": 2}]
+    assert dl.DeltaTable(latest, version=0).to_pyarrow_table().num_rows == 1
+    assert all(os.path.exists(f"{latest}/{f}") for f in old_files)
+
+
+def test_write_in_memory_repartition(temp_dir):
+    latest = f"{temp_dir}/latest"
+    write_deltalake(latest, _events((1, 1, 1)))
+    merged_data = add_partition_columns(
+        dataframe_from_dict(_events((1, 1, 1), (2, 2, 2))), PARTITION_BY
+    )
+
+    with patch(
+        "uploader.dataset.wr.s3.delete_objects", side_effect=shutil.rmtree
+    ) as delete_objects:
+        _write_in_memory(
+            merged_data,
+            latest,
+            f"{temp_dir}/edition",
+            PARTITION_BY,
+            latest=dl.DeltaTable(latest),
+        )
+
+    # Delta can't repartition in an overwrite, so `latest` was cleared first.
+    delete_objects.assert_called_once_with(latest)
+    assert dl.DeltaTable(latest).metadata().partition_columns == ["date"]
+    assert sorted(read_deltalake(latest)["id"].tolist()) == [1, 2]
+
+
+def test_add_to_dataset_snapshot(temp_dir):
+    write_deltalake(temp_dir, [{"id": 1, "a": 1}, {"id": 2, "a": 2}])
+
+    with patch(
+        "uploader.dataset.snapshot", return_value=dl.DeltaTable(temp_dir)
+    ) as snapshot:
+        merged_data, _new_columns = add_to_dataset(
+            "s3://foo/bar", [{"id": 2, "a": 5}], ["id"], table_version=0
+        )
+
+    snapshot.assert_called_once_with("s3://foo/bar", 0)
+    assert merged_data.to_dict("records") == [{"id": 1, "a": 1}, {"id": 2, "a": 5}]
+
+
+def test_write_in_memory_conflict(temp_dir):
+    latest = f"{temp_dir}/latest"
+    write_deltalake(latest, [{"id": 1, "a": 1}])
+    # Another write commits after `latest` was read at version 0.
+    write_deltalake(latest, [{"id": 2, "a": 2}], mode="append")
+
+    with pytest.raises(CommitFailedError):
+        _write_in_memory(
+            dataframe_from_dict([{"id": 1, "a": 5}]),
+            latest,
+            f"{temp_dir}/edition",
+            latest=dl.DeltaTable(latest, version=0),
+        )
+
+    assert sorted(read_deltalake(latest)["id"].tolist()) == [1, 2]
+
+
+def test_write_scoped_concurrent(partitioned, temp_dir):
+    table_version = dl.DeltaTable(partitioned).version()
+    merged_data, _new_columns = add_to_dataset(
+        partitioned,
+        _events((2, 2, 20)),
+        ["id"],
+        PARTITION_BY,
+        scoped=True,
+        table_version=table_version,
+    )
+    # Another write to a different partition commits in the meantime.
+    dl.write_deltalake(
+        partitioned,
+        pa.Table.from_pandas(
+            add_partition_columns(
+                dataframe_from_dict(_events((3, 3, 30))), PARTITION_BY
+            ),
+            preserve_index=False,
+        ),
+        mode="overwrite",
+        predicate="date = '2024-05-03'",
+    )
+
+    _write_in_memory(
+        merged_data,
+        partitioned,
+        f"{temp_dir}/edition",
+        PARTITION_BY,
+        scoped=True,
+        latest=dl.DeltaTable(partitioned, version=table_version),
+    )
+
+    # The edition has the other write too.
+    for path in [partitioned, f"{temp_dir}/edition"]:
+        df = read_deltalake(path).sort_values("id")
+        assert list(zip(df["id"], df["value"])) == [(1, 1), (2, 20), (3, 30)]
+
+
+@patch("uploader.dataset.VACUUM_RETENTION_HOURS", 0)
+@patch("uploader.dataset.VACUUM_INTERVAL", 2)
+def test_vacuum(temp_dir):
+    write_deltalake(temp_dir, [{"id": 1}])
+    old_files = data_files(temp_dir)
+    write_deltalake(temp_dir, [{"id": 2}], mode="overwrite")
+
+    vacuum(temp_dir)
+
+    # Not on this version.
+    assert all(os.path.exists(f"{temp_dir}/{f}") for f in old_files)
+
+    write_deltalake(temp_dir, [{"id": 3}], mode="overwrite")
+
+    vacuum(temp_dir)
+
+    assert not any(os.path.exists(f"{temp_dir}/{f}") for f in old_files)
+    assert read_deltalake(temp_dir)["id"].tolist() == [3]
+
+
+@patch("uploader.dataset.log_exception")
+def test_vacuum_error(log_exception, temp_dir):
+    vacuum(f"{temp_dir}/missing")
+
+    log_exception.assert_called_once()
+
+
+def test_delete_from_dataset(temp_dir):
+    write_deltalake(temp_dir, [{"id": 1, "a": 1}, {"id": 2, "a": 2}])
+    write_deltalake(temp_dir, [{"id": 3, "a": 3}, {"id": 3, "a": 4}], mode="append")
+    files = set(data_files(temp_dir))
+
+    deleted_keys, deleted_rows = delete_from_dataset(
+        temp_dir, [{"id": 3}, {"id": 5}], ["id"]
+    )
+
+    assert deleted_keys == [{"id": 3}]
+    assert deleted_rows == 2
+    assert read_deltalake(temp_dir)["id"].tolist() == [1, 2]
+    # Only the file holding the deleted rows was rewritten.
+    assert set(data_files(temp_dir)) < files
+
+
+def test_delete_from_dataset_no_match(temp_dir):
+    write_deltalake(temp_dir, [{"id": 1, "a": 1}])
+    version = dl.DeltaTable(temp_dir).version()
+
+    assert delete_from_dataset(temp_dir, [{"id": 2}], ["id"]) == ([], 0)
+    assert dl.DeltaTable(temp_dir).version() == version
+
+
+@pytest.mark.parametrize(
+    "deletes,merge_on,error",
+    [
+        ([{"id": 1}], ["missing"], MissingMergeColumnsError),
+        ([{"id": "1"}], ["id"], InvalidTypeError),
+    ],
+)
+def test_delete_from_dataset_invalid(temp_dir, deletes, merge_on, error):
+    write_deltalake(temp_dir, [{"id": 1, "a": 1}])
+
+    with pytest.raises(error):
+        delete_from_dataset(temp_dir, deletes, merge_on)
+
+
+@pytest.mark.parametrize(
+    "deletes,merge_on",
+    [
+        ([{"id": 1}], []),
+        ([{"id": 1}, {"other": 2}], ["id"]),
+    ],
+)
+def test_handle_events_invalid_deletes(dataset, deletes, merge_on):
+    with pytest.raises(MissingMergeColumnsError):
+        handle_events(dataset, "1", merge_on, "s3://foo/bar", [], deletes)
+
+
+@mock_aws
+@patch("uploader.dataset.sdk_config")
+@patch("uploader.dataset.Dataset")
+@patch("uploader.dataset.open_table")
+@patch("uploader.dataset.delete_from_dataset")
+@patch("uploader.dataset._copy_table")
+@patch("uploader.dataset.data_files")
+@patch("uploader.dataset.status_add")
+@patch("uploader.dataset.alert_if_new_columns")
+def test_handle_events_only_deletes(
+    alert_if_new_columns,
+    status_add,
+    data_files,
+    copy_table,
+    delete_from_dataset,
+    open_table,
+    Dataset,
+    sdk_config,
+    dataset,
+    delta_writes,
+):
+    _mock_s3()
+    sdk = Mock()
+    sdk.auto_create_edition.return_value = {"Id": f"{dataset['Id']}/1/new-edition"}
+    sdk.create_distribution.return_value = {"Id": "distribution"}
+    Dataset.return_value = sdk
+    delete_from_dataset.return_value = ([{"id": 1}], 2)
+    latest = "s3://testbucket/processed/green/test-dataset/version=1/latest"
+    edition = (
+        "s3://testbucket/processed/green/test-dataset/version=1/edition=new-edition"
+    )
+
+    assert (
+        handle_events(dataset, "1", ["id"], latest, [], [{"id": 1}, {"id": 2}])
+        == "test-dataset/1/new-edition"
+    )
+
+    delete_from_dataset.assert_called_once_with(latest, [{"id": 1}, {"id": 2}], ["id"])
+    copy_table.assert_called_once_with(
+        "write_edition", latest, edition, merge_on=["id"]
+    )
+    status_add.assert_called_once_with(
+        status_body={"deletedKeys": [{"id": 1}], "deletedRows": 2}
+    )
+
+
+@patch("uploader.dataset.Dataset")
+@patch("uploader.dataset.open_table", return_value=None)
+def test_handle_events_only_deletes_no_dataset(open_table, Dataset, dataset):
+    assert handle_events(dataset, "1", ["id"], "s3://foo/bar", [], [{"id": 1}]) is None
+
+    Dataset.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "existing_data,new_data,merge_on,unchanged",
+    [
+        ([{"id": 1, "a": 1}, {"id": 2, "a": 2}], [{"id": 2, "a": 2}], ["id"], True),
+        ([{"id": 1, "a": 1, "b": "x"}], [{"id": 1, "b": "x"}], ["id"], True),
+        (
+            [{"k1": 1, "k2": "x", "a": None}, {"k1": 1, "k2": "y", "a": 2}],
+            [{"k1": 1, "k2": "y", "a": 2}],
+            ["k1", "k2"],
+            True,
+        ),
+        ([{"id": 1, "a": 1}], [{"id": 1, "a": 2}], ["id"], False),
+        ([{"id": 1, "a": 1}], [{"id": 2, "a": 1}], ["id"], False),
+        ([{"id": 1, "a": 1}], [{"id": 1, "a": 1, "b": 1}], ["id"], False),
+        ([{"id": 1, "a": 1}], [{"id": 1, "a": 1.5}], ["id"], False),
+        ([{"id": 1, "a": 1}], [{"id": 1, "a": 1}], [], False),
+    ],
+)
+def test_add_to_dataset_skip_unchanged(
+    temp_dir, mocked_wr_read_deltalake, existing_data, new_data, merge_on, unchanged
+):
+    merged_data, new_columns = add_to_dataset(
+        "s3://foo/bar", new_data, merge_on, skip_unchanged=True
+    )
+
+    assert (merged_data is None) == unchanged
+
+
+@mock_aws
+@patch("uploader.dataset.sdk_config")
+@patch("uploader.dataset.add_to_dataset")
+@patch("uploader.dataset.Dataset")
+@patch("uploader.dataset._write_in_memory")
+@patch("uploader.dataset._catch_up")
+@patch("uploader.dataset.open_table")
+@patch("uploader.dataset.alert_if_new_columns")
+@patch("uploader.dataset.data_files")
+def test_handle_events_commit_conflict(
+    data_files,
+    alert_if_new_columns,
+    open_table,
+    catch_up,
+    write_in_memory,
+    Dataset,
+    add_to_dataset,
+    sdk_config,
+    dataset,
+    delta_writes,
+):
+    _mock_s3()
+    sdk = Mock()
+    sdk.auto_create_edition.return_value = {"Id": f"{dataset['Id']}/1/new-edition"}
+    sdk.create_distribution.return_value = {"Id": "distribution"}
+    Dataset.return_value = sdk
+    add_to_dataset.return_value = pd.DataFrame.from_dict([{"id": 1}]), set()
+    loaded, caught_up = Mock(), Mock()
+    loaded.version.return_value = 3
+    caught_up.version.return_value = 4
+    open_table.return_value = loaded
+    catch_up.return_value = caught_up
+    write_in_memory.side_effect = [CommitFailedError("Conflict"), None]
+
+    handle_events(dataset, "1", ["id"], "s3://testbucket/latest", [{"id": 1}])
+
+    # The table was loaded once, and only caught up with after the conflict.
+    open_table.assert_called_once_with("s3://testbucket/latest")
+    catch_up.assert_called_once_with(loaded, "s3://testbucket/latest")
+    # The events were merged again into the version the other write made.
+    assert [c.kwargs["table_version"] for c in add_to_dataset.call_args_list] == [
+        3,
+        4,
+    ]
+    assert [c.args[5] for c in write_in_memory.call_args_list] == [loaded, caught_up]
+    sdk.auto_create_edition.assert_called_once()
+
+
+@mock_aws
+@patch("uploader.dataset.sdk_config")
+@patch("uploader.dataset.add_to_dataset")
+@patch("uploader.dataset.Dataset")
+@patch("uploader.dataset._write_in_memory")
+@patch("uploader.dataset.COMMIT_RETRIES", 2)
+def test_handle_events_commit_conflicts(
+    write_in_memory, Dataset, add_to_dataset, sdk_config, dataset, delta_writes
+):
+    _mock_s3()
+    sdk = Mock()
+    sdk.auto_create_edition.return_value = {"Id": f"{dataset['Id']}/1/new-edition"}
+    Dataset.return_value = sdk
+    add_to_dataset.return_value = pd.DataFrame.from_dict([{"id": 1}]), set()
+    write_in_memory.side_effect = CommitFailedError("Conflict")
+
+    with pytest.raises(ConcurrentWriteError):
+        handle_events(dataset, "1", ["id"], "s3://testbucket/latest", [{"id": 1}])
+
+    assert write_in_memory.call_count == 3
+    sdk.create_distribution.assert_not_called()
+
+
+@mock_aws
+@patch("uploader.dataset.sdk_config")
+@patch("uploader.dataset.add_to_dataset")
+@patch("uploader.dataset.Dataset")
+@patch("uploader.dataset.status_add")
+def test_handle_events_unchanged(
+    status_add, Dataset, add_to_dataset, sdk_config, dataset, delta_writes
+):
+    write_deltalake, _vacuum = delta_writes
+    sdk = Mock()
+    sdk.get_latest_edition.return_value = {"Id": f"{dataset['Id']}/1/old-edition"}
+    Dataset.return_value = sdk
+    add_to_dataset.return_value = None, set()
+
+    assert (
+        handle_events(dataset, "1", ["id"], "s3://testbucket/latest", [{"id": 1}])
+        == "test-dataset/1/old-edition"
+    )
+
+    assert add_to_dataset.call_args.kwargs["skip_unchanged"]
+    sdk.auto_create_edition.assert_not_called()
+    write_deltalake.assert_not_called()
+    status_add.assert_called_once_with(
+        status_body={"unchanged": True, "editionId": "test-dataset/1/old-edition"}
+    )
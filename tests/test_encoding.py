@@ -0,0 +1,115 @@
+from unittest.mock import patch
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from uploader.inference import dataframe_from_dict
+from uploader.encoding import compact, fillna, restore, writer_properties
+
+DICTIONARY = pd.ArrowDtype(pa.dictionary(pa.int32(), pa.string()))
+
+
+@pytest.fixture(autouse=True)
+def min_rows():
+    with patch("uploader.encoding.DICTIONARY_MIN_ROWS", 10):
+        yield
+
+
+def test_compact_dictionary():
+    existing = dataframe_from_dict(
+        [{"id": str(i), "status": ["OK", "FAILED"][i % 2]} for i in range(100)]
+    )
+    events = dataframe_from_dict([{"id": "100", "status": "PENDING"}])
+
+    widths = compact(existing, events, ["id"])
+
+    assert widths == {}
+    assert existing["status"].dtype == events["status"].dtype == DICTIONARY
+    assert existing["id"].dtype == events["id"].dtype == "string[pyarrow]"
+    assert events["status"].tolist() == ["PENDING"]
+
+
+@pytest.mark.parametrize(
+    "existing_data",
+    [
+        # Too many distinct values.
+        [{"name": str(i)} for i in range(100)],
+        # Too few rows.
+        [{"name": "foo"}] * 9,
+    ],
+)
+def test_compact_dictionary_skipped(existing_data):
+    existing = dataframe_from_dict(existing_data)
+
+    compact(existing, dataframe_from_dict([{"name": "foo"}]))
+
+    assert existing["name"].dtype == "string[pyarrow]"
+
+
+def test_compact_narrow():
+    existing = dataframe_from_dict(
+        [{"a": 1, "b": 1, "x": 0.5, "y": 0.5}, {"a": 300, "b": None, "x": 1.25}]
+    )
+    events = dataframe_from_dict([{"a": -5, "x": 2.5, "y": 0.1}])
+
+    widths = compact(existing, events)
+
+    assert existing["a"].dtype == events["a"].dtype == "int16[pyarrow]"
+    assert existing["b"].dtype == "int8[pyarrow]"
+    assert existing["x"].dtype == events["x"].dtype == "float[pyarrow]"
+    # 0.1 isn't exactly a float32.
+    assert existing["y"].dtype == events["y"].dtype == "double[pyarrow]"
+    assert widths == {
+        "a": "int64[pyarrow]",
+        "b": "int64[pyarrow]",
+        "x": "double[pyarrow]",
+    }
+
+    restore(events, widths)
+
+    assert events.dtypes.to_dict() == {
+        "a": "int64[pyarrow]",
+        "x": "double[pyarrow]",
+        "y": "double[pyarrow]",
+    }
+    assert events.to_dict("records") == [{"a": -5, "x": 2.5, "y": 0.1}]
+
+
+def test_compact_different_dtypes():
+    existing = dataframe_from_dict([{"a": "foo"}] * 10)
+    events = dataframe_from_dict([{"a": 1}])
+
+    assert compact(existing, events) == {}
+    assert existing["a"].dtype == "string[pyarrow]"
+    assert events["a"].dtype == "int64[pyarrow]"
+
+
+def test_fillna_dictionary():
+    # Each side with its own dictionary.
+    values = pd.Series([None, "a", None, None], dtype="string[pyarrow]").astype(
+        DICTIONARY
+    )
+    fill = pd.Series(["b", "c", None, "d"], dtype="string[pyarrow]").astype(DICTIONARY)
+
+    filled = fillna(values, fill)
+
+    assert filled.dtype == DICTIONARY
+    assert filled.tolist() == ["b", "a", pd.NA, "d"]
+    assert filled.tolist() == values.fillna(fill).tolist()
+
+
+def test_writer_properties():
+    schema = pa.schema(
+        [
+            ("id", pa.int64()),
+            ("name", pa.string()),
+            ("value", pa.int64()),
+            ("time", pa.timestamp("us", tz="UTC")),
+        ]
+    )
+
+    properties = writer_properties(schema, ["id", "name"])
+
+    assert properties.default_column_properties.dictionary_enabled
+    assert properties.column_properties.keys() == {"id", "time"}
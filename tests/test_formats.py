@@ -0,0 +1,56 @@
+import io
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from uploader.errors import InvalidEventsError
+from uploader.formats import ARROW_STREAM, NDJSON, PARQUET, read_events, write_ipc
+
+TABLE = pa.table({"id": [1, 2], "name": ["foo", None]})
+
+
+def _parquet(table):
+    sink = io.BytesIO()
+    pq.write_table(table, sink)
+    return sink.getvalue()
+
+
+def _ndjson(table):
+    return "\n".join(json.dumps(row) for row in table.to_pylist()).encode()
+
+
+@pytest.mark.parametrize(
+    "content_type,encode",
+    [(ARROW_STREAM, write_ipc), (PARQUET, _parquet), (NDJSON, _ndjson)],
+)
+def test_read_events(content_type, encode):
+    assert read_events(encode(TABLE), content_type).to_pylist() == TABLE.to_pylist()
+
+
+def test_read_events_ndjson_temporal():
+    payload = _ndjson(
+        pa.table({"id": [1], "time": ["2024-01-01T12:00:00Z"], "date": ["2024-01-01"]})
+    )
+
+    # Left to be inferred like the events of a JSON document.
+    assert read_events(payload, NDJSON).schema == pa.schema(
+        [("id", pa.int64()), ("time", pa.string()), ("date", pa.string())]
+    )
+
+
+@pytest.mark.parametrize(
+    "payload,content_type",
+    [
+        (b"nope", ARROW_STREAM),
+        (b"nope", PARQUET),
+        (b"{nope", NDJSON),
+        (b"", NDJSON),
+        (write_ipc(TABLE.slice(0, 0)), ARROW_STREAM),
+        (write_ipc(TABLE), "text/csv"),
+    ],
+)
+def test_read_events_invalid(payload, content_type):
+    with pytest.raises(InvalidEventsError):
+        read_events(payload, content_type)
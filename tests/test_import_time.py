@@ -0,0 +1,54 @@
+"""Guard the cold start of the API handlers against heavy imports.
+
+Uses `python -X importtime` in a fresh interpreter, so that modules already
+imported by the test session don't hide anything.
+"""
+
+import subprocess
+import sys
+
+import pytest
+
+# The data engine; only needed when actually writing to a dataset.
+HEAVY_MODULES = {"awswrangler", "deltalake", "pandas", "pyarrow"}
+
+
+def _import_times(module):
+    """Return a dict of cumulative import times (µs) from importing `module`."""
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self, cumulative, name = line.removeprefix("import time:").split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "uploader.handlers.generate_signed_post",
+        "uploader.handlers.handle_status_queue",
+        "uploader.handlers.push_dataset_events",
+    ],
+)
+def test_handler_import_excludes_data_engine(module):
+    times = _import_times(module)
+    heavy = {name.split(".")[0] for name in times} & HEAVY_MODULES
+
+    assert not heavy, f"{module} imports {heavy} ({times[module] / 1000:.0f} ms)"
+
+
+def test_validation_import_excludes_dataset_engine():
+    # File heads are read with pandas and pyarrow, but never written.
+    times = _import_times("uploader.validation")
+
+    assert "uploader.dataset" not in times
+    assert "awswrangler" not in {name.split(".")[0] for name in times}
@@ -0,0 +1,73 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from uploader.inference import dataframe_from_dict
+
+
+@pytest.mark.parametrize(
+    "data,schema",
+    [
+        # https://arrow.apache.org/docs/python/api/datatypes.html
+        ([{"a": 2, "b": "bar", "c": None}], {"a": pa.int64(), "b": pa.string()}),
+        (
+            [
+                {"a": 2, "b": "bar", "c": "baz"},
+                {"a": 2, "b": "bar", "c": None},
+            ],
+            {"a": pa.int64(), "b": pa.string(), "c": pa.string()},
+        ),
+        ([{"a": 0}, {"a": 5000000000000}], {"a": pa.int64()}),
+        ([{"a": 1}, {"a": 1.123}], {"a": pa.float64()}),
+        ([{"a": True}, {"a": False}, {"a": None}], {"a": pa.bool_()}),
+        # Incomplete dates should be strings.
+        ([{"a": "2024"}], {"a": pa.string()}),
+        ([{"a": "2024-10"}], {"a": pa.string()}),
+        (
+            [{"a": "2024-10-01"}, {"a": "1999-10-01"}],
+            {"a": pa.date64()},
+        ),
+        (
+            [{"a": "2024-10-01"}, {"a": "foo"}],
+            {"a": pa.string()},
+        ),
+        ([{"a": "2024-10-22T14:43:47"}], {"a": pa.timestamp("us", tz="UTC")}),
+        ([{"a": "2024-10-22T14:43:47Z"}], {"a": pa.timestamp("us", tz="UTC")}),
+        ([{"a": "2024-10-22T14:43:47+02:00"}], {"a": pa.timestamp("us", tz="UTC")}),
+        ([{"a": "2024-10-22T14:43:47.764186"}], {"a": pa.timestamp("us", tz="UTC")}),
+        ([{"a": "2025-01-16T08:21:07.61978Z"}], {"a": pa.timestamp("us", tz="UTC")}),
+        (
+            [{"a": "2024-10-22T14:44:41.038797+02:00"}],
+            {"a": pa.timestamp("us", tz="UTC")},
+        ),
+        # Mixed formats fallback to strings.
+        (
+            [
+                {"a": "2024-10-22T14:43:47.764186"},
+                {"a": "2024-10-22T14:44:41.038797+02:00"},
+            ],
+            {"a": pa.string()},
+        ),
+        (
+            [{"a": "2024-10-22T14:43:47.764186"}, {"a": "2024-10-22"}],
+            {"a": pa.string()},
+        ),
+    ],
+)
+def test_dataframe_from_dict(data, schema):
+    df = dataframe_from_dict(data)
+
+    for col in df.columns:
+        dtype = df[col].dtype
+        assert dtype == pd.ArrowDtype(schema[col])
+
+
+def test_dataframe_from_dict_table():
+    data = [
+        {"id": 1, "time": "2024-05-01T12:00:00Z", "empty": None},
+        {"id": 2, "time": "2024-05-02T12:00:00Z", "empty": None},
+    ]
+
+    pd.testing.assert_frame_equal(
+        dataframe_from_dict(pa.Table.from_pylist(data)), dataframe_from_dict(data)
+    )
@@ -0,0 +1,114 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from uploader.inference import dataframe_from_dict
+from uploader.errors import InvalidTypeError
+from uploader.partitioning import (
+    add_partition_columns,
+    partition_filter,
+    partition_predicate,
+    partition_spec,
+)
+
+DATE = {"name": "date", "column": "time", "transform": "day"}
+
+
+def test_partition_spec():
+    dataset = {
+        "source": {
+            "type": "event",
+            "partitionBy": [
+                "region",
+                {"name": "date", "column": "time", "transform": "day"},
+            ],
+        }
+    }
+
+    assert partition_spec(dataset) == [
+        {"name": "region", "column": "region", "transform": None},
+        DATE,
+    ]
+
+
+def test_partition_spec_unpartitioned():
+    assert partition_spec({"source": {"type": "event"}}) == []
+    assert partition_spec({}) == []
+
+
+@pytest.mark.parametrize(
+    "partition_by",
+    [
+        [{"name": "date"}],
+        [{"name": "date", "column": "time"}],
+        [{"name": "date", "column": "time", "transform": "hour"}],
+        [1],
+    ],
+)
+def test_partition_spec_invalid(partition_by):
+    with pytest.raises(ValueError):
+        partition_spec({"source": {"partitionBy": partition_by}})
+
+
+@pytest.mark.parametrize(
+    "transform,partitions",
+    [
+        ("year", ["2024", "2024", None]),
+        ("month", ["2024-05", "2024-06", None]),
+        ("day", ["2024-05-01", "2024-06-30", None]),
+    ],
+)
+def test_add_partition_columns(transform, partitions):
+    df = dataframe_from_dict(
+        [
+            {"id": 1, "time": "2024-05-01T12:00:00"},
+            {"id": 2, "time": "2024-06-30T23:59:59"},
+            {"id": 3, "time": None},
+        ]
+    )
+
+    df = add_partition_columns(
+        df, [{"name": "part", "column": "time", "transform": transform}]
+    )
+
+    assert df["part"].tolist()[:2] == partitions[:2]
+    assert pd.isna(df["part"].tolist()[2])
+    assert df["part"].dtype == pd.ArrowDtype(pa.string())
+
+
+def test_add_partition_columns_missing_column():
+    df = add_partition_columns(dataframe_from_dict([{"id": 1}]), [DATE])
+
+    assert df["date"].isna().all()
+
+
+def test_add_partition_columns_not_timestamp():
+    df = dataframe_from_dict([{"id": 1, "time": "yesterday"}])
+
+    with pytest.raises(InvalidTypeError):
+        add_partition_columns(df, [DATE])
+
+
+def test_partition_filter_and_predicate():
+    df = dataframe_from_dict(
+        [
+            {"date": "2024-05-01", "key": 1},
+            {"date": "it's", "key": 2},
+            {"date": "2024-05-01", "key": None},
+        ]
+    )
+    table = pa.table(
+        {
+            "date": ["2024-05-01", "it's", "2024-05-02", None],
+            "key": [None, 2, 1, 1],
+        }
+    )
+
+    assert table.filter(partition_filter(df, ["date", "key"])).to_pylist() == [
+        {"date": "2024-05-01", "key": None},
+        {"date": "it's", "key": 2},
+    ]
+    assert partition_predicate(df, ["date", "key"]) == (
+        "(\"date\" IN ('2024-05-01', 'it''s')) AND "
+        '("key" IN (1, 2) OR "key" IS NULL)'
+    )
@@ -0,0 +1,106 @@
+import os
+from unittest.mock import mock_open, patch
+
+import pytest
+
+from conftest import write_deltalake
+from uploader.planner import CHUNKED, IN_MEMORY, REJECTED, plan, table_stats
+from uploader.storage import open_table
+
+
+@pytest.fixture
+def table(temp_dir):
+    write_deltalake(
+        temp_dir, [{"id": i, "value": i / 2, "name": f"name-{i}"} for i in range(1000)]
+    )
+    write_deltalake(temp_dir, [{"id": 1000, "value": 1.5, "name": "x"}], mode="append")
+    return open_table(temp_dir)
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    """Set the function's memory size in MB, with nothing used so far."""
+
+    def set_memory(mb):
+        monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", str(mb))
+
+    with patch("uploader.planner.rss_bytes", return_value=0):
+        yield set_memory
+
+
+def test_table_stats(table):
+    stats = table_stats(table)
+
+    assert stats["rows"] == 1001
+    assert stats["files"] == 2
+    assert stats["file_bytes"] > stats["largest_file_bytes"] > 0
+    assert stats["fixed_row_bytes"] == 16
+    assert stats["variable_columns"] == 1
+
+
+def test_table_stats_no_table():
+    assert table_stats(None) is None
+
+
+@patch("uploader.planner.table_stats")
+def test_plan_without_memory_limit(table_stats, monkeypatch):
+    monkeypatch.delenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", raising=False)
+
+    res = plan(None, 1000, ["id"])
+
+    assert res["strategy"] == IN_MEMORY
+    assert res["available_bytes"] is None
+    table_stats.assert_not_called()
+
+
+@patch("uploader.profiling.max_rss_bytes", return_value=10**12)
+def test_plan_after_peak(max_rss_bytes, monkeypatch):
+    # An earlier invocation of a warm function peaked far above the limit,
+    # but the memory has been freed since.
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "10240")
+
+    with patch("uploader.profiling.open", mock_open(read_data="100 50 0 0 0 0 0")):
+        res = plan(None, 1000, ["id"])
+
+    assert res["strategy"] == IN_MEMORY
+    assert res["available_bytes"] == int(10240 * 1024 * 1024 * 0.9) - 50 * os.sysconf(
+        "SC_PAGE_SIZE"
+    )
+
+
+def test_plan_no_table(memory):
+    memory(1)
+
+    res = plan(None, 1000, ["id"])
+
+    assert res["strategy"] == IN_MEMORY
+    assert res["estimated_bytes"] == 2000
+    assert plan(None, 1000, ["id"], 1)["estimated_bytes"] == 1000
+
+
+@pytest.mark.parametrize(
+    "in_memory_bytes,chunked_bytes,strategy",
+    [
+        (5 * 10**5, 10**5, IN_MEMORY),
+        (10**7, 10**5, CHUNKED),
+        (10**7, 10**7, REJECTED),
+    ],
+)
+def test_plan(table, memory, in_memory_bytes, chunked_bytes, strategy):
+    memory(1)  # 943718 bytes available
+
+    with (
+        patch("uploader.planner.MERGE_FACTOR", in_memory_bytes / 10**5),
+        patch("uploader.planner.CHUNK_FACTOR", chunked_bytes / 10**5),
+        patch("uploader.planner._table_bytes", return_value=10**5),
+    ):
+        res = plan(table, 0, ["id"])
+
+    assert res["strategy"] == strategy
+    assert res["rows"] == 1001
+    assert res["available_bytes"] == 943718
+    assert res["in_memory_bytes"] == in_memory_bytes
+    if strategy == IN_MEMORY:
+        assert res["estimated_bytes"] == res["in_memory_bytes"]
+    else:
+        assert res["estimated_bytes"] == res["chunked_bytes"]
@@ -0,0 +1,60 @@
+import datetime
+
+import pyarrow as pa
+import pytest
+
+from uploader.errors import InvalidTypeError
+from uploader.predicates import keys_filter, keys_predicate, sql_literal
+
+TABLE = pa.table(
+    {
+        "k1": [1, 1, 2, None, 3],
+        "k2": ["a", "b", "a", "a", "it's"],
+    }
+)
+
+
+@pytest.mark.parametrize(
+    "keys,columns,predicate,rows",
+    [
+        ([{"k1": 2}, {"k1": 1}], ["k1"], '"k1" IN (1, 2)', [0, 1, 2]),
+        ([{"k1": None}], ["k1"], '"k1" IS NULL', [3]),
+        ([{"k1": 3}, {"k1": None}], ["k1"], '"k1" IN (3) OR "k1" IS NULL', [3, 4]),
+        (
+            [{"k1": 1, "k2": "b"}, {"k1": None, "k2": "a"}],
+            ["k1", "k2"],
+            '("k1" = 1 AND "k2" = \'b\') OR ("k1" IS NULL AND "k2" = \'a\')',
+            [1, 3],
+        ),
+        ([{"k2": "it's"}], ["k2"], "\"k2\" IN ('it''s')", [4]),
+    ],
+)
+def test_keys_predicate_and_filter(keys, columns, predicate, rows):
+    assert keys_predicate(keys, columns) == predicate
+
+    matched = TABLE.append_column("row", pa.array(range(5))).filter(
+        keys_filter(keys, columns)
+    )
+    assert matched["row"].to_pylist() == rows
+
+
+@pytest.mark.parametrize(
+    "value,literal",
+    [
+        ("it's", "'it''s'"),
+        (True, "TRUE"),
+        (3, "3"),
+        (1.5, "1.5"),
+        (datetime.date(2024, 5, 1), "DATE '2024-05-01'"),
+    ],
+)
+def test_sql_literal(value, literal):
+    assert sql_literal(value) == literal
+
+
+@pytest.mark.parametrize(
+    "value", [float("nan"), datetime.datetime(2024, 5, 1), b"bytes"]
+)
+def test_sql_literal_unsupported(value):
+    with pytest.raises(InvalidTypeError):
+        sql_literal(value)
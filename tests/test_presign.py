@@ -0,0 +1,107 @@
+import os
+
+import boto3
+import pytest
+from botocore.client import Config as BotoConfig
+from botocore.credentials import ReadOnlyCredentials
+from freezegun import freeze_time
+
+from uploader.common import generate_signed_post
+from uploader.presign import generate_presigned_post, signing_key
+
+
+def _boto3_presigned_post(bucket, key, fields, conditions, credentials):
+    s3 = boto3.client(
+        "s3",
+        region_name=os.environ["AWS_REGION"],
+        aws_access_key_id=credentials.access_key,
+        aws_secret_access_key=credentials.secret_key,
+        aws_session_token=credentials.token,
+        config=BotoConfig(signature_version="s3v4", s3={"addressing_style": "path"}),
+    )
+    return s3.generate_presigned_post(
+        bucket, key, Fields=fields, Conditions=conditions, ExpiresIn=300
+    )
+
+
+@freeze_time("2020-11-02T19:54:14.123456+00:00")
+@pytest.mark.parametrize(
+    "key,fields,conditions",
+    [
+        ("raw/green/foo/version=1/edition=bar/data.csv", None, None),
+        (
+            "raw/green/foo/version=1/edition=bar/data.csv",
+            {"acl": "private"},
+            [{"acl": "private"}],
+        ),
+        (
+            "raw/red/foo/version=1/edition=bar/blåbær.csv",
+            {"acl": "private", "Content-Type": "text/csv"},
+            [
+                {"acl": "private"},
+                {"Content-Type": "text/csv"},
+                ["content-length-range", 1, 5 * 2**30],
+            ],
+        ),
+        ("raw/green/foo/version=1/edition=bar/${filename}", None, None),
+    ],
+)
+@pytest.mark.parametrize(
+    "credentials",
+    [
+        ReadOnlyCredentials("mock-key", "mock-secret", None),
+        ReadOnlyCredentials("mock-key", "mock-secret", "mock-session-token"),
+    ],
+)
+def test_generate_presigned_post_matches_boto3(key, fields, conditions, credentials):
+    assert generate_presigned_post(
+        "testbucket",
+        key,
+        fields=fields,
+        conditions=conditions,
+        expires_in=300,
+        credentials=credentials,
+    ) == _boto3_presigned_post("testbucket", key, fields, conditions, credentials)
+
+
+def test_generate_presigned_post_does_not_mutate_arguments():
+    fields = {"acl": "private"}
+    conditions = [{"acl": "private"}]
+
+    generate_presigned_post(
+        "testbucket",
+        "foo.csv",
+        fields=fields,
+        conditions=conditions,
+        credentials=ReadOnlyCredentials("mock-key", "mock-secret", None),
+    )
+
+    assert fields == {"acl": "private"}
+    assert conditions == [{"acl": "private"}]
+
+
+def test_signing_key_cached():
+    signing_key.cache_clear()
+
+    signing_key("mock-secret", "20201102", "eu-west-1")
+    signing_key("mock-secret", "20201102", "eu-west-1")
+    signing_key("mock-secret", "20201103", "eu-west-1")
+
+    info = signing_key.cache_info()
+    assert info.hits == 1
+    assert info.misses == 2
+
+
+@freeze_time("2020-11-02T19:54:14.123456+00:00")
+def test_generate_signed_post_extra_conditions():
+    post = generate_signed_post(
+        "testbucket",
+        "foo.csv",
+        fields={"Content-Type": "text/csv"},
+        conditions=[["content-length-range", 1, 1024]],
+    )
+
+    assert post["url"] == "https://s3.eu-west-1.amazonaws.com/testbucket"
+    assert post["fields"]["acl"] == "private"
+    assert post["fields"]["Content-Type"] == "text/csv"
+    assert post["fields"]["key"] == "foo.csv"
@@ -0,0 +1,88 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from uploader import profiling
+from uploader.profiling import max_rss_bytes, profile, rss_bytes, stage
+
+
+def _records(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_stage_outside_profile(capsys):
+    with stage("read") as metrics:
+        metrics["rows"] = 10
+
+    assert metrics == {"rows": 10}
+    assert capsys.readouterr().out == ""
+
+
+@patch("uploader.profiling.log_add")
+def test_profile(log_add, capsys):
+    with profile(dataset_id="my-dataset"):
+        with stage("read") as metrics:
+            metrics.update(rows=10, bytes=1024)
+        with stage("write"):
+            pass
+
+    read, write = _records(capsys)
+
+    assert read["_aws"]["CloudWatchMetrics"][0]["Namespace"] == "DataUploader"
+    assert read["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [
+        ["Stage"],
+        ["DatasetId", "Stage"],
+    ]
+    assert {
+        m["Name"]: m["Unit"] for m in read["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+    } == {
+        "Duration": "Milliseconds",
+        "Rows": "Count",
+        "Bytes": "Bytes",
+        "MaxRSS": "Bytes",
+        "MaxRSSIncrease": "Bytes",
+    }
+    assert read["DatasetId"] == "my-dataset"
+    assert read["Stage"] == "read"
+    assert read["Rows"] == 10
+    assert read["Bytes"] == 1024
+    assert read["Duration"] >= 0
+    assert read["MaxRSS"] > 0
+
+    assert write["Stage"] == "write"
+    assert "Rows" not in write
+
+    [stages] = [c.kwargs["profile"] for c in log_add.call_args_list]
+    assert [s["stage"] for s in stages] == ["read", "write"]
+
+
+def test_profile_failing_stage(capsys):
+    with pytest.raises(ValueError):
+        with profile(dataset_id="my-dataset"):
+            with stage("merge"):
+                raise ValueError
+
+    [merge] = _records(capsys)
+    assert merge["Stage"] == "merge"
+    assert profiling._profile is None
+
+
+@patch("uploader.profiling.PROFILE_TRACEMALLOC", True)
+def test_profile_tracemalloc(capsys):
+    with profile(dataset_id="my-dataset"):
+        with stage("infer"):
+            data = [str(i) for i in range(10000)]
+
+    [infer] = _records(capsys)
+    assert infer["TracemallocPeak"] > 10000
+    assert len(data) == 10000
+
+
+def test_rss_bytes():
+    # Large allocations are returned to the system when freed, lowering the
+    # current RSS but not the peak.
+    data = b"x" * (256 * 1024 * 1024)
+    del data
+
+    assert 0 < rss_bytes() < max_rss_bytes() - 128 * 1024 * 1024
@@ -0,0 +1,51 @@
+import jsonschema
+import pytest
+
+from uploader.schema import MODELS, VALIDATORS, get_model_schema, validate
+
+
+def test_all_models_compiled():
+    assert set(VALIDATORS) == set(MODELS)
+    assert {"uploadRequest", "pushEventsRequest"} <= set(MODELS)
+
+
+def test_get_model_schema():
+    assert get_model_schema("uploadRequest")["title"] == "Upload Request"
+
+
+def test_validate():
+    validate({"datasetId": "foo", "events": [{"a": 1}]}, "pushEventsRequest")
+
+
+def test_validate_deletes():
+    validate({"datasetId": "foo", "deletes": [{"id": 1}]}, "pushEventsRequest")
+
+
+def test_validate_dedup():
+    validate(
+        {"datasetId": "foo", "events": [{"a": 1}], "dedup": "coalesce"},
+        "pushEventsRequest",
+    )
+
+
+@pytest.mark.parametrize(
+    "instance",
+    [
+        None,
+        {},
+        {"datasetId": "foo"},
+        {"datasetId": "foo", "events": []},
+        {"datasetId": 1, "events": "nope", "version": 2},
+        {"datasetId": "foo", "deletes": []},
+        {"datasetId": "foo", "deletes": [1]},
+        {"datasetId": "foo", "events": [{"a": 1}], "dedup": "any"},
+    ],
+)
+def test_validate_error_matches_jsonschema(instance):
+    with pytest.raises(jsonschema.ValidationError) as expected:
+        jsonschema.validate(instance, get_model_schema("pushEventsRequest"))
+
+    with pytest.raises(jsonschema.ValidationError) as actual:
+        validate(instance, "pushEventsRequest")
+
+    assert actual.value.message == expected.value.message
@@ -0,0 +1,129 @@
+import os
+from unittest.mock import patch
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+from uploader import secrets
+from uploader.errors import SecretNotFoundError
+from uploader.secrets import get_secret
+
+KEYCLOAK_SECRET = "/dataplatform/data-uploader/keycloak-client-secret"
+EMAIL_SECRET = "/dataplatform/shared/email-api-key"
+
+
+class _Thread:
+    """Run thread targets synchronously."""
+
+    def __init__(self, target, args, daemon):
+        self.target = target
+        self.args = args
+
+    def start(self):
+        self.target(*self.args)
+
+
+@pytest.fixture
+def ssm():
+    with mock_aws():
+        secrets._cache.clear()
+        secrets._ssm_client.cache_clear()
+
+        ssm = boto3.client("ssm", region_name=os.environ["AWS_REGION"])
+        for name in [KEYCLOAK_SECRET, EMAIL_SECRET]:
+            ssm.put_parameter(Name=name, Value=f"{name}-v1", Type="SecureString")
+
+        with patch.object(
+            secrets._ssm_client(),
+            "get_parameters",
+            wraps=secrets._ssm_client().get_parameters,
+        ) as get_parameters:
+            yield ssm, get_parameters
+
+        secrets._cache.clear()
+        secrets._ssm_client.cache_clear()
+
+
+def test_get_secret_batched(ssm):
+    _ssm, get_parameters = ssm
+
+    assert get_secret(KEYCLOAK_SECRET) == f"{KEYCLOAK_SECRET}-v1"
+    assert get_secret(EMAIL_SECRET) == f"{EMAIL_SECRET}-v1"
+    assert get_secret(KEYCLOAK_SECRET) == f"{KEYCLOAK_SECRET}-v1"
+
+    get_parameters.assert_called_once()
+    assert set(get_parameters.call_args.kwargs["Names"]) == {
+        KEYCLOAK_SECRET,
+        EMAIL_SECRET,
+    }
+
+
+def test_get_secret_not_found(ssm):
+    with pytest.raises(SecretNotFoundError, match="/missing"):
+        get_secret("/missing")
+
+    # The known secrets were cached nonetheless.
+    assert get_secret(EMAIL_SECRET) == f"{EMAIL_SECRET}-v1"
+
+
+@patch("uploader.secrets.SECRETS", [KEYCLOAK_SECRET, "/missing", EMAIL_SECRET])
+def test_get_secret_other_not_found(ssm):
+    _ssm, get_parameters = ssm
+
+    assert get_secret(KEYCLOAK_SECRET) == f"{KEYCLOAK_SECRET}-v1"
+    assert get_secret(EMAIL_SECRET) == f"{EMAIL_SECRET}-v1"
+
+    get_parameters.assert_called_once()
+
+
+def test_get_secret_batch_denied(ssm):
+    _ssm, get_parameters = ssm
+    fetch = get_parameters._mock_wraps
+
+    def get_parameters_denied(Names, **kwargs):
+        if EMAIL_SECRET in Names:
+            raise ClientError(
+                {"Error": {"Code": "AccessDeniedException"}}, "GetParameters"
+            )
+        return fetch(Names=Names, **kwargs)
+
+    get_parameters.side_effect = get_parameters_denied
+
+    assert get_secret(KEYCLOAK_SECRET) == f"{KEYCLOAK_SECRET}-v1"
+    with pytest.raises(ClientError):
+        get_secret(EMAIL_SECRET)
+
+    assert get_secret(KEYCLOAK_SECRET) == f"{KEYCLOAK_SECRET}-v1"
+
+
+@patch("uploader.secrets.threading.Thread", _Thread)
+def test_get_secret_refresh(ssm):
+    ssm, get_parameters = ssm
+    get_secret(KEYCLOAK_SECRET)
+    ssm.put_parameter(
+        Name=KEYCLOAK_SECRET, Value="v2", Type="SecureString", Overwrite=True
+    )
+
+    assert get_secret(KEYCLOAK_SECRET) == f"{KEYCLOAK_SECRET}-v1"
+
+    with patch("uploader.secrets.SECRET_TTL", 0):
+        # The stale value is served while refreshing.
+        assert get_secret(KEYCLOAK_SECRET) == f"{KEYCLOAK_SECRET}-v1"
+
+    assert get_secret(KEYCLOAK_SECRET) == "v2"
+    assert get_parameters.call_count == 2
+
+
+@patch("uploader.secrets.threading.Thread", _Thread)
+def test_get_secret_refresh_failure(ssm):
+    _ssm, get_parameters = ssm
+    get_secret(KEYCLOAK_SECRET)
+    get_parameters.side_effect = Exception("SSM is down")
+
+    with patch("uploader.secrets.SECRET_TTL", 0):
+        assert get_secret(KEYCLOAK_SECRET) == f"{KEYCLOAK_SECRET}-v1"
+        assert get_secret(KEYCLOAK_SECRET) == f"{KEYCLOAK_SECRET}-v1"
+
+    assert get_parameters.call_count == 3
@@ -0,0 +1,164 @@
+import os
+import shutil
+from unittest.mock import patch
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from conftest import write_deltalake
+from uploader import snapshots
+from uploader.snapshots import snapshot
+
+S3_PATH = f"s3://{os.environ['BUCKET']}/processed/green/foo/version=1/latest"
+
+
+@pytest.fixture
+def s3(temp_dir):
+    with mock_aws():
+        snapshots._s3_client.cache_clear()
+        s3 = boto3.client("s3", region_name=os.environ["AWS_REGION"])
+        s3.create_bucket(
+            Bucket=os.environ["BUCKET"],
+            CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_REGION"]},
+        )
+        with patch("uploader.snapshots.CACHE_DIR", f"{temp_dir}/cache"):
+            yield s3
+        snapshots._s3_client.cache_clear()
+
+
+def _upload(s3, table_path):
+    # Mirror the local Delta table at `table_path` to `S3_PATH`.
+    _bucket, prefix = snapshots._split_s3_path(S3_PATH)
+    for root, _dirs, files in os.walk(table_path):
+        for name in files:
+            path = os.path.join(root, name)
+            s3.upload_file(
+                path,
+                os.environ["BUCKET"],
+                f"{prefix}/{os.path.relpath(path, table_path)}",
+            )
+
+
+@pytest.fixture
+def fetched(s3):
+    with (
+        patch.object(s3, "download_file", wraps=s3.download_file) as download_file,
+        patch.object(s3, "get_object", wraps=s3.get_object) as get_object,
+        patch("uploader.snapshots._s3_client", return_value=s3),
+    ):
+        yield download_file, get_object
+
+
+def test_snapshot(s3, fetched, temp_dir):
+    download_file, get_object = fetched
+    table_path = f"{temp_dir}/table"
+    write_deltalake(table_path, [{"id": 1, "date": "a"}], partition_by=["date"])
+    _upload(s3, table_path)
+
+    table = snapshot(S3_PATH, 0)
+
+    assert table.to_pyarrow_table().to_pylist() == [{"id": 1, "date": "a"}]
+    assert table.table_uri.startswith(f"file://{temp_dir}/cache/")
+    # The log and the data file.
+    assert download_file.call_count == 2
+
+    write_deltalake(
+        table_path, [{"id": 2, "date": "b"}], mode="append", partition_by=["date"]
+    )
+    _upload(s3, table_path)
+    download_file.reset_mock()
+    get_object.reset_mock()
+
+    table = snapshot(S3_PATH, 1)
+
+    assert sorted(table.to_pyarrow_table().to_pylist(), key=lambda r: r["id"]) == [
+        {"id": 1, "date": "a"},
+        {"id": 2, "date": "b"},
+    ]
+    # Only the new data file was downloaded, and the new commit fetched after
+    # verifying the cached one.
+    assert download_file.call_count == 1
+    assert [
+        c.kwargs["Key"].rsplit("/")[-1]
+        for c in get_object.call_args_list
+        if "/_delta_log/" in c.kwargs["Key"]
+    ] == ["00000000000000000000.json", "00000000000000000001.json"]
+
+
+def test_snapshot_removed_files(s3, fetched, temp_dir):
+    table_path = f"{temp_dir}/table"
+    write_deltalake(table_path, [{"id": 1}])
+    _upload(s3, table_path)
+    old_files = snapshot(S3_PATH, 0).file_uris()
+
+    write_deltalake(table_path, [{"id": 2}], mode="overwrite")
+    _upload(s3, table_path)
+
+    table = snapshot(S3_PATH, 1)
+
+    assert table.to_pyarrow_table().to_pylist() == [{"id": 2}]
+    assert not any(os.path.exists(f.removeprefix("file://")) for f in old_files)
+    assert all(os.path.exists(f.removeprefix("file://")) for f in table.file_uris())
+
+
+def test_snapshot_table_replaced(s3, fetched, temp_dir):
+    download_file, _get_object = fetched
+    table_path = f"{temp_dir}/table"
+    write_deltalake(table_path, [{"id": 1}])
+    _upload(s3, table_path)
+    snapshot(S3_PATH, 0)
+
+    # The table is cleared out and written anew.
+    shutil.rmtree(table_path)
+    s3.delete_objects(
+        Bucket=os.environ["BUCKET"],
+        Delete={
+            "Objects": [
+                {"Key": o["Key"]}
+                for o in s3.list_objects_v2(Bucket=os.environ["BUCKET"])["Contents"]
+            ]
+        },
+    )
+    write_deltalake(table_path, [{"id": 2, "a": "x"}])
+    _upload(s3, table_path)
+    download_file.reset_mock()
+
+    assert snapshot(S3_PATH, 0).to_pyarrow_table().to_pylist() == [{"id": 2, "a": "x"}]
+    assert download_file.call_count == 2
+
+
+@patch("uploader.snapshots._remote_table")
+def test_snapshot_too_large(remote_table, s3, fetched, temp_dir):
+    table_path = f"{temp_dir}/table"
+    write_deltalake(table_path, [{"id": 1}])
+    _upload(s3, table_path)
+
+    with patch("uploader.snapshots.CACHE_SHARE", 0):
+        assert snapshot(S3_PATH, 0) == remote_table.return_value
+
+    remote_table.assert_called_once_with(S3_PATH, 0)
+    assert os.listdir(f"{temp_dir}/cache") == []
+
+
+@patch("uploader.snapshots._remote_table")
+@patch("uploader.snapshots.log_exception")
+def test_snapshot_error(log_exception, remote_table, s3, fetched):
+    # There's no table in S3.
+    assert snapshot(S3_PATH, 0) == remote_table.return_value
+
+    log_exception.assert_called_once()
+
+
+def test_evict(s3, temp_dir):
+    cache_dir = f"{temp_dir}/cache"
+    for i, name in enumerate(["old", "recent", "current"]):
+        os.makedirs(f"{cache_dir}/{name}")
+        with open(f"{cache_dir}/{name}/data", "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(f"{cache_dir}/{name}", (i, i))
+
+    with patch("uploader.snapshots._cache_budget", return_value=250):
+        snapshots._evict(keep=f"{cache_dir}/current")
+
+    assert sorted(os.listdir(cache_dir)) == ["current", "recent"]
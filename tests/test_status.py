@@ -0,0 +1,41 @@
+import json
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+
+from uploader.status import create_status_trace
+
+
+def _status_data():
+    return {
+        "domain": "dataset",
+        "domain_id": "my-dataset/1",
+        "component": "data-uploader",
+        "operation": "upload",
+        "user": "me",
+    }
+
+
+def test_create_status_trace(status_queue):
+    trace_id = create_status_trace(_status_data())
+
+    assert trace_id.startswith("my-dataset-")
+
+    messages = status_queue.receive_messages(MaxNumberOfMessages=10)
+    assert [json.loads(m.body) for m in messages] == [
+        {"trace_id": trace_id, "trace_status": "STARTED", **_status_data()}
+    ]
+
+
+def test_create_status_trace_unique_ids(status_queue):
+    assert create_status_trace(_status_data()) != create_status_trace(_status_data())
+
+
+@patch("uploader.status._queue_url")
+def test_create_status_trace_queue_error(queue_url):
+    queue_url.side_effect = ClientError(
+        {"Error": {"Code": "AWS.SimpleQueueService.NonExistentQueue"}},
+        "GetQueueUrl",
+    )
+
+    assert create_status_trace(_status_data()).startswith("my-dataset-")
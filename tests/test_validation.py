@@ -0,0 +1,208 @@
+import io
+import json
+import os
+import struct
+from unittest.mock import patch
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from moto import mock_aws
+
+from conftest import write_deltalake
+from uploader import validation
+from uploader.errors import UnreadableFileError
+from uploader.validation import (
+    PARQUET_MAGIC,
+    dataset_schema,
+    file_schema,
+    schema_mismatches,
+)
+
+BUCKET = os.environ["BUCKET"]
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        validation._s3_client.cache_clear()
+        s3 = boto3.client("s3", region_name=os.environ["AWS_REGION"])
+        s3.create_bucket(
+            Bucket=BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_REGION"]},
+        )
+        with patch.object(s3, "get_object", wraps=s3.get_object) as get_object:
+            with patch("uploader.validation._s3_client", return_value=s3):
+                yield s3, get_object
+        validation._s3_client.cache_clear()
+
+
+def _schema(s3, key, body):
+    s3, get_object = s3
+    s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+    return file_schema(BUCKET, key, len(body))
+
+
+def _parquet(table):
+    buf = io.BytesIO()
+    pq.write_table(table, buf)
+    return buf.getvalue()
+
+
+def test_file_schema_csv(s3):
+    body = b"id;name;date\n1;foo;2020-01-01\n2;bar;2020-01-02\n"
+
+    assert _schema(s3, "data.csv", body) == {
+        "id": pa.int64(),
+        "name": pa.string(),
+        "date": pa.date64(),
+    }
+
+
+def test_file_schema_csv_latin_1(s3):
+    body = "id,name\n1,blåbær\n".encode("latin-1")
+
+    assert _schema(s3, "data.csv", body) == {"id": pa.int64(), "name": pa.string()}
+
+
+def test_file_schema_csv_head_only(s3):
+    body = b"id,time\n" + b"1,2020-01-01T12:00:00Z\n" * 1000
+
+    with patch("uploader.validation.HEAD_SIZE", 100):
+        schema = _schema(s3, "data.csv", body)
+
+    assert schema == {"id": pa.int64(), "time": pa.timestamp("us", tz="UTC")}
+    _s3, get_object = s3
+    assert get_object.call_args.kwargs["Range"] == "bytes=0-99"
+
+
+def test_file_schema_json(s3):
+    body = json.dumps([{"id": 1, "value": 1.5}, {"id": 2, "value": None}]).encode()
+
+    assert _schema(s3, "data.json", body) == {
+        "id": pa.int64(),
+        "value": pa.float64(),
+    }
+
+
+def test_file_schema_json_too_large(s3):
+    body = json.dumps([{"id": i} for i in range(100)]).encode()
+
+    with patch("uploader.validation.HEAD_SIZE", 100):
+        assert _schema(s3, "data.json", body) is None
+
+
+def test_file_schema_ndjson(s3):
+    body = b'{"id": 1, "name": "foo"}\n' * 100
+
+    with patch("uploader.validation.HEAD_SIZE", 100):
+        schema = _schema(s3, "data.jsonl", body)
+
+    assert schema == {"id": pa.int64(), "name": pa.string()}
+
+
+def test_file_schema_ndjson_temporal(s3):
+    body = b'{"date": "2024-05-01", "time": "2024-05-01T12:00:00Z"}\n'
+
+    assert _schema(s3, "data.ndjson", body) == {
+        "date": pa.date64(),
+        "time": pa.timestamp("us", tz="UTC"),
+    }
+
+
+def test_file_schema_mixed_types(s3):
+    body = json.dumps([{"id": 1}, {"id": "foo"}]).encode()
+
+    assert _schema(s3, "data.json", body) == {"id": None}
+
+
+def test_file_schema_parquet(s3):
+    table = pa.table(
+        {
+            "id": pa.array([1, 2], pa.int32()),
+            "date": ["2020-01-01", "2020-02-01"],
+            "name": ["foo", "bar"],
+        }
+    )
+
+    assert _schema(s3, "data.parquet", _parquet(table)) == {
+        "id": pa.int32(),
+        "date": pa.date64(),
+        "name": pa.string(),
+    }
+
+
+def test_file_schema_parquet_large_footer(s3):
+    table = pa.table({f"column_{i}": [i] for i in range(100)})
+    body = _parquet(table)
+
+    with patch("uploader.validation.FOOTER_SIZE", 100):
+        schema = _schema(s3, "data.parquet", body)
+
+    assert schema == {f"column_{i}": pa.int64() for i in range(100)}
+    _s3, get_object = s3
+    # The end of the file, then the rest of the footer.
+    assert get_object.call_count == 2
+
+
+def test_file_schema_unreadable(s3):
+    with pytest.raises(UnreadableFileError):
+        _schema(s3, "data.parquet", b"not parquet at all")
+
+
+@pytest.mark.parametrize("key", ["data.csv", "data.json", "data.parquet"])
+def test_file_schema_empty(s3, key):
+    with pytest.raises(UnreadableFileError):
+        _schema(s3, key, b"")
+
+    # S3 rejects ranges of empty files.
+    _s3, get_object = s3
+    get_object.assert_not_called()
+
+
+def test_file_schema_parquet_corrupt_footer(s3):
+    # The footer claims more metadata than the whole file holds.
+    body = PARQUET_MAGIC + b"\0" * 10 + struct.pack("<I", 1000) + PARQUET_MAGIC
+
+    with pytest.raises(UnreadableFileError):
+        _schema(s3, "data.parquet", body)
+
+    # No range before the start of the file was asked for.
+    _s3, get_object = s3
+    get_object.assert_called_once()
+
+
+def test_dataset_schema(temp_dir):
+    write_deltalake(temp_dir, [{"id": 1, "name": "foo"}])
+
+    assert dataset_schema(temp_dir) == {"id": pa.int64(), "name": pa.string()}
+
+
+def test_dataset_schema_no_table(temp_dir):
+    assert dataset_schema(temp_dir) is None
+
+
+def test_schema_mismatches():
+    file_types = {
+        "id": pa.int32(),
+        "value": pa.int64(),
+        "date": pa.date64(),
+        "time": pa.timestamp("s"),
+        "name": pa.int64(),
+        "mixed": None,
+        "new": pa.string(),
+    }
+    dataset_types = {
+        "id": pa.int64(),
+        "value": pa.float64(),
+        "date": pa.date32(),
+        "time": pa.timestamp("us", tz="UTC"),
+        "name": pa.string(),
+        "mixed": pa.string(),
+    }
+
+    assert schema_mismatches(file_types, dataset_types) == [
+        {"column": "name", "type": "int64", "expected": "string"},
+        {"column": "mixed", "type": "mixed", "expected": "string"},
+    ]
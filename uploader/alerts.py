@@ -1,11 +1,56 @@
+"""Alerting of dataset subscribers about new columns.
+
+Alerts are put on a queue by `alert_if_new_columns`, so that writing a
+dataset never waits on (or fails because of) the email API. They're sent by
+`uploader.handlers.handle_alert_queue`, which merges the alerts for a
+dataset within a batch into a single digest email by `send_alert_digest`.
+"""
+
+import functools
+import json
 import os
+import time
+from datetime import datetime, timezone
 
 import boto3
 import requests
-from okdata.aws.ssm import get_secret
+from botocore.client import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
+from okdata.aws.logging import log_add, log_duration, log_exception
 from requests.exceptions import HTTPError
 
 from uploader.errors import AlertEmailError
+from uploader.secrets import get_secret
+
+# Seconds to cache the subscribers of a dataset.
+SUBSCRIPTIONS_TTL = 300
+
+_subscriptions = {}
+
+
+@functools.cache
+def _sqs_client():
+    # Rather lose an alert than keep the writer waiting on a struggling queue.
+    return boto3.client(
+        "sqs",
+        region_name=os.environ["AWS_REGION"],
+        config=BotoConfig(
+            connect_timeout=1, read_timeout=2, retries={"max_attempts": 2}
+        ),
+    )
+
+
+@functools.cache
+def _queue_url():
+    return _sqs_client().get_queue_url(QueueName=os.environ["ALERT_QUEUE_NAME"])[
+        "QueueUrl"
+    ]
+
+
+@functools.cache
+def _subscriptions_table():
+    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
+    return dynamodb.Table("dataset-subscriptions")
 
 
 def _send_email(to_emails, body):
@@ -32,26 +77,65 @@ def _send_email(to_emails, body):
     return res
 
 
+def _subscribers(dataset_id):
+    """Return the subscribers to `dataset_id`, cached for a while."""
+    cached = _subscriptions.get(dataset_id)
+    if cached and time.monotonic() - cached[1] <= SUBSCRIPTIONS_TTL:
+        return cached[0]
+
+    item = _subscriptions_table().get_item(Key={"DatasetId": dataset_id}).get("Item")
+    subscribers = item["Subscribers"] if item else []
+
+    _subscriptions[dataset_id] = (subscribers, time.monotonic())
+    return subscribers
+
+
 def alert_if_new_columns(dataset_id, new_columns):
-    """Alert subscribers to `dataset_id` about `new_columns`.
+    """Queue an alert to subscribers to `dataset_id` about `new_columns`.
 
-    Raise `AlertEmailError` if sending the alert email fails.
+    The alert is sent asynchronously; if queueing it fails, the error is
+    logged and the alert lost.
     """
     if not new_columns:
         return
 
-    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
-    subscriptions_table = dynamodb.Table("dataset-subscriptions")
+    try:
+        log_duration(
+            lambda: _sqs_client().send_message(
+                QueueUrl=_queue_url(),
+                MessageBody=json.dumps(
+                    {
+                        "dataset_id": dataset_id,
+                        "new_columns": sorted(new_columns),
+                        "detected_at": datetime.now(timezone.utc).isoformat(),
+                    }
+                ),
+            ),
+            "duration_queue_alert",
+        )
+        log_add(alert_queued=True)
+    except (BotoCoreError, ClientError) as e:
+        log_exception(e)
 
-    subscriptions_entry = subscriptions_table.get_item(Key={"DatasetId": dataset_id})
 
-    if item := subscriptions_entry.get("Item"):
-        multi = len(new_columns) > 1
+def send_alert_digest(dataset_id, new_columns):
+    """Alert subscribers to `dataset_id` about `new_columns` in one email.
 
-        text = "{} har blitt lagt til datasettet '{}':\n{}".format(
-            "Nye kolonner" if multi else "En ny kolonne",
-            dataset_id,
-            "\n".join(f"- {c}" for c in sorted(new_columns)),
-        )
+    Return whether there were any subscribers to alert. Raise
+    `AlertEmailError` if sending the alert email fails.
+    """
+    subscribers = _subscribers(dataset_id)
+
+    if not subscribers:
+        return False
+
+    multi = len(new_columns) > 1
+
+    text = "{} har blitt lagt til datasettet '{}':\n{}".format(
+        "Nye kolonner" if multi else "En ny kolonne",
+        dataset_id,
+        "\n".join(f"- {c}" for c in sorted(new_columns)),
+    )
 
-        _send_email(item["Subscribers"], text)
+    _send_email(subscribers, text)
+    return True
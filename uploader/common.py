@@ -1,4 +1,3 @@
-import boto3
 import functools
 import json
 import os
@@ -6,9 +5,7 @@ import requests
 import uuid
 from datetime import datetime
 
-from botocore.client import Config as BotoConfig
 from okdata.aws.logging import log_duration
-from okdata.aws.ssm import get_secret
 from okdata.sdk.config import Config
 
 from uploader.errors import (
@@ -17,9 +14,30 @@ from uploader.errors import (
     InvalidDatasetEditionError,
     InvalidSourceTypeError,
 )
+from uploader.presign import generate_presigned_post
+from uploader.secrets import get_secret
 
 BASE_URL = os.environ["METADATA_API_URL"]
-STATUS_API_URL = os.environ["STATUS_API_URL"]
+
+# Files uploaded before their edition exists are kept here until it's
+# created, see `uploader.handlers.handle_staged_upload`.
+STAGING_PREFIX = "staging"
+
+# A staged file is claimed by creating a marker object under this prefix
+# before its edition is created, so that only one of several notifications of
+# the same file creates one. Outside the staging area, so that the markers
+# don't trigger anything.
+STAGING_CLAIMS_PREFIX = "staging-claims"
+
+# Uploaded files are tagged with the ID of their status trace in this S3
+# object metadata field, see `uploader.handlers.validate_upload`.
+TRACE_ID_METADATA = "trace-id"
+
+# The raw files written to each edition of an event dataset, see
+# `uploader.dataset`.
+RAW_EVENTS_JSON = "data.json"
+RAW_EVENTS_IPC = "data.arrows"
+RAW_DELETES = "deletes.json"
 
 CONFIDENTIALITY_MAP = {
     "public": "green",
@@ -58,21 +76,73 @@ def generate_s3_path(
     return "/".join(path)
 
 
-def generate_signed_post(bucket, key):
-    # Path adressing style (which needs region specified) used because CORS doesn't propagate on global URIs immediately
-    s3 = boto3.client(
-        "s3",
-        region_name=os.environ["AWS_REGION"],
-        config=BotoConfig(signature_version="s3v4", s3={"addressing_style": "path"}),
-    )
+def split_s3_path(s3_path):
+    """Extract dataset ID, version, edition and filename from `s3_path`.
+
+    `s3_path` is a key as generated by `generate_s3_path`. The filename is
+    `None` if the key is that of an edition. Raise `ValueError` if `s3_path`
+    doesn't look like such a key.
+    """
+    parts = s3_path.split("/")
+
+    for i, part in enumerate(parts[2:-1], start=2):
+        if part.startswith("version="):
+            edition = parts[i + 1]
+            if edition != "latest" and not edition.startswith("edition="):
+                break
+            return (
+                parts[i - 1],
+                part.removeprefix("version="),
+                edition.removeprefix("edition="),
+                "/".join(parts[i + 2 :]) or None,
+            )
+
+    raise ValueError(f"Not a dataset key: {s3_path}")
+
+
+def generate_staging_path(dataset_id, version, upload_id, filename):
+    """Return the key to stage `filename` at until its edition is created.
+
+    Everything needed to move the file into place later is kept in the key.
+    """
+    return f"{STAGING_PREFIX}/{dataset_id}/version={version}/{upload_id}/{filename}"
+
+
+def split_staging_path(key):
+    """Extract dataset ID, version, upload ID and filename from staged `key`.
+
+    Raise `ValueError` if `key` isn't a staging key.
+    """
+    try:
+        prefix, dataset_id, version, upload_id, filename = key.split("/", 4)
+    except ValueError:
+        raise ValueError(f"Not a staging key: {key}")
+
+    if prefix != STAGING_PREFIX or not version.startswith("version="):
+        raise ValueError(f"Not a staging key: {key}")
+
+    return dataset_id, version.removeprefix("version="), upload_id, filename
+
 
+def generate_signed_post(bucket, key, fields=None, conditions=None, metadata=None):
+    """Return a presigned POST for uploading `key` to `bucket`.
+
+    `fields` and `conditions` are added to the form fields and policy
+    conditions respectively, e.g. to restrict the content length or type.
+    `metadata` is S3 object metadata the uploaded file must be stored with.
+    """
     # TODO: Add more conditions!
-    fields = {"acl": "private"}
-    conditions = [{"acl": "private"}]
+    metadata_fields = {f"x-amz-meta-{k}": v for k, v in (metadata or {}).items()}
+    fields = {"acl": "private", **metadata_fields, **(fields or {})}
+    conditions = [
+        {"acl": "private"},
+        *({k: v} for k, v in metadata_fields.items()),
+        *(conditions or []),
+    ]
 
     presigned_post = log_duration(
-        lambda: s3.generate_presigned_post(
-            bucket, key, Fields=fields, Conditions=conditions, ExpiresIn=300
+        lambda: generate_presigned_post(
+            bucket, key, fields=fields, conditions=conditions, expires_in=300
         ),
         "duration_generate_presigned_post",
     )
@@ -84,17 +154,6 @@ def generate_uuid(s3path, dataset_id):
     return f"{dataset_id}-{new_uuid}"[0:80]
 
 
-def create_status_trace(token, status_data):
-    response = requests.post(
-        STATUS_API_URL,
-        json.dumps(status_data),
-        headers={
-            "Authorization": f"Bearer {token}",
-        },
-    )
-    return response.json()
-
-
 def error_response(status, message):
     return {
         "isBase64Encoded": False,
@@ -206,8 +265,17 @@ def split_edition_id(edition_id):
 
 
 @functools.cache
+def _sdk_config():
+    return Config()
+
+
 def sdk_config():
-    config = Config()
+    """Return the SDK configuration, with the current Keycloak client secret.
+
+    The same configuration object is returned every time, updated in place,
+    so that holders of it (like `status_wrapper`) pick up rotated secrets too.
+    """
+    config = _sdk_config()
     config.config["client_secret"] = get_secret(
         "/dataplatform/data-uploader/keycloak-client-secret"
     )
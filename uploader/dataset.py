@@ -1,29 +1,170 @@
 import json
 import logging
 import os
+from urllib.parse import unquote
 
 import awswrangler as wr
 import boto3
+import numpy as np
 import pandas as pd
+import deltalake as dl
 import pyarrow as pa
-from deltalake.exceptions import TableNotFoundError
-from okdata.aws.logging import log_add, log_duration, log_exception
+import pyarrow.compute as pc
+from deltalake.exceptions import CommitFailedError, DeltaError, TableNotFoundError
+from okdata.aws.logging import log_add, log_exception
+from okdata.aws.status import status_add
 from okdata.sdk.data.dataset import Dataset
 
 from uploader.alerts import alert_if_new_columns
-from uploader.common import generate_s3_path, sdk_config
-from uploader.errors import AlertEmailError, InvalidTypeError, MissingMergeColumnsError
+from uploader.common import (
+    RAW_DELETES,
+    RAW_EVENTS_IPC,
+    RAW_EVENTS_JSON,
+    generate_s3_path,
+    sdk_config,
+)
+from uploader.encoding import compact, fillna, restore, writer_properties
+from uploader.errors import (
+    ConcurrentWriteError,
+    DatasetTooLargeError,
+    InvalidTypeError,
+    MissingMergeColumnsError,
+    PartitionChangedError,
+)
+from uploader.formats import write_ipc
+from uploader.inference import dataframe_from_dict
+from uploader.partitioning import (
+    add_partition_columns,
+    derive_partition,
+    partition_filter,
+    partition_names,
+    partition_predicate,
+    partition_spec,
+    table_partitions,
+)
+from uploader.planner import (
+    CHUNKED,
+    EVENTS_EXPANSION,
+    REJECTED,
+    plan,
+)
+from uploader.predicates import keys_filter, keys_predicate
+from uploader.profiling import max_rss_bytes, memory_usage, profile, stage
+from uploader.storage import open_table, storage_options
+from uploader.snapshots import snapshot
 
 logger = logging.getLogger()
 logger.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
 
+# Hours that files replaced in `latest` are kept for readers of its older
+# versions before being vacuumed.
+VACUUM_RETENTION_HOURS = 6
 
-def handle_events(dataset, version, merge_on, source_s3_path, events):
+# Vacuum `latest` on every this many versions of it.
+VACUUM_INTERVAL = 10
+
+# Times to merge the events into `latest` again when another write committed
+# to it first.
+COMMIT_RETRIES = 5
+
+# Predicate overwriting a whole Delta table. Unlike a plain overwrite, one
+# with a predicate is checked for conflicts with concurrent writes.
+OVERWRITE_ALL = "true"
+
+# Strategies for deduplicating events sharing a key, see `deduplicate`.
+FIRST = "first"
+LAST = "last"
+COALESCE = "coalesce"
+
+
+def handle_events(
+    dataset, version, merge_on, source_s3_path, events, deletes=[], dedup=LAST
+):
+    """Add `events` to the dataset, delete the rows keyed by `deletes`.
+
+    The result is written to `latest` at `source_s3_path` and to a new
+    edition, whose ID is returned. `deletes` are objects with a value for
+    each of the `merge_on` columns, and are applied after the events have
+    been added. Events sharing a key are deduplicated by the `dedup`
+    strategy first (see `deduplicate`). Return `None` if there's nothing to
+    do, i.e. only deletes for a dataset that doesn't exist yet.
+    """
     dataset_id = dataset["Id"]
 
-    merged_data, new_columns = add_to_dataset(source_s3_path, events, merge_on)
+    with profile(dataset_id=dataset_id):
+        return _handle_events(
+            dataset, version, merge_on, source_s3_path, events, deletes, dedup
+        )
+
+
+def _handle_events(dataset, version, merge_on, source_s3_path, events, deletes, dedup):
+    dataset_id = dataset["Id"]
+    new_columns = set()
+
+    if isinstance(events, pa.Table):
+        # Columnar events take up about as much memory as their IPC stream.
+        raw_data, raw_filename, expansion = write_ipc(events), RAW_EVENTS_IPC, 1
+    else:
+        raw_data, raw_filename, expansion = (
+            json.dumps(events),
+            RAW_EVENTS_JSON,
+            EVENTS_EXPANSION,
+        )
+
+    _validate_deletes(deletes, merge_on)
+
+    # The log of `latest` is read once, and only caught up with from then on.
+    latest = open_table(source_s3_path)
+
+    if events:
+        with stage("plan") as metrics:
+            memory_plan = plan(latest, len(raw_data), merge_on, expansion)
+            metrics.update(
+                rows=memory_plan["rows"], bytes=memory_plan["estimated_bytes"]
+            )
+
+        log_add(memory_plan=memory_plan)
+
+        if memory_plan["strategy"] == REJECTED:
+            raise DatasetTooLargeError(
+                f"Adding the events to dataset {dataset_id} would need about "
+                f"{memory_plan['estimated_bytes'] // 2**20} MiB of memory, but "
+                f"only {memory_plan['available_bytes'] // 2**20} MiB is available"
+            )
+
+        partition_by = partition_spec(dataset)
+        names = partition_names(partition_by)
+        # Until the dataset is partitioned the way it's supposed to be (e.g.
+        # before the first write after its partitioning changed), the whole
+        # dataset is rewritten.
+        scoped = bool(names) and table_partitions(latest) == names
+
+        log_add(partition_by=names, partition_scoped=scoped)
+
+        chunked = memory_plan["strategy"] == CHUNKED
+        table_version = None if latest is None else latest.version()
+        merged, new_columns, scoped = _merge_events(
+            source_s3_path,
+            events,
+            merge_on,
+            partition_by,
+            scoped,
+            dedup,
+            chunked,
+            table_version,
+            # Deletes may change the dataset regardless.
+            skip_unchanged=not deletes,
+        )
+        if merged is None:
+            return _unchanged_edition(dataset, version)
+    elif latest is None:
+        log_add(deleted_rows=0)
+        return None
+
     sdk = Dataset(sdk_config())
-    edition = sdk.auto_create_edition(dataset_id, version)
+
+    with stage("edition"):
+        edition = sdk.auto_create_edition(dataset_id, version)
 
     target_s3_path_processed = generate_s3_path(
         dataset, edition["Id"], "processed", absolute=True
@@ -36,63 +177,468 @@ def handle_events(dataset, version, merge_on, source_s3_path, events):
     )
 
     # Write the raw input data
-    s3 = boto3.client("s3", region_name=os.environ["AWS_REGION"])
-    s3.put_object(
-        Body=json.dumps(events),
-        Bucket=os.environ["BUCKET"],
-        Key=f"{target_s3_path_raw}/data.json",
-    )
+    with stage("write_raw") as metrics:
+        s3 = boto3.client("s3", region_name=os.environ["AWS_REGION"])
+        s3.put_object(
+            Body=raw_data,
+            Bucket=os.environ["BUCKET"],
+            Key=f"{target_s3_path_raw}/{raw_filename}",
+        )
+        metrics.update(rows=len(events), bytes=len(raw_data))
+        if deletes:
+            s3.put_object(
+                Body=json.dumps(deletes),
+                Bucket=os.environ["BUCKET"],
+                Key=f"{target_s3_path_raw}/{RAW_DELETES}",
+            )
 
-    # Clean out any existing data in `latest`
-    log_duration(
-        lambda: wr.s3.delete_objects(source_s3_path), "delete_objects_duration"
-    )
+    # Writers don't lock `latest`. Instead, committing to it fails if another
+    # write committed to it since it was read (to any of the same partitions,
+    # when scoped), and the events are merged into it again.
+    if events:
+        for retries in range(COMMIT_RETRIES + 1):
+            try:
+                if chunked:
+                    _write_chunked(
+                        merged, source_s3_path, target_s3_path_processed, latest
+                    )
+                else:
+                    _write_in_memory(
+                        merged,
+                        source_s3_path,
+                        target_s3_path_processed,
+                        partition_by,
+                        scoped,
+                        latest,
+                        merge_on,
+                    )
+                break
+            except CommitFailedError as e:
+                _on_conflict(source_s3_path, retries, e)
 
-    # Write merged data to both the new edition and to `latest`
-    for i, path in enumerate([target_s3_path_processed, source_s3_path]):
-        logger.info(f"Writing the merged data to {path}...")
-        log_duration(
-            lambda: wr.s3.to_deltalake(
-                df=merged_data,
-                path=path,
-                mode="overwrite",
-                schema_mode="merge",
-                s3_allow_unsafe_rename=True,
-            ),
-            f"to_deltalake_{i}_duration",
+            # When scoped, only the partitions among the events are read again.
+            latest = _catch_up(latest, source_s3_path)
+            table_version = None if latest is None else latest.version()
+            merged, new_columns, scoped = _merge_events(
+                source_s3_path,
+                events,
+                merge_on,
+                partition_by,
+                scoped,
+                dedup,
+                chunked,
+                table_version,
+            )
+
+    if deletes:
+        with stage("delete_rows") as metrics:
+            for retries in range(COMMIT_RETRIES + 1):
+                try:
+                    deleted_keys, deleted_rows = delete_from_dataset(
+                        source_s3_path, deletes, merge_on
+                    )
+                    break
+                except CommitFailedError as e:
+                    _on_conflict(source_s3_path, retries, e)
+            if events:
+                # The edition was written along with `latest`.
+                delete_from_dataset(target_s3_path_processed, deletes, merge_on)
+            metrics["rows"] = deleted_rows
+
+        if not events:
+            _copy_table(
+                "write_edition",
+                source_s3_path,
+                target_s3_path_processed,
+                merge_on=merge_on,
+            )
+
+        log_add(deleted_rows=deleted_rows, deleted_key_count=len(deleted_keys))
+        status_add(
+            status_body={"deletedKeys": deleted_keys, "deletedRows": deleted_rows}
         )
-        logger.info("...done")
+
+    vacuum(source_s3_path)
+
+    with stage("files") as metrics:
+        filenames = data_files(target_s3_path_processed)
+        metrics["rows"] = len(filenames)
+
+    log_add(memory_peak_bytes=max_rss_bytes())
 
     # Create new distribution
     edition_id = edition["Id"]
     log_add(edition_id=edition_id)
 
-    distribution = sdk.create_distribution(
-        dataset_id,
-        version,
-        edition_id.split("/")[2],
-        data={
-            "distribution_type": "file",
-            "content_type": "application/vnd.apache.parquet",
-            "filenames": [
-                obj.removeprefix(f"{target_s3_path_processed}/")
-                for obj in wr.s3.list_objects(target_s3_path_processed)
-            ],
-        },
-        retries=3,
-    )
+    with stage("distribution"):
+        distribution = sdk.create_distribution(
+            dataset_id,
+            version,
+            edition_id.split("/")[2],
+            data={
+                "distribution_type": "file",
+                "content_type": "application/vnd.apache.parquet",
+                "filenames": filenames,
+            },
+            retries=3,
+        )
 
     log_add(distribution_id=distribution["Id"])
 
-    try:
+    with stage("alert"):
         alert_if_new_columns(dataset_id, new_columns)
-    except AlertEmailError as e:
-        log_exception(e)
 
     return edition["Id"]
 
 
-def add_to_dataset(s3_path, data, merge_on=[]):
+def _merge_events(
+    source_s3_path,
+    events,
+    merge_on,
+    partition_by,
+    scoped,
+    dedup,
+    chunked,
+    table_version,
+    skip_unchanged=False,
+):
+    # Merge `events` into `latest` as of `table_version`, returning what to
+    # write (see `_write_chunked` and `_write_in_memory`), the new columns,
+    # and whether only the partitions among the events are to be written.
+    if chunked:
+        prepared = prepare_chunked_add(
+            source_s3_path, events, merge_on, partition_by, dedup, table_version
+        )
+        return prepared, prepared["new_columns"], scoped
+
+    if scoped:
+        try:
+            merged, new_columns = add_to_dataset(
+                source_s3_path,
+                events,
+                merge_on,
+                partition_by,
+                scoped=True,
+                skip_unchanged=skip_unchanged,
+                dedup=dedup,
+                table_version=table_version,
+            )
+            if merged is None:
+                # Nothing changed, so there's nothing to write either.
+                return None, new_columns, True
+            # Only partitions whose values can be put in SQL can be replaced.
+            partition_predicate(merged, partition_names(partition_by))
+            return merged, new_columns, True
+        except (PartitionChangedError, InvalidTypeError) as e:
+            # Rows moving between partitions must be removed from their old
+            # one, and partitions with values SQL can't express can't be
+            # replaced on their own, so the whole dataset is rewritten instead.
+            logger.info(f"Rewriting the whole dataset: {e}")
+            log_add(partition_scoped=False)
+
+    merged, new_columns = add_to_dataset(
+        source_s3_path,
+        events,
+        merge_on,
+        partition_by,
+        skip_unchanged=skip_unchanged,
+        dedup=dedup,
+        table_version=table_version,
+    )
+    return merged, new_columns, False
+
+
+def _on_conflict(s3_path, retries, e):
+    # Note that a commit to `s3_path` conflicted with another write, giving
+    # up if it has been retried `COMMIT_RETRIES` times already.
+    log_add(commit_conflicts=retries + 1)
+
+    if retries == COMMIT_RETRIES:
+        raise ConcurrentWriteError(
+            f"Writing to {s3_path} conflicted with other writes {retries + 1} "
+            "times in a row"
+        ) from e
+
+    logger.info(f"Writing to {s3_path} conflicted with another write: {e}")
+
+
+def _unchanged_edition(dataset, version):
+    # Skip writing anything when the events wouldn't change the dataset,
+    # and return the current edition instead.
+    edition_id = Dataset(sdk_config()).get_latest_edition(
+        dataset["Id"], version, retries=3
+    )["Id"]
+    log_add(unchanged=True, edition_id=edition_id)
+    status_add(status_body={"unchanged": True, "editionId": edition_id})
+    return edition_id
+
+
+def _write_in_memory(
+    merged_data,
+    source_s3_path,
+    target_s3_path,
+    partition_by=[],
+    scoped=False,
+    latest=None,
+    merge_on=[],
+):
+    # `latest` (the Delta table at `source_s3_path` as of the version the
+    # data was merged into, or `None` if there was none) is written first,
+    # failing with `CommitFailedError` if another write committed to it since,
+    # before anything is written to the new edition.
+    names = partition_names(partition_by)
+
+    if scoped:
+        # Replace only the partitions that were read in `latest`, then copy
+        # the result to the new edition. Writes to other partitions don't
+        # conflict with this one.
+        logger.info(f"Writing the merged partitions to {source_s3_path}...")
+        with stage("write_latest") as metrics:
+            table = pa.Table.from_pandas(merged_data, preserve_index=False)
+            dl.write_deltalake(
+                latest,
+                table,
+                mode="overwrite",
+                schema_mode="merge",
+                partition_by=names,
+                predicate=partition_predicate(merged_data, names),
+                storage_options=storage_options(),
+                writer_properties=writer_properties(table.schema, merge_on),
+            )
+            metrics.update(rows=len(merged_data), bytes=memory_usage(merged_data))
+        logger.info("...done")
+
+        # Committing brought `latest` up to date with the write.
+        _copy_table(
+            "write_edition",
+            source_s3_path,
+            target_s3_path,
+            merge_on=merge_on,
+            source_table=latest,
+        )
+        return
+
+    table = pa.Table.from_pandas(merged_data, preserve_index=False)
+    properties = writer_properties(table.schema, merge_on)
+
+    if _clear_if_repartitioned(latest, source_s3_path, names):
+        latest = None
+
+    logger.info(f"Writing the merged data to {source_s3_path}...")
+    with stage("write_latest") as metrics:
+        dl.write_deltalake(
+            _commit_target(latest, source_s3_path),
+            table,
+            mode="overwrite",
+            schema_mode="overwrite",
+            partition_by=names or None,
+            predicate=None if latest is None else OVERWRITE_ALL,
+            storage_options=storage_options(),
+            writer_properties=properties,
+        )
+        metrics.update(rows=len(merged_data), bytes=memory_usage(merged_data))
+    logger.info("...done")
+
+    logger.info(f"Writing the merged data to {target_s3_path}...")
+    with stage("write_edition") as metrics:
+        dl.write_deltalake(
+            target_s3_path,
+            table,
+            mode="overwrite",
+            partition_by=names or None,
+            storage_options=storage_options(),
+            writer_properties=properties,
+        )
+        metrics.update(rows=len(merged_data), bytes=memory_usage(merged_data))
+    logger.info("...done")
+
+
+def _write_chunked(prepared, source_s3_path, target_s3_path, latest=None):
+    # `latest` is the source of the new edition, so write the edition first
+    # and then copy it back to `latest`, through the table as of the version
+    # it was read from.
+    logger.info(f"Writing the merged data to {target_s3_path} in chunks...")
+    with stage("write_edition") as metrics:
+        metrics["rows"] = write_chunked_add(prepared, target_s3_path)
+    logger.info("...done")
+
+    if _clear_if_repartitioned(
+        latest, source_s3_path, partition_names(prepared["partition_by"])
+    ):
+        latest = None
+
+    _copy_table(
+        "write_latest",
+        target_s3_path,
+        source_s3_path,
+        latest,
+        prepared["merge_on"],
+    )
+
+
+def _catch_up(table, s3_path):
+    # Return the Delta table at `s3_path` as of its latest version, given
+    # `table`, the same table as of an earlier version (or `None` if there
+    # was none). Only the commits since are read.
+    if table is None:
+        return open_table(s3_path)
+    table.update_incremental()
+    return table
+
+
+def _commit_target(table, s3_path):
+    # What to commit to the Delta table at `s3_path` through: `table`, so
+    # that committing fails with `CommitFailedError` if it conflicts with
+    # another write since the version it was loaded at, or the path if the
+    # table is new.
+    return s3_path if table is None else table
+
+
+def _clear_if_repartitioned(table, s3_path, partition_by):
+    # `latest` is replaced in a single overwrite commit, so that readers
+    # always see a consistent version of it, and the files it no longer uses
+    # are removed by `vacuum` later. Delta can't change the partitioning of
+    # a table in an overwrite though, so a table being repartitioned is
+    # cleared out first. Return whether it was.
+    partitions = table_partitions(table)
+    if partitions is None or partitions == partition_by:
+        return False
+
+    with stage("delete"):
+        wr.s3.delete_objects(s3_path)
+    return True
+
+
+def _copy_table(
+    stage_name,
+    source_s3_path,
+    target_s3_path,
+    target_table=None,
+    merge_on=[],
+    source_table=None,
+):
+    # Stream the Delta table at `source_s3_path` (`source_table`, if already
+    # loaded as of its latest version) to `target_s3_path`, keeping its
+    # partitioning (and encoding its columns like any other write). An
+    # existing table at `target_s3_path` is replaced in a single commit,
+    # schema and all, through `target_table` (see `_commit_target`).
+    logger.info(f"Copying {source_s3_path} to {target_s3_path}...")
+    with stage(stage_name) as metrics:
+        options = storage_options()
+        source = source_table or dl.DeltaTable(source_s3_path, storage_options=options)
+        reader = (
+            source.to_pyarrow_dataset()
+            .scanner(batch_readahead=1, fragment_readahead=1)
+            .to_reader()
+        )
+        dl.write_deltalake(
+            _commit_target(target_table, target_s3_path),
+            reader,
+            mode="overwrite",
+            schema_mode="overwrite",
+            partition_by=source.metadata().partition_columns or None,
+            predicate=None if target_table is None else OVERWRITE_ALL,
+            storage_options=options,
+            writer_properties=writer_properties(reader.schema, merge_on),
+        )
+        metrics["rows"] = source.count()
+    logger.info("...done")
+
+
+def vacuum(s3_path):
+    """Remove the files replaced in the Delta table at `s3_path` a while ago.
+
+    Runs on every `VACUUM_INTERVAL` versions of the table, removing the
+    files it stopped using more than `VACUUM_RETENTION_HOURS` ago. The files
+    to remove are taken from the Delta log, so the (ever growing) prefix is
+    never listed. Failing to vacuum is logged, but not raised; the files are
+    picked up by the next vacuum instead.
+    """
+    try:
+        table = dl.DeltaTable(s3_path, storage_options=storage_options())
+        if table.version() % VACUUM_INTERVAL:
+            return
+
+        with stage("vacuum") as metrics:
+            removed = table.vacuum(
+                retention_hours=VACUUM_RETENTION_HOURS,
+                dry_run=False,
+                enforce_retention_duration=False,
+                full=False,
+            )
+            metrics["rows"] = len(removed)
+    except DeltaError as e:
+        log_exception(e)
+        return
+
+    log_add(vacuumed_files=len(removed))
+
+
+def data_files(s3_path):
+    """Return the data files of the Delta table at `s3_path`.
+
+    The file names are taken from the add actions in the Delta log, relative
+    to `s3_path`, so the (ever growing) prefix is never listed and the log
+    itself isn't included. They're URL-encoded in the log (e.g. partition
+    values with spaces), and decoded here.
+    """
+    table = dl.DeltaTable(s3_path, storage_options=storage_options())
+    paths = pa.table(table.get_add_actions(flatten=True))["path"].to_pylist()
+    return [unquote(p) for p in paths]
+
+
+def _validate_deletes(deletes, merge_on):
+    if not deletes:
+        return
+    if not merge_on:
+        raise MissingMergeColumnsError("Deleting rows requires merge column(s)")
+    missing_columns = sorted({c for d in deletes for c in merge_on if c not in d})
+    if missing_columns:
+        raise MissingMergeColumnsError(
+            f"Missing ID column(s) in deletes: {missing_columns}"
+        )
+
+
+def delete_from_dataset(s3_path, deletes, merge_on):
+    """Delete the rows of the dataset at `s3_path` keyed by `deletes`.
+
+    `deletes` are objects with a value for each of the `merge_on` columns.
+    Only the files containing rows to delete are rewritten. Return the keys
+    that matched any rows, and the number of rows deleted.
+    """
+    table = dl.DeltaTable(s3_path, storage_options=storage_options())
+    schema = pa.schema(table.schema().to_arrow())
+
+    missing_columns = [c for c in merge_on if c not in schema.names]
+    if missing_columns:
+        raise MissingMergeColumnsError(f"Missing ID column(s): {missing_columns}")
+
+    try:
+        matched = table.to_pyarrow_dataset().to_table(
+            columns=merge_on, filter=keys_filter(deletes, merge_on)
+        )
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        raise InvalidTypeError("Invalid types detected in deletes")
+
+    if matched.num_rows:
+        table.delete(
+            keys_predicate(deletes, merge_on),
+            writer_properties=writer_properties(schema, merge_on),
+        )
+
+    return matched.group_by(merge_on).aggregate([]).to_pylist(), matched.num_rows
+
+
+def add_to_dataset(
+    s3_path,
+    data,
+    merge_on=[],
+    partition_by=[],
+    scoped=False,
+    skip_unchanged=False,
+    dedup=LAST,
+    table_version=None,
+):
     """Return the dataset found at `s3_path` with `data` added to it.
 
     Also return a set of new columns (if any) that weren't present in the
@@ -100,50 +646,103 @@ def add_to_dataset(s3_path, data, merge_on=[]):
 
     `merge_on` is a list of column names to optionally merge ("full join" in
     the SQL world) the data on. New data overrides old data on conflicting
-    rows.
+    rows. Rows in `data` sharing a key are deduplicated first, by the `dedup`
+    strategy (see `deduplicate`).
 
     If `merge_on` is empty, the new data is simply appended to the existing
     dataset.
+
+    `partition_by` is the partition specification of the dataset (see
+    `uploader.partitioning`), whose partition columns are added to the data.
+    If `scoped`, the dataset is already partitioned that way, and only the
+    partitions present in `data` are read (and returned). Rows must then
+    stay in their partition; raise `PartitionChangedError` if any of the
+    `merge_on` keys of `data` are found in other partitions.
+
+    If `skip_unchanged` and merging `data` wouldn't change the dataset (the
+    merged rows are all identical to the existing ones), return `None`
+    instead of the merged data.
+
+    String columns with few distinct values may be dictionary encoded in the
+    returned data (see `uploader.encoding`), but are written as strings.
+
+    The dataset is read as of `table_version` if given (through the local
+    snapshot cache when read whole, see `uploader.snapshots`), its latest
+    version otherwise.
     """
     # Create DataFrame with new data
     events = dataframe_from_dict(data)
 
+    if merge_on:
+        events = deduplicate(events, merge_on, dedup)
+
+    if partition_by:
+        events = add_partition_columns(events, partition_by)
+
     # Load existing dataset contents to DataFrame and add new objects. If the
     # dataset is empty, new data is written directly.
+    widths = {}
     try:
-        existing_dataset = log_duration(
-            lambda: wr.s3.read_deltalake(s3_path, dtype_backend="pyarrow"),
-            "read_deltalake_duration",
-        )
+        with stage("read") as metrics:
+            if scoped:
+                existing_dataset = _read_partitions(
+                    s3_path,
+                    partition_filter(events, partition_names(partition_by)),
+                    table_version,
+                    events[merge_on] if merge_on else None,
+                )
+            elif table_version is None:
+                existing_dataset = wr.s3.read_deltalake(
+                    s3_path, dtype_backend="pyarrow"
+                )
+            else:
+                existing_dataset = (
+                    snapshot(s3_path, table_version)
+                    .to_pyarrow_table()
+                    .to_pandas(types_mapper=pd.ArrowDtype)
+                )
+            metrics.update(
+                rows=len(existing_dataset), bytes=memory_usage(existing_dataset)
+            )
+
+        # Merge the data in compact encodings (see `uploader.encoding`).
+        with stage("compact") as metrics:
+            widths = compact(
+                existing_dataset, events, [*merge_on, *partition_names(partition_by)]
+            )
+            metrics.update(
+                rows=len(existing_dataset), bytes=memory_usage(existing_dataset)
+            )
 
         if merge_on:
-            try:
-                events.set_index(merge_on, inplace=True)
-                existing_dataset.set_index(merge_on, inplace=True)
-            except KeyError as e:
-                raise MissingMergeColumnsError(f"Missing ID column(s): {e}")
-            # A note on efficiency: Local tests suggest that this should scale
-            # well to at least tens of millions of rows.
-            try:
-                merged_data = log_duration(
-                    lambda: events.combine_first(existing_dataset),
-                    "dataset_combine_first_duration",
+            missing_columns = [c for c in merge_on if c not in existing_dataset]
+            if missing_columns:
+                raise MissingMergeColumnsError(
+                    f"Missing ID column(s): {missing_columns}"
+                )
+            with stage("merge") as metrics:
+                merged_data, inserted, updated = upsert(
+                    existing_dataset, events, merge_on
                 )
-            except ValueError:
-                raise InvalidTypeError("Mixed types detected")
-            # Turn the index back into ordinary columns
-            merged_data.reset_index(inplace=True)
-            existing_dataset.reset_index(inplace=True)
+                metrics["rows"] = len(merged_data)
+            log_add(inserted_rows=inserted, updated_rows=updated)
+            if skip_unchanged and not inserted and not updated:
+                return None, set()
         else:
-            merged_data = log_duration(
-                lambda: pd.concat([existing_dataset, events]), "dataset_concat_duration"
-            )
+            with stage("merge") as metrics:
+                merged_data = pd.concat([existing_dataset, events])
+                metrics["rows"] = len(merged_data)
     except TableNotFoundError:
         existing_dataset = None
         merged_data = events
 
     # Ensure that we have no index
     merged_data = merged_data.reset_index(drop=True)
+    restore(merged_data, widths)
+
+    if partition_by and not scoped:
+        # Partition any existing rows not partitioned yet too.
+        merged_data = add_partition_columns(merged_data, partition_by)
 
     # Ensure no columns contain mixed types
     mixed_columns = [c for c in merged_data if merged_data[c].dtype == "object"]
@@ -163,40 +762,337 @@ def add_to_dataset(s3_path, data, merge_on=[]):
     return merged_data, new_columns
 
 
-def dataframe_from_dict(data):
-    # Construct DataFrame from `data`. Drop empty columns and convert
-    # columns to the best possible dtypes using pyarrow.
-    df = pd.DataFrame.from_dict(data)
-    df = df.dropna(how="all", axis="columns")
-    df = df.convert_dtypes(dtype_backend="pyarrow")
-    df = df.apply(_infer_column_dtype_from_input)
-    return df
-
-
-def _infer_column_dtype_from_input(col):
-    recognized_datetime_formats = [
-        "%Y-%m-%dT%H:%M:%S",
-        "%Y-%m-%dT%H:%M:%SZ",
-        "%Y-%m-%dT%H:%M:%S%z",
-        "%Y-%m-%dT%H:%M:%S.%f",
-        "%Y-%m-%dT%H:%M:%S.%fZ",
-        "%Y-%m-%dT%H:%M:%S.%f%z",
+def _read_partitions(s3_path, expression, table_version=None, keys=None):
+    # Read the rows of the Delta table at `s3_path` matching `expression`,
+    # reading only the files of the matching partitions. If given `keys` (a
+    # frame of key columns), first make sure that no rows outside those
+    # partitions have any of them, raising `PartitionChangedError` otherwise.
+    dataset = dl.DeltaTable(
+        s3_path, version=table_version, storage_options=storage_options()
+    ).to_pyarrow_dataset()
+
+    if keys is not None:
+        columns = list(keys.columns)
+        # Rows in the null partition don't match `expression` either.
+        outside = ~pc.coalesce(expression, pc.scalar(False))
+        matches = keys_filter(
+            pa.Table.from_pandas(keys, preserve_index=False).to_pylist(), columns
+        )
+        moved = dataset.head(1, columns=columns, filter=outside & matches)
+        if moved.num_rows:
+            raise PartitionChangedError(
+                f"Events move rows keyed by {moved.to_pylist()[0]} (at least) "
+                "to other partitions"
+            )
+
+    return dataset.to_table(filter=expression).to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def deduplicate(events, merge_on, strategy=LAST):
+    """Return `events` with a single row per `merge_on` key.
+
+    Of the rows sharing a key, `FIRST` keeps the first and `LAST` the last
+    one. `COALESCE` keeps the last non-null value of each column, so that
+    later rows update earlier ones. Raise `MissingMergeColumnsError` if any
+    of the `merge_on` columns are missing.
+    """
+    missing_columns = [c for c in merge_on if c not in events]
+    if missing_columns:
+        raise MissingMergeColumnsError(f"Missing ID column(s): {missing_columns}")
+
+    with stage("dedup") as metrics:
+        if strategy == COALESCE:
+            deduplicated = (
+                events.groupby(merge_on, sort=False, dropna=False)
+                .last()
+                .reset_index()[events.columns]
+            )
+        else:
+            deduplicated = events.drop_duplicates(
+                subset=merge_on, keep=strategy
+            ).reset_index(drop=True)
+        metrics["rows"] = len(deduplicated)
+
+    log_add(duplicate_count=len(events) - len(deduplicated))
+    return deduplicated
+
+
+def upsert(existing, events, merge_on):
+    """Return `existing` with `events` merged into it on the `merge_on` keys.
+
+    Existing rows are updated with the non-null values of the event with the
+    same key, and events matching no row are added. This is what
+    `combine_first` of the events over the existing rows does with
+    `merge_on` as the index, column order and dtypes included, but without
+    aligning and sorting the union of the indexes: Existing rows keep their
+    order, followed by the new rows in the order of `events`.
+
+    The keys of `events` must be unique (see `deduplicate`). Also return the
+    number of rows added, and the number of existing rows changed. Raise
+    `InvalidTypeError` if the columns can't be merged.
+    """
+    try:
+        positions = _match_keys(existing, events, merge_on)
+    except (ValueError, TypeError):
+        raise InvalidTypeError("Mixed types detected")
+
+    matched = positions >= 0
+    added = np.ones(len(events), dtype=bool)
+    added[positions[matched]] = False
+    added_positions = np.flatnonzero(added)
+
+    # The keys first, followed by the rest of the columns in the order
+    # `combine_first` aligns them to.
+    columns = [
+        *merge_on,
+        *events.columns.drop(merge_on).union(existing.columns.drop(merge_on)),
     ]
+    merged = pd.DataFrame(
+        {
+            c: _upsert_column(existing, events, c, positions, added_positions)
+            for c in columns
+        }
+    )
 
-    # Detect columns containing date(time) values and attempt casting to relevant
-    # dtype. If it fails, keep existing string type.
-    if getattr(col.dtypes, "pyarrow_dtype", None) == "string":
-        try:
-            series = pd.to_datetime(col, format="%Y-%m-%d")
-            return series.astype(pd.ArrowDtype(pa.date64()))
-        except ValueError:
-            pass
+    return merged, len(added_positions), _changed_rows(existing, merged, matched)
 
-        for dt_format in recognized_datetime_formats:
-            try:
-                series = pd.to_datetime(col, format=dt_format, utc=True)
-                return series.astype(pd.ArrowDtype(pa.timestamp("us", tz="UTC")))
-            except ValueError:
-                pass
 
-    return col
+def _common_dtype(a, b):
+    # The dtype `a` and `b` are cast to when aligned.
+    if a.dtype == b.dtype:
+        return a.dtype
+    return pd.concat([a.iloc[:0], b.iloc[:0]]).dtype
+
+
+def _match_keys(existing, events, merge_on):
+    # Return the position of the event with the same key as each row of
+    # `existing`, -1 for rows with no such event. The rows are matched by a
+    # hash of their keys, falling back to comparing the keys themselves in
+    # the unlikely case of a collision.
+    existing_keys = existing[merge_on].reset_index(drop=True)
+    event_keys = events[merge_on].reset_index(drop=True)
+
+    for c in merge_on:
+        dtype = _common_dtype(existing_keys[c], event_keys[c])
+        existing_keys[c] = existing_keys[c].astype(dtype)
+        event_keys[c] = event_keys[c].astype(dtype)
+
+    event_hashes = pd.Index(pd.util.hash_pandas_object(event_keys, index=False))
+
+    if event_hashes.is_unique:
+        positions = event_hashes.get_indexer(
+            pd.util.hash_pandas_object(existing_keys, index=False)
+        )
+        matched = positions >= 0
+        if all(
+            _same_values(
+                existing_keys[c][matched], event_keys[c].take(positions[matched])
+            )
+            for c in merge_on
+        ):
+            return positions
+
+    return pd.MultiIndex.from_frame(event_keys).get_indexer(
+        pd.MultiIndex.from_frame(existing_keys)
+    )
+
+
+def _same_values(a, b):
+    a = a.reset_index(drop=True)
+    b = b.reset_index(drop=True)
+    both_missing = a.isna().to_numpy() & b.isna().to_numpy()
+    equal = (a == b).fillna(False).to_numpy(dtype=bool)
+    return bool(np.all(equal | both_missing))
+
+
+def _upsert_column(existing, events, column, positions, added_positions):
+    # Return `column` of the rows of `existing`, updated by the events at
+    # `positions`, followed by the events at `added_positions`.
+    if column not in events:
+        values = existing[column].array
+        return _concat(
+            values, values.take(np.full(len(added_positions), -1), allow_fill=True)
+        )
+
+    if column not in existing:
+        values = events[column].array
+        return _concat(
+            values.take(positions, allow_fill=True), values.take(added_positions)
+        )
+
+    dtype = _common_dtype(existing[column], events[column])
+    old = pd.Series(existing[column].array).astype(dtype)
+    new = pd.Series(events[column].array).astype(dtype).array
+    updated = fillna(pd.Series(new.take(positions, allow_fill=True)), old)
+
+    return _concat(updated.array, new.take(added_positions))
+
+
+def _concat(top, bottom):
+    return pd.concat([pd.Series(top), pd.Series(bottom)], ignore_index=True)
+
+
+def _changed_rows(existing, merged, matched):
+    # Return the number of rows of `existing` that are different in the first
+    # rows of `merged`, which are the same rows after merging. Only the rows
+    # at `matched` can differ in value, but all differ when the columns or
+    # their dtypes do.
+    if set(merged.columns) != set(existing.columns) or any(
+        merged[c].dtype != existing[c].dtype for c in existing.columns
+    ):
+        return len(existing)
+
+    def row_hashes(df):
+        rows = df.iloc[: len(existing)][matched]
+        return pd.util.hash_pandas_object(
+            rows[existing.columns], index=False
+        ).to_numpy()
+
+    return int((row_hashes(existing) != row_hashes(merged)).sum())
+
+
+def prepare_chunked_add(
+    s3_path, data, merge_on=[], partition_by=[], dedup=LAST, table_version=None
+):
+    """Prepare adding `data` to the dataset at `s3_path` in chunks.
+
+    Meant for datasets too large for `add_to_dataset`; only the Delta log of
+    the dataset is read here. The events are validated against the dataset
+    up front, raising the same errors as `add_to_dataset` does. Pass the
+    result on to `write_chunked_add`, and find the set of new columns under
+    its `new_columns` key.
+
+    The whole dataset is rewritten, partitioned by `partition_by`. It's read
+    as of `table_version` if given (through the local snapshot cache, see
+    `uploader.snapshots`), its latest version otherwise.
+    """
+    events = dataframe_from_dict(data)
+
+    if merge_on:
+        events = deduplicate(events, merge_on, dedup)
+
+    if partition_by:
+        events = add_partition_columns(events, partition_by)
+
+    mixed_columns = [c for c in events if events[c].dtype == "object"]
+    if mixed_columns:
+        raise InvalidTypeError(
+            f"Invalid or mixed types detected in column(s): {', '.join(mixed_columns)}"
+        )
+
+    if table_version is None:
+        table = dl.DeltaTable(s3_path, storage_options=storage_options())
+    else:
+        table = snapshot(s3_path, table_version)
+    existing = table.to_pyarrow_dataset()
+
+    missing_columns = [
+        c for c in merge_on if c not in events or c not in existing.schema.names
+    ]
+    if missing_columns:
+        raise MissingMergeColumnsError(f"Missing ID column(s): {missing_columns}")
+
+    try:
+        schema = pa.unify_schemas(
+            [existing.schema, pa.Schema.from_pandas(events, preserve_index=False)],
+            promote_options="permissive",
+        )
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        raise InvalidTypeError("Mixed types detected")
+
+    return {
+        "existing": existing,
+        "events": events,
+        "merge_on": merge_on,
+        "partition_by": partition_by,
+        "schema": schema,
+        "new_columns": set(events.columns) - set(existing.schema.names),
+        "table_version": table_version,
+    }
+
+
+def write_chunked_add(prepared, target_s3_path):
+    """Write a dataset prepared by `prepare_chunked_add` to `target_s3_path`.
+
+    The existing dataset is streamed through one batch at a time. Rows that
+    match any of the events are held back and merged with them like
+    `add_to_dataset` does, then written last. Return the number of rows
+    written.
+    """
+    schema = prepared["schema"]
+    rows = 0
+
+    def batches():
+        nonlocal rows
+        for table in _chunked_tables(prepared):
+            rows += table.num_rows
+            yield from _conform(table, schema).to_batches()
+
+    try:
+        dl.write_deltalake(
+            target_s3_path,
+            pa.RecordBatchReader.from_batches(schema, batches()),
+            mode="overwrite",
+            schema_mode="merge",
+            partition_by=partition_names(prepared["partition_by"]) or None,
+            storage_options=storage_options(),
+            writer_properties=writer_properties(schema, prepared["merge_on"]),
+        )
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        raise InvalidTypeError("Mixed types detected")
+
+    return rows
+
+
+def _chunked_tables(prepared):
+    events = prepared["events"]
+    merge_on = prepared["merge_on"]
+    keys = pa.Table.from_pandas(events[merge_on], preserve_index=False)
+    matched = []
+
+    for batch in prepared["existing"].to_batches(
+        batch_readahead=1, fragment_readahead=1
+    ):
+        table = _with_partitions(
+            pa.Table.from_batches([batch]), prepared["partition_by"]
+        )
+        if merge_on:
+            keys = _conform(keys, table.select(merge_on).schema)
+            matched.append(table.join(keys, merge_on, join_type="left semi"))
+            table = table.join(keys, merge_on, join_type="left anti")
+        yield table
+
+    if merge_on and matched:
+        # There's at most one matching row per event, so these fit in memory.
+        existing = pa.concat_tables(matched).to_pandas(types_mapper=pd.ArrowDtype)
+        events, inserted, updated = upsert(existing, events, merge_on)
+        log_add(inserted_rows=inserted, updated_rows=updated)
+
+    yield pa.Table.from_pandas(events, preserve_index=False)
+
+
+def _with_partitions(table, partition_by):
+    # (Re)derive the partition columns of `table`, for existing rows that
+    # weren't partitioned yet.
+    for p in partition_by:
+        if p["transform"] and p["column"] in table.column_names:
+            values = derive_partition(table[p["column"]], p)
+            if p["name"] in table.column_names:
+                table = table.drop_columns(p["name"])
+            table = table.append_column(p["name"], values)
+    return table
+
+
+def _conform(table, schema):
+    # Cast `table` to `schema`, adding missing columns as nulls.
+    return pa.table(
+        [
+            (
+                table[field.name].cast(field.type)
+                if field.name in table.column_names
+                else pa.nulls(table.num_rows, field.type)
+            )
+            for field in schema
+        ],
+        schema=schema,
+    )
@@ -0,0 +1,188 @@
+"""Compact encodings of dataset columns, in memory and on disk.
+
+While events are merged into a dataset, string columns with few distinct
+values are dictionary encoded, and integer and float columns narrowed to the
+smallest width that holds their values exactly (see `compact`). Both sides of
+the merge get the same encodings, so merging them doesn't cast anything.
+Narrowed columns are widened again before writing (see `restore`), so the
+schema of the Delta table never depends on the values at hand. Dictionary
+encoded columns are written as the plain strings they are.
+
+In the Parquet files, the encoding of each column only follows from its type
+and whether it's a merge column (see `writer_properties`), so every edition
+of a dataset is encoded the same way. Dictionaries are used for most
+columns; low-cardinality columns shrink the most. Merge columns and
+timestamps, which seldom repeat, are delta encoded instead, which packs
+increasing values into a few bits each.
+"""
+
+import deltalake as dl
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Dictionary encode string columns with at most this share of distinct
+# values...
+DICTIONARY_MAX_SHARE = 0.1
+
+# ...and at least this many rows, below which it saves too little to matter.
+DICTIONARY_MIN_ROWS = 10_000
+
+INTEGER_TYPES = [pa.int8(), pa.int16(), pa.int32(), pa.int64()]
+
+# deltalake's default, which custom writer properties would otherwise drop
+# (leaving the files uncompressed).
+COMPRESSION = "SNAPPY"
+
+DELTA_ENCODED = dl.ColumnProperties(
+    dictionary_enabled=False, encoding="DELTA_BINARY_PACKED"
+)
+
+
+def _arrow(series):
+    return pa.array(series.array)
+
+
+def _chunks(series):
+    return series.array.__arrow_array__().chunks
+
+
+def _pyarrow_type(series):
+    return getattr(series.dtype, "pyarrow_dtype", None)
+
+
+def _is_string(t):
+    return t is not None and (pa.types.is_string(t) or pa.types.is_large_string(t))
+
+
+def _dictionary_type(series):
+    # The dictionary type to encode string `series` as, or `None` if it has
+    # too many distinct values to be worth it.
+    t = _pyarrow_type(series)
+    if not _is_string(t) or len(series) < DICTIONARY_MIN_ROWS:
+        return None
+    distinct = pc.count_distinct(_arrow(series)).as_py()
+    if distinct > DICTIONARY_MAX_SHARE * len(series):
+        return None
+    return pa.dictionary(pa.int32(), t)
+
+
+def _narrow_type(columns):
+    # The narrowest type that holds the values of all `columns` exactly, or
+    # `None` if that's the type they already have.
+    t = _pyarrow_type(columns[0])
+
+    if pa.types.is_signed_integer(t):
+        bounds = [pc.min_max(_arrow(c)) for c in columns]
+        low = min((b["min"].as_py() for b in bounds if b["min"].is_valid), default=0)
+        high = max((b["max"].as_py() for b in bounds if b["max"].is_valid), default=0)
+        narrow = next(
+            i
+            for i in INTEGER_TYPES
+            if np.iinfo(i.to_pandas_dtype()).min <= low
+            and high <= np.iinfo(i.to_pandas_dtype()).max
+        )
+        return narrow if narrow.bit_width < t.bit_width else None
+
+    if pa.types.is_float64(t):
+        for c in columns:
+            values = _arrow(c)
+            round_trip = pc.cast(pc.cast(values, pa.float32(), safe=False), t)
+            # NaNs never compare equal, so columns with NaNs stay as they are.
+            if not pc.all(pc.equal(round_trip, values)).as_py():
+                return None
+        return pa.float32()
+
+    return None
+
+
+def compact(existing, events, exclude=[]):
+    """Encode the columns of `existing` and `events` compactly, in place.
+
+    String columns of `existing` with few distinct values are dictionary
+    encoded, in `events` too. Integer and float columns with the same dtype
+    on both sides (or only on one) are narrowed to the smallest width that
+    holds all their values exactly. Columns of `exclude` (e.g. merge and
+    partition columns) and columns with different dtypes on each side are
+    left alone.
+
+    Columns are replaced one at a time, so that only one column is held in
+    both encodings at once. Return the original dtypes of the narrowed
+    columns, for `restore`.
+    """
+    widths = {}
+
+    for c in existing.columns.union(events.columns).difference(exclude):
+        frames = [df for df in (existing, events) if c in df]
+
+        if c in existing and (dictionary := _dictionary_type(existing[c])):
+            if c not in events or _pyarrow_type(events[c]) == dictionary.value_type:
+                for df in frames:
+                    df[c] = df[c].astype(pd.ArrowDtype(dictionary))
+            continue
+
+        if len({df[c].dtype for df in frames}) != 1:
+            continue
+
+        narrow = _narrow_type([df[c] for df in frames])
+        if narrow is not None:
+            widths[c] = frames[0][c].dtype
+            for df in frames:
+                df[c] = df[c].astype(pd.ArrowDtype(narrow))
+
+    return widths
+
+
+def restore(df, widths):
+    """Widen the columns of `df` narrowed by `compact` again, in place."""
+    for c, dtype in widths.items():
+        if c in df:
+            df[c] = df[c].astype(dtype)
+
+
+def fillna(series, fill):
+    """Return `series` with its missing values taken from `fill`.
+
+    Like `Series.fillna`, but dictionary encoded series are filled by their
+    indices, which Arrow does far faster than by their values.
+    """
+    t = _pyarrow_type(series)
+    if t is None or not pa.types.is_dictionary(t) or series.dtype != fill.dtype:
+        return series.fillna(fill)
+
+    chunks = pa.chunked_array(
+        [*_chunks(series), *_chunks(fill)], t
+    ).unify_dictionaries()
+    dictionary = chunks.chunk(0).dictionary
+    indices = pa.chunked_array([c.indices for c in chunks.chunks], t.index_type)
+    filled = pc.fill_null(indices[: len(series)], indices[len(series) :])
+
+    return pd.Series(
+        pd.arrays.ArrowExtensionArray(
+            pa.chunked_array(
+                [pa.DictionaryArray.from_arrays(c, dictionary) for c in filled.chunks],
+                t,
+            )
+        ),
+        index=series.index,
+    )
+
+
+def writer_properties(schema, merge_on=[]):
+    """Return the Parquet writer properties of a table with `schema`.
+
+    Integer merge columns and timestamp columns are delta encoded, and the
+    rest dictionary encoded, falling back to plain encoding for columns with
+    too many distinct values.
+    """
+    return dl.WriterProperties(
+        compression=COMPRESSION,
+        default_column_properties=dl.ColumnProperties(dictionary_enabled=True),
+        column_properties={
+            field.name: DELTA_ENCODED
+            for field in schema
+            if pa.types.is_timestamp(field.type)
+            or (field.name in merge_on and pa.types.is_integer(field.type))
+        },
+    )
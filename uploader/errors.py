@@ -24,3 +24,31 @@ class MissingMergeColumnsError(Exception):
 
 class AlertEmailError(Exception):
     pass
+
+
+class DatasetTooLargeError(Exception):
+    pass
+
+
+class ConcurrentWriteError(Exception):
+    pass
+
+
+class PartitionChangedError(Exception):
+    pass
+
+
+class SecretNotFoundError(Exception):
+    pass
+
+
+class InvalidEventsError(Exception):
+    pass
+
+
+class UnsupportedContentTypeError(Exception):
+    pass
+
+
+class UnreadableFileError(Exception):
+    pass
@@ -0,0 +1,79 @@
+"""Columnar payloads of events.
+
+Besides a JSON document with an `events` array, events can be pushed as an
+Arrow IPC stream, a Parquet file or newline-delimited JSON, chosen by the
+content type of the request. These are read straight into a pyarrow table,
+never into Python objects per event.
+"""
+
+import io
+
+import pyarrow as pa
+import pyarrow.json
+import pyarrow.parquet as pq
+
+from uploader.errors import InvalidEventsError
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+PARQUET = "application/vnd.apache.parquet"
+NDJSON = "application/x-ndjson"
+
+CONTENT_TYPES = [ARROW_STREAM, PARQUET, NDJSON]
+
+
+def read_events(payload, content_type):
+    """Return the events in `payload` (bytes) of `content_type` as a table.
+
+    Raise `InvalidEventsError` if the payload can't be read, or holds no
+    events.
+    """
+    try:
+        if content_type == ARROW_STREAM:
+            table = pa.ipc.open_stream(payload).read_all()
+        elif content_type == PARQUET:
+            table = pq.read_table(io.BytesIO(payload))
+        elif content_type == NDJSON:
+            table = _read_ndjson(payload)
+        else:
+            raise InvalidEventsError(f"Unsupported content type: {content_type}")
+    except (pa.ArrowException, OSError) as e:
+        raise InvalidEventsError(f"Could not read the events: {e}")
+
+    if not table.num_rows:
+        raise InvalidEventsError("No events")
+
+    return table
+
+
+def _read_ndjson(payload):
+    # pyarrow infers timestamps (and dates, as timestamps) from strings by
+    # rules of its own. Read those columns as strings instead, for them to be
+    # inferred like the events of a JSON document are (see
+    # `uploader.inference.dataframe_from_dict`).
+    table = pyarrow.json.read_json(io.BytesIO(payload))
+    temporal = [
+        f.name
+        for f in table.schema
+        if pa.types.is_timestamp(f.type) or pa.types.is_date(f.type)
+    ]
+    if not temporal:
+        return table
+
+    names = table.column_names
+    table = pyarrow.json.read_json(
+        io.BytesIO(payload),
+        parse_options=pyarrow.json.ParseOptions(
+            explicit_schema=pa.schema([(c, pa.string()) for c in temporal]),
+            unexpected_field_behavior="infer",
+        ),
+    )
+    # The explicit columns come first; keep the order of the events.
+    return table.select(names)
+
+
+def write_ipc(table):
+    """Return `table` as an Arrow IPC stream."""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
@@ -4,12 +4,14 @@ from json.decoder import JSONDecodeError
 from datetime import datetime, timezone
 
 from aws_xray_sdk.core import patch_all, xray_recorder
-from jsonschema import validate, ValidationError, SchemaError
+from botocore.exceptions import ClientError
+from jsonschema import ValidationError, SchemaError
 
 from okdata.aws.logging import logging_wrapper, log_add
 from okdata.resource_auth import ResourceAuthorizer
 
 from uploader.common import (
+    TRACE_ID_METADATA,
     get_and_validate_dataset,
     error_response,
     edition_missing,
@@ -18,7 +20,8 @@ from uploader.common import (
     create_edition,
     generate_s3_path,
     generate_signed_post,
-    create_status_trace,
+    generate_staging_path,
+    generate_uuid,
     split_edition_id,
 )
 from uploader.errors import (
@@ -27,24 +30,76 @@ from uploader.errors import (
     InvalidSourceTypeError,
     DatasetNotFoundError,
 )
-from uploader.schema import get_model_schema
+from uploader.multipart import (
+    MAX_PARTS_PER_REQUEST,
+    abort_multipart_upload,
+    complete_multipart_upload,
+    create_multipart_upload,
+    generate_signed_part_urls,
+)
+from uploader.schema import validate
+from uploader.status import create_status_trace
 
 patch_all()
 
 BUCKET = os.environ["BUCKET"]
 ENABLE_AUTH = os.environ.get("ENABLE_AUTH", "false") == "true"
 
+# Request model for each kind of upload handled by `_handler`.
+REQUEST_MODELS = {
+    "single": "uploadRequest",
+    "batch": "batchUploadRequest",
+    "multipart": "uploadRequest",
+}
+
 resource_authorizer = ResourceAuthorizer()
 
 
 @logging_wrapper
 @xray_recorder.capture("generate_signed_post")
 def handler(event, context):
+    """Return a signed POST for uploading a single file to an edition.
+
+    With `deferEdition`, a missing edition isn't created here. The file is
+    staged instead, and moved into a new edition once uploaded by
+    `uploader.handlers.handle_staged_upload`.
+    """
+    return _handler(event, "single")
+
+
+@logging_wrapper
+@xray_recorder.capture("generate_signed_posts")
+def batch_handler(event, context):
+    """Return signed POSTs for uploading several files to one edition.
+
+    The request is validated, authorized and traced once for the whole batch,
+    leaving only path generation and signing to be done per file.
+    """
+    return _handler(event, "batch")
+
+
+@logging_wrapper
+@xray_recorder.capture("create_multipart_upload")
+def multipart_handler(event, context):
+    """Create a multipart upload of a single file to an edition.
+
+    Meant for files too large for a single signed POST. The edition is
+    validated (or created) just like for `handler`. Part URLs are then signed
+    by `multipart_parts_handler`, and the upload finished by either
+    `multipart_complete_handler` or `multipart_abort_handler`.
+    """
+    return _handler(event, "multipart")
+
+
+def _handler(event, mode):
     try:
         body = json.loads(event["body"])
-        validate(body, get_model_schema("uploadRequest"))
-
-        log_add(filename=body["filename"], edition_id=body["editionId"])
+        validate(body, REQUEST_MODELS[mode])
+        log_add(
+            filename=body.get("filename"),
+            filename_count=len(body.get("filenames", [None])),
+            edition_id=body["editionId"],
+        )
         maybe_edition = body["editionId"]
 
         dataset_id, dataset_version = split_edition_id(maybe_edition)
@@ -80,31 +135,35 @@ def handler(event, context):
     if ENABLE_AUTH and not has_access:
         return error_response(403, "Forbidden")
 
-    try:
-        edition_created = False
-        if edition_missing(maybe_edition) and validate_version(maybe_edition):
-            body["editionId"] = create_edition(token, maybe_edition)
-            edition_created = True
+    # Rather than creating the edition up front, the file can be staged and the
+    # edition created once the file is uploaded.
+    defer_edition = body.get("deferEdition", False) and edition_missing(maybe_edition)
+    log_add(defer_edition=defer_edition)
 
-        log_add(edition_id=body["editionId"], edition_created=edition_created)
+    if defer_edition and mode != "single":
+        return error_response(400, "Only single file uploads can defer the edition")
 
-        if not edition_created and not validate_edition(maybe_edition):
-            raise InvalidDatasetEditionError()
+    if not defer_edition:
+        error = _ensure_edition(body, token)
+        if error:
+            return error
 
-    except InvalidDatasetEditionError:
-        return error_response(400, "Incorrect dataset edition")
-    except DataExistsError:
-        return error_response(409, "Could not create data as resource already exists")
-    except Exception as e:
-        log_add(exc_info=e)
-        return error_response(500, "Could not complete request, please try again later")
+    # The trace ID is decided up front, for tagging the uploaded files with it.
+    # It also doubles as the ID of staged uploads.
+    trace_id = generate_uuid(None, dataset_id)
 
     try:
-        s3_path = generate_s3_path(
-            dataset_metadata=dataset,
-            edition_id=body["editionId"],
-            filename=body["filename"],
-        )
+        if defer_edition:
+            s3_path = generate_staging_path(
+                dataset_id, dataset_version, trace_id, body["filename"]
+            )
+        else:
+            # For batches, the status trace points to the edition as a whole.
+            s3_path = generate_s3_path(
+                dataset_metadata=dataset,
+                edition_id=body["editionId"],
+                filename=body.get("filename"),
+            )
     except ValueError as e:
         return error_response(400, str(e))
 
@@ -125,16 +184,19 @@ def handler(event, context):
         "s3_path": s3_path,
     }
 
-    post_response = generate_signed_post(BUCKET, s3_path)
+    post_response = _create_upload(
+        body, s3_path, mode, metadata={TRACE_ID_METADATA: trace_id}
+    )
 
     status_data["end_time"] = datetime.now(timezone.utc).isoformat()
 
-    status_response = create_status_trace(token, status_data)
+    trace_id = create_status_trace(status_data, trace_id)
 
-    post_response["status_response"] = status_response.get("trace_id")
-    post_response["trace_id"] = status_response.get("trace_id")
+    post_response["trace_id"] = trace_id
 
-    log_add(full_post_response=post_response)
+    if mode == "single":
+        post_response["status_response"] = trace_id
+        log_add(full_post_response=post_response)
 
     return {
         "isBase64Encoded": False,
@@ -142,3 +204,188 @@ def handler(event, context):
         "headers": {"Access-Control-Allow-Origin": "*"},
         "body": json.dumps(post_response),
     }
+
+
+def _ensure_edition(body, token):
+    # Make sure the edition in `body` exists, creating it if it's missing.
+    # Return an error response if it can't be.
+    maybe_edition = body["editionId"]
+
+    try:
+        edition_created = False
+        if edition_missing(maybe_edition) and validate_version(maybe_edition):
+            body["editionId"] = create_edition(token, maybe_edition)
+            edition_created = True
+
+        log_add(edition_id=body["editionId"], edition_created=edition_created)
+
+        if not edition_created and not validate_edition(maybe_edition):
+            raise InvalidDatasetEditionError()
+
+    except InvalidDatasetEditionError:
+        return error_response(400, "Incorrect dataset edition")
+    except DataExistsError:
+        return error_response(409, "Could not create data as resource already exists")
+    except Exception as e:
+        log_add(exc_info=e)
+        return error_response(500, "Could not complete request, please try again later")
+
+    return None
+
+
+def _create_upload(body, s3_path, mode, metadata):
+    if mode == "single":
+        return generate_signed_post(BUCKET, s3_path, metadata=metadata)
+
+    if mode == "multipart":
+        return {
+            "editionId": body["editionId"],
+            "uploadId": create_multipart_upload(BUCKET, s3_path, metadata),
+            "key": s3_path,
+        }
+
+    return {
+        "posts": [
+            {
+                "filename": filename,
+                **generate_signed_post(
+                    BUCKET, f"{s3_path}/{filename}", metadata=metadata
+                ),
+            }
+            for filename in body["filenames"]
+        ]
+    }
+
+
+@logging_wrapper
+@xray_recorder.capture("sign_multipart_upload_parts")
+def multipart_parts_handler(event, context):
+    """Return presigned URLs for uploading a range of parts of an upload."""
+    return _multipart_handler(event, "multipartPartsRequest", _sign_parts)
+
+
+@logging_wrapper
+@xray_recorder.capture("complete_multipart_upload")
+def multipart_complete_handler(event, context):
+    """Complete a multipart upload from its uploaded parts."""
+    return _multipart_handler(event, "multipartCompleteRequest", _complete_upload)
+
+
+@logging_wrapper
+@xray_recorder.capture("abort_multipart_upload")
+def multipart_abort_handler(event, context):
+    """Abort a multipart upload, discarding any uploaded parts."""
+    return _multipart_handler(event, "multipartAbortRequest", _abort_upload)
+
+
+def _multipart_handler(event, model_name, action):
+    try:
+        body = json.loads(event["body"])
+        validate(body, model_name)
+
+        log_add(
+            filename=body["filename"],
+            edition_id=body["editionId"],
+            upload_id=body["uploadId"],
+        )
+
+        dataset_id, _dataset_version = split_edition_id(body["editionId"])
+        log_add(dataset_id=dataset_id)
+
+        dataset = get_and_validate_dataset(dataset_id)
+    except JSONDecodeError as e:
+        log_add(exc_info=e)
+        return error_response(400, "Body is not a valid JSON document")
+    except ValidationError as e:
+        log_add(exc_info=e)
+        return error_response(400, "JSON document does not conform to the given schema")
+    except InvalidSourceTypeError as e:
+        return error_response(400, str(e))
+    except DatasetNotFoundError:
+        return error_response(404, f"Dataset {dataset_id} does not exist")
+    except InvalidDatasetEditionError:
+        return error_response(422, "Invalid dataset edition format")
+    except (SchemaError, Exception) as e:
+        log_add(exc_info=e)
+        return error_response(500, "Internal server error")
+
+    token = event["headers"]["Authorization"].split(" ")[-1]
+
+    has_access = resource_authorizer.has_access(
+        token, "okdata:dataset:write", f"okdata:dataset:{dataset_id}"
+    )
+    log_add(enable_auth=ENABLE_AUTH, has_access=has_access)
+
+    if ENABLE_AUTH and not has_access:
+        return error_response(403, "Forbidden")
+
+    # Unlike when creating the upload, a missing edition is never created here.
+    try:
+        edition_exists = validate_edition(body["editionId"])
+    except Exception as e:
+        log_add(exc_info=e)
+        return error_response(500, "Could not complete request, please try again later")
+
+    log_add(edition_exists=edition_exists)
+
+    if not edition_exists:
+        return error_response(400, "Incorrect dataset edition")
+
+    try:
+        # The key is always derived from the edition and filename, so that
+        # only uploads to the dataset the caller has access to can be touched.
+        s3_path = generate_s3_path(
+            dataset_metadata=dataset,
+            edition_id=body["editionId"],
+            filename=body["filename"],
+        )
+        log_add(generated_s3_path=s3_path)
+
+        response_body = action(body, s3_path)
+    except ValueError as e:
+        return error_response(400, str(e))
+    except ClientError as e:
+        log_add(exc_info=e)
+        error = e.response["Error"]
+        if error["Code"] == "NoSuchUpload":
+            return error_response(404, f"Upload {body['uploadId']} does not exist")
+        if e.response["ResponseMetadata"]["HTTPStatusCode"] < 500:
+            return error_response(400, error["Message"])
+        return error_response(500, "Could not complete request, please try again later")
+
+    return {
+        "isBase64Encoded": False,
+        "statusCode": 200,
+        "headers": {"Access-Control-Allow-Origin": "*"},
+        "body": json.dumps(response_body),
+    }
+
+
+def _sign_parts(body, s3_path):
+    first_part = body["firstPart"]
+    last_part = body["lastPart"]
+
+    if last_part < first_part:
+        raise ValueError("`lastPart` must not be less than `firstPart`")
+
+    if last_part - first_part >= MAX_PARTS_PER_REQUEST:
+        raise ValueError(
+            f"Cannot sign more than {MAX_PARTS_PER_REQUEST} parts per request"
+        )
+
+    return {
+        "uploadId": body["uploadId"],
+        "parts": generate_signed_part_urls(
+            BUCKET, s3_path, body["uploadId"], first_part, last_part
+        ),
+    }
+
+
+def _complete_upload(body, s3_path):
+    complete_multipart_upload(BUCKET, s3_path, body["uploadId"], body["parts"])
+    return {"uploadId": body["uploadId"], "key": s3_path}
+
+
+def _abort_upload(body, s3_path):
+    abort_multipart_upload(BUCKET, s3_path, body["uploadId"])
+    return {"uploadId": body["uploadId"]}
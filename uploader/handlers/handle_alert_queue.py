@@ -0,0 +1,59 @@
+import json
+import logging
+import os
+
+from aws_xray_sdk.core import patch_all, xray_recorder
+from botocore.exceptions import BotoCoreError, ClientError
+from okdata.aws.logging import log_add, log_exception, logging_wrapper
+from requests.exceptions import RequestException
+
+from uploader.alerts import send_alert_digest
+from uploader.errors import AlertEmailError
+
+patch_all()
+
+logger = logging.getLogger()
+logger.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
+
+
+@logging_wrapper
+@xray_recorder.capture("handle_alert_queue")
+def alert_queue_handler(event, context):
+    """Send queued new column alerts as one digest email per dataset.
+
+    The trigger collects alerts over a batching window, so that a burst of
+    writes introducing columns to a dataset results in a single email.
+    Records for datasets whose email couldn't be sent are reported back as
+    batch item failures, leaving them on the queue to be retried later.
+    """
+    alerts = {}
+
+    for record in event["Records"]:
+        alert = json.loads(record["body"])
+        dataset_alerts = alerts.setdefault(
+            alert["dataset_id"], {"new_columns": set(), "message_ids": []}
+        )
+        dataset_alerts["new_columns"].update(alert["new_columns"])
+        dataset_alerts["message_ids"].append(record["messageId"])
+
+    failures = []
+    sent = 0
+
+    for dataset_id, dataset_alerts in alerts.items():
+        try:
+            sent += send_alert_digest(dataset_id, dataset_alerts["new_columns"])
+        except (AlertEmailError, RequestException, BotoCoreError, ClientError) as e:
+            log_exception(e)
+            failures += [
+                {"itemIdentifier": message_id}
+                for message_id in dataset_alerts["message_ids"]
+            ]
+
+    log_add(
+        alert_count=len(event["Records"]),
+        dataset_count=len(alerts),
+        sent_email_count=sent,
+        failed_alert_count=len(failures),
+    )
+
+    return {"batchItemFailures": failures}
@@ -1,13 +1,16 @@
+import base64
 import json
 import logging
 import os
 
 from aws_xray_sdk.core import patch_all, xray_recorder
-from okdata.aws.logging import log_add, logging_wrapper
-from okdata.aws.status import status_add, status_wrapper, TraceStatus
+from okdata.aws.logging import log_add, log_exception, logging_wrapper
+from okdata.aws.status import status_add, status_wrapper, TraceEventStatus, TraceStatus
 
 from uploader.common import generate_s3_path, get_and_validate_dataset, sdk_config
 from uploader.dataset import handle_events
+from uploader.errors import DatasetTooLargeError
+from uploader.formats import read_events
 
 patch_all()
 
@@ -31,11 +34,19 @@ def event_queue_handler(event, context):
     dataset_id = body["datasetId"]
     merge_on = body.get("mergeOn", [])
     version = body.get("version", "1")
+    if "contentType" in body:
+        # A columnar payload, see `uploader.handlers.push_dataset_events`.
+        events = read_events(base64.b64decode(body["data"]), body["contentType"])
+    else:
+        events = body.get("events", [])
+    deletes = body.get("deletes", [])
+    dedup = body.get("dedup", "last")
 
     log_add(
         dataset_id=dataset_id,
         dataset_version=version,
-        event_count=len(body["events"]),
+        event_count=len(events),
+        delete_count=len(deletes),
     )
 
     dataset = get_and_validate_dataset(dataset_id, source_type="event")
@@ -48,9 +59,27 @@ def event_queue_handler(event, context):
 
     log_add(source_s3_path=source_s3_path)
 
-    edition_id = handle_events(
-        dataset, version, merge_on, source_s3_path, body["events"]
-    )
+    try:
+        edition_id = handle_events(
+            dataset, version, merge_on, source_s3_path, events, deletes, dedup=dedup
+        )
+    except DatasetTooLargeError as e:
+        # Retrying won't help, so fail the trace and let the message go
+        # instead of raising (which would only send it back to the queue).
+        log_exception(e)
+        status_add(
+            trace_event_status=TraceEventStatus.FAILED,
+            trace_status=TraceStatus.FINISHED,
+            errors=[
+                {
+                    "message": {
+                        "nb": "Datasettet er for stort til å legge til flere hendelser.",
+                        "en": "The dataset is too large to add more events to.",
+                    }
+                }
+            ],
+        )
+        return {"statusCode": 413, "body": json.dumps({"message": str(e)})}
 
     status_add(trace_status=TraceStatus.FINISHED)
 
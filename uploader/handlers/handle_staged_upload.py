@@ -0,0 +1,150 @@
+import functools
+import logging
+import os
+from urllib.parse import unquote_plus
+
+import boto3
+from aws_xray_sdk.core import patch_all, xray_recorder
+from botocore.exceptions import ClientError
+from okdata.aws.logging import log_add, log_exception, logging_wrapper
+from okdata.aws.status import status_add, status_wrapper, TraceEventStatus, TraceStatus
+from okdata.sdk.data.dataset import Dataset
+
+from uploader.common import (
+    STAGING_CLAIMS_PREFIX,
+    STAGING_PREFIX,
+    generate_s3_path,
+    get_and_validate_dataset,
+    sdk_config,
+    split_staging_path,
+)
+from uploader.errors import DatasetNotFoundError, InvalidSourceTypeError
+
+patch_all()
+
+logger = logging.getLogger()
+logger.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
+
+
+@functools.cache
+def _s3_client():
+    return boto3.client("s3", region_name=os.environ["AWS_REGION"])
+
+
+def _staged_object(bucket, key):
+    # Return the staged object at `key`, or `None` if it's gone.
+    try:
+        return _s3_client().head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+
+def _claim_key(key):
+    return f"{STAGING_CLAIMS_PREFIX}/{key.removeprefix(f'{STAGING_PREFIX}/')}"
+
+
+def _claim(bucket, key):
+    # Claim the staged object at `key` for this invocation. Return whether it
+    # was claimed, i.e. not already claimed by another one.
+    try:
+        _s3_client().put_object(
+            Bucket=bucket, Key=_claim_key(key), Body=b"", IfNoneMatch="*"
+        )
+    except ClientError as e:
+        # A conflict means another conditional write of it is in progress.
+        if e.response["Error"]["Code"] in (
+            "PreconditionFailed",
+            "ConditionalRequestConflict",
+        ):
+            return False
+        raise
+    return True
+
+
+@status_wrapper(sdk_config())
+@logging_wrapper
+@xray_recorder.capture("handle_staged_upload")
+def staged_upload_handler(event, context):
+    """Move a staged file into a new edition of its dataset.
+
+    Triggered by S3 when a file signed for with `deferEdition` has been
+    uploaded to the staging area. The edition is created here, and the file
+    copied to it and removed from the staging area.
+    """
+    # S3 notifies of one object per event.
+    record = event["Records"][0]
+    bucket = record["s3"]["bucket"]["name"]
+    key = unquote_plus(record["s3"]["object"]["key"])
+
+    dataset_id, version, trace_id, filename = split_staging_path(key)
+
+    status_add(trace_id=trace_id, domain="dataset", domain_id=f"{dataset_id}/{version}")
+    log_add(
+        dataset_id=dataset_id,
+        dataset_version=version,
+        staged_s3_path=key,
+        trace_id=trace_id,
+    )
+
+    # S3 may notify of the same object more than once, even at the same
+    # time; don't create another edition for a file that has already been
+    # (or is being) moved.
+    staged = _staged_object(bucket, key)
+    if staged is None:
+        log_add(already_moved=True)
+        return {"statusCode": 200}
+    if not _claim(bucket, key):
+        log_add(already_claimed=True)
+        return {"statusCode": 200}
+
+    try:
+        dataset = get_and_validate_dataset(dataset_id)
+    except (DatasetNotFoundError, InvalidSourceTypeError) as e:
+        # Retrying won't help, so fail the trace and discard the file instead
+        # of raising.
+        log_exception(e)
+        status_add(
+            trace_event_status=TraceEventStatus.FAILED,
+            trace_status=TraceStatus.FINISHED,
+            errors=[
+                {
+                    "message": {
+                        "nb": "Datasettet finnes ikke, eller tar ikke imot filer.",
+                        "en": "The dataset doesn't exist, or doesn't accept files.",
+                    }
+                }
+            ],
+        )
+        _s3_client().delete_object(Bucket=bucket, Key=key)
+        return {"statusCode": 400}
+
+    try:
+        edition = Dataset(sdk_config()).auto_create_edition(dataset_id, version)
+        s3_path = generate_s3_path(dataset, edition["Id"], filename=filename)
+
+        log_add(edition_id=edition["Id"], s3_path=s3_path)
+
+        # A managed copy, since a single copy is limited to 5 GB. The metadata
+        # (like the trace ID) is passed on explicitly, as multipart copies
+        # don't keep it otherwise.
+        _s3_client().copy(
+            {"Bucket": bucket, "Key": key},
+            bucket,
+            s3_path,
+            ExtraArgs={"Metadata": staged["Metadata"], "MetadataDirective": "REPLACE"},
+        )
+    except Exception:
+        # Release the claim, so that the file isn't left behind when the
+        # event is retried.
+        _s3_client().delete_object(Bucket=bucket, Key=_claim_key(key))
+        raise
+
+    # The claim is kept, for a duplicate notification may have found the
+    # file just before it was removed.
+    _s3_client().delete_object(Bucket=bucket, Key=key)
+
+    status_add(s3_path=s3_path)
+
+    return {"statusCode": 200}
@@ -0,0 +1,46 @@
+import json
+import logging
+import os
+
+from aws_xray_sdk.core import patch_all, xray_recorder
+from okdata.aws.logging import log_add, log_exception, logging_wrapper
+from okdata.sdk.status import Status
+from requests.exceptions import RequestException
+
+from uploader.common import sdk_config
+
+patch_all()
+
+logger = logging.getLogger()
+logger.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
+
+STATUS_API_RETRIES = 3
+
+
+@logging_wrapper
+@xray_recorder.capture("handle_status_queue")
+def status_queue_handler(event, context):
+    """Deliver queued status traces to the status API.
+
+    Records that couldn't be delivered are reported back as batch item
+    failures, leaving them on the queue to be retried later.
+    """
+    status = Status(sdk_config())
+    failures = []
+
+    for record in event["Records"]:
+        status_data = json.loads(record["body"])
+        trace_id = status_data["trace_id"]
+
+        try:
+            status.update_status(trace_id, status_data, retries=STATUS_API_RETRIES)
+        except RequestException as e:
+            log_exception(e)
+            failures.append({"itemIdentifier": record["messageId"]})
+
+    log_add(
+        trace_count=len(event["Records"]),
+        failed_trace_count=len(failures),
+    )
+
+    return {"batchItemFailures": failures}
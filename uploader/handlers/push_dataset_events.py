@@ -1,44 +1,105 @@
+import base64
 import json
 import logging
 import os
-import time
 from datetime import datetime, timezone
 from json.decoder import JSONDecodeError
 
 import boto3
 from aws_xray_sdk.core import patch_all, xray_recorder
 from botocore.exceptions import ClientError
-from jsonschema import validate, ValidationError, SchemaError
+from jsonschema import ValidationError, SchemaError
 from okdata.aws.logging import log_add, log_exception, logging_wrapper
 from okdata.resource_auth import ResourceAuthorizer
 
 from uploader.common import (
-    create_status_trace,
     error_response,
     generate_s3_path,
     get_and_validate_dataset,
 )
-from uploader.dataset import handle_events
 from uploader.errors import (
+    ConcurrentWriteError,
     DatasetNotFoundError,
+    DatasetTooLargeError,
+    InvalidEventsError,
     InvalidSourceTypeError,
     InvalidTypeError,
     MissingMergeColumnsError,
+    UnsupportedContentTypeError,
 )
-from uploader.schema import get_model_schema
+from uploader.schema import validate
+from uploader.status import create_status_trace
 
 patch_all()
 
 logger = logging.getLogger()
 logger.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
 
-LOCK_WAIT_SECONDS = 5
-LOCK_RETRIES = 5
+JSON = "application/json"
+
+# As in `uploader.dataset`, which isn't imported up front (see below).
+DEDUP_STRATEGIES = ["first", "last", "coalesce"]
 
 resource_authorizer = ResourceAuthorizer()
 
 
-def _handler_v1(dataset, version, merge_on, events):
+def handle_events(*args, **kwargs):
+    """Proxy for `uploader.dataset.handle_events`.
+
+    `uploader.dataset` pulls in awswrangler, pandas, pyarrow and deltalake,
+    which only `_handler_v1` needs. Importing it on first use keeps them out
+    of cold starts that only validate and enqueue the events.
+    """
+    from uploader.dataset import handle_events
+
+    return handle_events(*args, **kwargs)
+
+
+def _content_type(event):
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    return headers.get("content-type", JSON).split(";")[0].strip().lower()
+
+
+def _columnar_request(event, content_type):
+    """Return the properties, payload and events of a columnar request.
+
+    The properties are taken from the query string, in the same form as
+    those of a JSON request. The events are read from the payload into a
+    pyarrow table (`uploader.formats` is imported on first use for the same
+    reason as `uploader.dataset` is).
+    """
+    from uploader.formats import CONTENT_TYPES, read_events
+
+    if content_type not in CONTENT_TYPES:
+        raise UnsupportedContentTypeError(f"Unsupported content type: {content_type}")
+
+    params = event.get("queryStringParameters") or {}
+
+    if not params.get("datasetId"):
+        raise InvalidEventsError("Missing query parameter: datasetId")
+
+    body = {"datasetId": params["datasetId"], "version": params.get("version", "1")}
+    if params.get("mergeOn"):
+        body["mergeOn"] = params["mergeOn"].split(",")
+    if params.get("dedup"):
+        if params["dedup"] not in DEDUP_STRATEGIES:
+            raise InvalidEventsError("Invalid query parameter: dedup")
+        body["dedup"] = params["dedup"]
+    if params.get("apiVersion"):
+        try:
+            body["apiVersion"] = int(params["apiVersion"])
+        except ValueError:
+            raise InvalidEventsError("Invalid query parameter: apiVersion")
+
+    if event.get("isBase64Encoded"):
+        payload = base64.b64decode(event["body"])
+    else:
+        payload = (event["body"] or "").encode("utf-8")
+
+    return body, payload, read_events(payload, content_type)
+
+
+def _handler_v1(dataset, version, merge_on, events, deletes, dedup):
     """Synchronous event handler.
 
     To be phased out in favor of the implementation `_handler_v2` which is
@@ -52,78 +113,66 @@ def _handler_v1(dataset, version, merge_on, events):
 
     log_add(source_s3_path=source_s3_path)
 
-    dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_REGION"])
-    lock_table = dynamodb.Table("delta-write-lock")
-    locked = False
-    tries = 0
-    edition_id = None
-
-    while not edition_id and tries < LOCK_RETRIES:
-        try:
-            logger.info(f"Locking dataset {dataset_id}...")
-            lock_table.put_item(
-                Item={
-                    "DatasetId": dataset_id,
-                    "Timestamp": datetime.now(timezone.utc).isoformat(),
-                },
-                ConditionExpression="attribute_not_exists(DatasetId)",
-            )
-            logger.info("...done")
-            locked = True
-            edition_id = handle_events(
-                dataset, version, merge_on, source_s3_path, events
-            )
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-                logger.info(
-                    f"Dataset was locked; waiting for {LOCK_WAIT_SECONDS} seconds..."
-                )
-                time.sleep(LOCK_WAIT_SECONDS)
-                tries += 1
-                logger.info(f"...done, trying again (attempt #{tries + 1})")
-            else:
-                raise
-        except InvalidTypeError as e:
-            log_add(exc_info=e)
-            return error_response(400, str(e))
-        except MissingMergeColumnsError as e:
-            log_add(exc_info=e)
-            return error_response(422, str(e))
-        finally:
-            if locked:
-                logger.info(f"Unlocking dataset {dataset_id}...")
-                lock_table.delete_item(Key={"DatasetId": dataset_id})
-                logger.info("...done")
-
-    if not edition_id:
-        log_exception(
-            f"The dataset '{dataset_id}' remained write-locked after several retries"
+    # Concurrent pushes to the same dataset aren't serialized; a push whose
+    # write conflicts with another is retried by `handle_events`.
+    try:
+        edition_id = handle_events(
+            dataset,
+            version,
+            merge_on,
+            source_s3_path,
+            events,
+            deletes,
+            dedup=dedup,
         )
+    except InvalidTypeError as e:
+        log_add(exc_info=e)
+        return error_response(400, str(e))
+    except MissingMergeColumnsError as e:
+        log_add(exc_info=e)
+        return error_response(422, str(e))
+    except DatasetTooLargeError as e:
+        log_exception(e)
+        return error_response(413, str(e))
+    except ConcurrentWriteError as e:
+        log_exception(e)
         return error_response(
             409,
-            "The dataset remains write-locked after several retries. This "
-            "should not happen, please contact Dataspeilet.",
+            "The dataset is being written to by others at the same time. "
+            "Please try again.",
         )
 
+    if edition_id is None:
+        # Only deletes, for a dataset with no data yet, so no edition either.
+        return {
+            "statusCode": 200,
+            "body": json.dumps(
+                {
+                    "unchanged": True,
+                    "message": "The dataset has no data to delete from yet; "
+                    "nothing was changed.",
+                }
+            ),
+        }
+
     return {
         "statusCode": 201,
         "body": json.dumps({"editionId": edition_id}),
     }
 
 
-def _handler_v2(event, dataset_id, version):
+def _handler_v2(event, dataset_id, version, message_body):
     """Alternate handler based on SQS.
 
     To become the default in favor of `_handler_v1` which does synchronous
     message handling.
     """
-    if len(event["body"].encode("utf-8", "ignore")) >= 262144:  # (256 KiB)
+    if len(message_body.encode("utf-8", "ignore")) >= 262144:  # (256 KiB)
         return error_response(400, "Body is too large; must be below 256 KiB")
 
     sqs = boto3.resource("sqs", region_name=os.environ["AWS_REGION"])
 
-    status = create_status_trace(
-        event["headers"]["Authorization"].split(" ")[-1],
+    trace_id = create_status_trace(
         {
             "domain": "dataset",
             "domain_id": f"{dataset_id}/{version}",
@@ -134,13 +183,12 @@ def _handler_v2(event, dataset_id, version):
             "end_time": "N/A",
         },
     )
-    trace_id = status.get("trace_id")
 
     try:
         queue = sqs.get_queue_by_name(QueueName=os.environ["EVENT_QUEUE_NAME"])
         queue.send_message(
             MessageGroupId=f"data-uploader-{dataset_id}",
-            MessageBody=event["body"],
+            MessageBody=message_body,
             MessageAttributes={
                 "trace_id": {"DataType": "String", "StringValue": trace_id}
             },
@@ -162,20 +210,39 @@ def _handler_v2(event, dataset_id, version):
 @logging_wrapper
 @xray_recorder.capture("push_dataset_events")
 def handler(event, context):
+    content_type = _content_type(event)
+
     try:
-        body = json.loads(event["body"])
-        validate(body, get_model_schema("pushEventsRequest"))
+        if content_type == JSON:
+            body = json.loads(event["body"])
+            validate(body, "pushEventsRequest")
+            events = body.get("events", [])
+            message_body = event["body"]
+        else:
+            body, payload, events = _columnar_request(event, content_type)
+            # SQS messages are text only.
+            message_body = json.dumps(
+                {
+                    **body,
+                    "contentType": content_type,
+                    "data": base64.b64encode(payload).decode("ascii"),
+                }
+            )
         dataset_id = body["datasetId"]
         merge_on = body.get("mergeOn", [])
+        dedup = body.get("dedup", "last")
         version = body.get("version", "1")
         api_version = body.get("apiVersion")
 
         log_add(
             dataset_id=dataset_id,
             merge_on=merge_on,
+            dedup=dedup,
             dataset_version=version,
-            event_count=len(body["events"]),
+            event_count=len(events),
+            delete_count=len(body.get("deletes", [])),
             api_version=api_version,
+            content_type=content_type,
         )
     except (JSONDecodeError, TypeError) as e:
         log_add(exc_info=e)
@@ -185,6 +252,12 @@ def handler(event, context):
         return error_response(
             400, f"JSON document does not conform to the given schema: {e.message}"
         )
+    except InvalidEventsError as e:
+        log_add(exc_info=e)
+        return error_response(400, str(e))
+    except UnsupportedContentTypeError as e:
+        log_add(exc_info=e)
+        return error_response(415, str(e))
     except (SchemaError, Exception) as e:
         log_add(exc_info=e)
         return error_response(500, "Internal server error")
@@ -210,5 +283,12 @@ def handler(event, context):
         return error_response(500, "Internal server error")
 
     if api_version == 2:
-        return _handler_v2(event, dataset_id, version)
-    return _handler_v1(dataset, version, merge_on, body["events"])
+        return _handler_v2(event, dataset_id, version, message_body)
+    return _handler_v1(
+        dataset,
+        version,
+        merge_on,
+        events,
+        body.get("deletes", []),
+        dedup,
+    )
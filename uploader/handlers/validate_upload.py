@@ -0,0 +1,154 @@
+import functools
+import logging
+import os
+from urllib.parse import unquote_plus
+
+import boto3
+from aws_xray_sdk.core import patch_all, xray_recorder
+from okdata.aws.logging import log_add, log_exception, logging_wrapper
+from okdata.aws.status import status_add, status_wrapper, TraceEventStatus
+
+from uploader.common import (
+    RAW_DELETES,
+    RAW_EVENTS_IPC,
+    RAW_EVENTS_JSON,
+    TRACE_ID_METADATA,
+    generate_s3_path,
+    get_and_validate_dataset,
+    sdk_config,
+    split_s3_path,
+)
+from uploader.errors import UnreadableFileError
+from uploader.validation import (
+    dataset_schema,
+    file_format,
+    file_schema,
+    schema_mismatches,
+    type_name,
+)
+
+patch_all()
+
+logger = logging.getLogger()
+logger.setLevel(os.environ.get("LOG_LEVEL", logging.INFO))
+
+
+@functools.cache
+def _s3_client():
+    return boto3.client("s3", region_name=os.environ["AWS_REGION"])
+
+
+def _mismatch_error(mismatches):
+    columns = ", ".join(
+        f"{m['column']} ({m['type']}, {m['expected']})" for m in mismatches
+    )
+    return {
+        "message": {
+            "nb": f"Kolonnetypene i filen stemmer ikke med datasettet: {columns}",
+            "en": f"The column types of the file don't match the dataset: {columns}",
+        }
+    }
+
+
+@status_wrapper(sdk_config())
+@logging_wrapper
+@xray_recorder.capture("validate_upload")
+def upload_validation_handler(event, context):
+    """Check the schema of an uploaded file against its dataset.
+
+    Triggered by S3 when a file is uploaded to an edition. Only a bounded part
+    of the file is read (see `uploader.validation`), and any column types
+    that don't match the dataset are reported on the status trace of the
+    upload. Files not tagged with a trace (i.e. not uploaded through a signed
+    POST or multipart upload) are left alone, as are files of datasets
+    without a `latest` Delta table to compare with. So are files named like
+    the raw files of event datasets, without even looking them up.
+    """
+    # S3 notifies of one object per event.
+    record = event["Records"][0]
+    bucket = record["s3"]["bucket"]["name"]
+    key = unquote_plus(record["s3"]["object"]["key"])
+
+    log_add(s3_path=key, file_format=file_format(key))
+
+    if file_format(key) is None:
+        return {"statusCode": 200}
+
+    # Every push of events writes these; they're never traced.
+    if os.path.basename(key) in (RAW_EVENTS_JSON, RAW_EVENTS_IPC, RAW_DELETES):
+        log_add(raw_events=True)
+        return {"statusCode": 200}
+
+    head = _s3_client().head_object(Bucket=bucket, Key=key)
+    trace_id = head["Metadata"].get(TRACE_ID_METADATA)
+
+    log_add(trace_id=trace_id)
+
+    if trace_id is None:
+        return {"statusCode": 200}
+
+    dataset_id, version, _edition, _filename = split_s3_path(key)
+
+    status_add(trace_id=trace_id, domain="dataset", domain_id=f"{dataset_id}/{version}")
+    log_add(dataset_id=dataset_id, dataset_version=version)
+
+    dataset = get_and_validate_dataset(dataset_id)
+    dataset_types = dataset_schema(
+        generate_s3_path(
+            dataset, f"{dataset_id}/{version}/latest", "processed", absolute=True
+        )
+    )
+
+    if dataset_types is None:
+        # Nothing to compare with, so the file isn't even read.
+        log_add(validated=False)
+        return {"statusCode": 200}
+
+    try:
+        file_types = file_schema(bucket, key, head["ContentLength"])
+    except UnreadableFileError as e:
+        log_exception(e)
+        status_add(
+            trace_event_status=TraceEventStatus.FAILED,
+            errors=[
+                {
+                    "message": {
+                        "nb": "Filen kunne ikke leses.",
+                        "en": "The file could not be read.",
+                    }
+                }
+            ],
+        )
+        return {"statusCode": 400}
+
+    if file_types is None:
+        # Nothing to compare.
+        log_add(validated=False)
+        return {"statusCode": 200}
+
+    mismatches = schema_mismatches(file_types, dataset_types)
+    new_columns = sorted(set(file_types) - set(dataset_types))
+
+    log_add(
+        validated=True,
+        mismatch_count=len(mismatches),
+        new_columns=new_columns,
+    )
+
+    status_add(
+        status_body={
+            "schema": {c: type_name(t) for c, t in file_types.items()},
+            "mismatches": mismatches,
+            "new_columns": new_columns,
+        }
+    )
+
+    if mismatches:
+        # The trace is left open; the rest of the pipeline decides whether
+        # the file can be processed after all.
+        status_add(
+            trace_event_status=TraceEventStatus.FAILED,
+            errors=[_mismatch_error(mismatches)],
+        )
+
+    return {"statusCode": 200}
@@ -0,0 +1,61 @@
+"""Inference of column types, the same for every way data comes in.
+
+Events pushed to a dataset and the heads of uploaded files (see
+`uploader.validation`) alike are read into frames by `dataframe_from_dict`,
+with dates and timestamps in string columns recognized by
+`infer_column_dtype_from_input`.
+"""
+
+import pandas as pd
+import pyarrow as pa
+
+from uploader.profiling import memory_usage, stage
+
+
+def dataframe_from_dict(data):
+    # Construct DataFrame from `data`, a list of events or a pyarrow table of
+    # them. Drop empty columns and convert columns to the best possible
+    # dtypes using pyarrow.
+    with stage("parse") as metrics:
+        if isinstance(data, pa.Table):
+            df = data.to_pandas(types_mapper=pd.ArrowDtype)
+        else:
+            df = pd.DataFrame.from_dict(data)
+        df = df.dropna(how="all", axis="columns")
+        metrics["rows"] = len(df)
+
+    with stage("infer") as metrics:
+        df = df.convert_dtypes(dtype_backend="pyarrow")
+        df = df.apply(infer_column_dtype_from_input)
+        metrics.update(rows=len(df), bytes=memory_usage(df))
+
+    return df
+
+
+def infer_column_dtype_from_input(col):
+    recognized_datetime_formats = [
+        "%Y-%m-%dT%H:%M:%S",
+        "%Y-%m-%dT%H:%M:%SZ",
+        "%Y-%m-%dT%H:%M:%S%z",
+        "%Y-%m-%dT%H:%M:%S.%f",
+        "%Y-%m-%dT%H:%M:%S.%fZ",
+        "%Y-%m-%dT%H:%M:%S.%f%z",
+    ]
+
+    # Detect columns containing date(time) values and attempt casting to relevant
+    # dtype. If it fails, keep existing string type.
+    if getattr(col.dtypes, "pyarrow_dtype", None) == "string":
+        try:
+            series = pd.to_datetime(col, format="%Y-%m-%d")
+            return series.astype(pd.ArrowDtype(pa.date64()))
+        except ValueError:
+            pass
+
+        for dt_format in recognized_datetime_formats:
+            try:
+                series = pd.to_datetime(col, format=dt_format, utc=True)
+                return series.astype(pd.ArrowDtype(pa.timestamp("us", tz="UTC")))
+            except ValueError:
+                pass
+
+    return col
@@ -0,0 +1,92 @@
+"""Presigned multipart uploads for files too large for a single signed POST.
+
+The client creates a multipart upload, requests presigned URLs for ranges of
+part numbers, PUTs the parts (in parallel, retrying only the ones that fail),
+and finally completes (or aborts) the upload.
+"""
+
+import functools
+import os
+
+import boto3
+from botocore.client import Config as BotoConfig
+
+# S3 supports part numbers 1 through 10 000.
+MAX_PART_NUMBER = 10000
+
+# Maximum number of part URLs to sign per request.
+MAX_PARTS_PER_REQUEST = 1000
+
+# Parts may be large; give the client some time to upload each of them.
+PART_URL_EXPIRES_IN = 3600
+
+
+@functools.cache
+def _s3_client():
+    # Path adressing style (which needs region specified) used because CORS
+    # doesn't propagate on global URIs immediately.
+    return boto3.client(
+        "s3",
+        region_name=os.environ["AWS_REGION"],
+        config=BotoConfig(signature_version="s3v4", s3={"addressing_style": "path"}),
+    )
+
+
+def create_multipart_upload(bucket, key, metadata=None):
+    """Create a multipart upload to `key` in `bucket` and return its ID.
+
+    The completed file is stored with the S3 object metadata `metadata`.
+    """
+    res = _s3_client().create_multipart_upload(
+        Bucket=bucket, Key=key, ACL="private", Metadata=metadata or {}
+    )
+    return res["UploadId"]
+
+
+def generate_signed_part_urls(bucket, key, upload_id, first_part, last_part):
+    """Return presigned URLs for uploading parts `first_part`..`last_part`.
+
+    The result is a list of `{"partNumber": ..., "url": ...}` dictionaries,
+    one per part. Each part is uploaded with a PUT to its URL.
+    """
+    s3 = _s3_client()
+    return [
+        {
+            "partNumber": part_number,
+            "url": s3.generate_presigned_url(
+                "upload_part",
+                Params={
+                    "Bucket": bucket,
+                    "Key": key,
+                    "UploadId": upload_id,
+                    "PartNumber": part_number,
+                },
+                ExpiresIn=PART_URL_EXPIRES_IN,
+            ),
+        }
+        for part_number in range(first_part, last_part + 1)
+    ]
+
+
+def complete_multipart_upload(bucket, key, upload_id, parts):
+    """Complete the multipart upload `upload_id` from the uploaded `parts`.
+
+    `parts` is a list of `{"partNumber": ..., "etag": ...}` dictionaries, the
+    ETags being the ones S3 returned when each part was uploaded.
+    """
+    _s3_client().complete_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [
+                {"PartNumber": p["partNumber"], "ETag": p["etag"]}
+                for p in sorted(parts, key=lambda p: p["partNumber"])
+            ]
+        },
+    )
+
+
+def abort_multipart_upload(bucket, key, upload_id):
+    """Abort the multipart upload `upload_id`, discarding uploaded parts."""
+    _s3_client().abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
@@ -0,0 +1,119 @@
+"""Partitioning of event datasets.
+
+A dataset is partitioned by the `partitionBy` list in its source metadata.
+Each entry is either the name of a column to partition by as is, or a
+partition column derived from a timestamp column:
+
+    {"name": "date", "column": "timestamp", "transform": "day"}
+
+Once a dataset is partitioned, adding events to it only reads and rewrites
+the partitions present among the events.
+"""
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from uploader.errors import InvalidTypeError
+from uploader.predicates import keys_filter, keys_predicate
+
+TRANSFORMS = {
+    "year": "%Y",
+    "month": "%Y-%m",
+    "day": "%Y-%m-%d",
+}
+
+
+def partition_spec(dataset):
+    """Return the partition specification of `dataset` in its long form.
+
+    Raise `ValueError` if the specification is invalid.
+    """
+    spec = []
+
+    for entry in dataset.get("source", {}).get("partitionBy", []):
+        if isinstance(entry, str):
+            entry = {"name": entry, "column": entry}
+        try:
+            name, column = entry["name"], entry["column"]
+        except (KeyError, TypeError):
+            raise ValueError("Invalid `partitionBy`")
+        transform = entry.get("transform")
+        if transform is None and name != column:
+            raise ValueError("Invalid `partitionBy`")
+        if transform is not None and transform not in TRANSFORMS:
+            raise ValueError(f"Invalid `partitionBy` transform: {transform}")
+        spec.append({"name": name, "column": column, "transform": transform})
+
+    return spec
+
+
+def partition_names(spec):
+    return [p["name"] for p in spec]
+
+
+def table_partitions(table):
+    """Return the partition columns of Delta `table`.
+
+    Return `None` if `table` is `None`, i.e. there is no table yet.
+    """
+    if table is None:
+        return None
+    return table.metadata().partition_columns
+
+
+def derive_partition(values, p):
+    """Return partition `p` of the pyarrow array `values` it's taken from."""
+    if not p["transform"]:
+        return values
+    if not (pa.types.is_timestamp(values.type) or pa.types.is_date(values.type)):
+        raise InvalidTypeError(
+            f"Cannot partition by {p['transform']} of non-timestamp column: "
+            f"{p['column']}"
+        )
+    return pc.strftime(values, TRANSFORMS[p["transform"]])
+
+
+def add_partition_columns(df, spec):
+    """Add the partition columns in `spec` to `df`.
+
+    Rows missing the column a partition is taken from end up in the null
+    partition.
+    """
+    for p in spec:
+        if p["column"] in df:
+            values = derive_partition(pa.array(df[p["column"]]), p)
+        else:
+            values = pa.nulls(len(df), pa.string())
+        df[p["name"]] = pd.Series(
+            values, index=df.index, dtype=pd.ArrowDtype(values.type)
+        )
+    return df
+
+
+def _partition_keys(df, name):
+    return [{name: None if pd.isna(v) else v} for v in df[name].drop_duplicates()]
+
+
+def partition_filter(df, names):
+    """Return a pyarrow expression matching the partitions present in `df`."""
+    expression = None
+
+    for name in names:
+        column = keys_filter(_partition_keys(df, name), [name])
+        expression = column if expression is None else expression & column
+
+    return expression
+
+
+def partition_predicate(df, names):
+    """Return a Delta predicate matching the partitions present in `df`.
+
+    The predicate matches exactly what `partition_filter` does, so that
+    overwriting the rows read through the filter with it leaves the other
+    partitions alone.
+    """
+    return " AND ".join(
+        "({})".format(keys_predicate(_partition_keys(df, name), [name]))
+        for name in names
+    )
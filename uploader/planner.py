@@ -0,0 +1,139 @@
+"""Planning how to add events to a dataset within the memory available.
+
+Before anything is read, the memory needed to add the incoming events to a
+dataset is estimated from the Delta log of the dataset (row counts, file
+sizes and column types) and the size of the events, and compared with the
+memory the function has left. The plan is one of:
+
+- `IN_MEMORY`: Read the whole dataset and merge with pandas.
+- `CHUNKED`: Stream the dataset through one file at a time.
+- `REJECTED`: Not even streaming is expected to fit.
+
+The model below is deliberately simple. Both the estimate and the actual peak
+memory are logged for every run (`memory_plan` and `memory_peak_bytes`), so
+that the factors can be calibrated against real workloads.
+"""
+
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from uploader.profiling import rss_bytes
+
+IN_MEMORY = "in-memory"
+CHUNKED = "chunked"
+REJECTED = "rejected"
+
+# In-memory size of variable width data (strings, mostly) relative to the
+# size of the Parquet files.
+PARQUET_EXPANSION = 4
+
+# In-memory size of parsed events relative to their size as JSON.
+EVENTS_EXPANSION = 2
+
+# Peak memory relative to the in-memory size of the dataset when merging
+# (`upsert`) and appending (`concat`) in memory, including the copy
+# made when writing.
+MERGE_FACTOR = 4
+APPEND_FACTOR = 3
+
+# Peak memory relative to the in-memory size of the largest file when
+# streaming.
+CHUNK_FACTOR = 3
+
+# Share of the function's memory that a plan may use.
+MEMORY_HEADROOM = 0.9
+
+
+def table_stats(table):
+    """Return statistics on Delta `table`, read from its log.
+
+    `table` is loaded with its files (see `uploader.storage.open_table`).
+    Return `None` if `table` is `None`, i.e. there is no table yet.
+    """
+    if table is None:
+        return None
+
+    files = pa.table(table.get_add_actions(flatten=True))
+    fixed_row_bytes = 0
+    variable_columns = 0
+
+    for field in pa.schema(table.schema().to_arrow()):
+        try:
+            fixed_row_bytes += max(field.type.bit_width // 8, 1)
+        except ValueError:
+            variable_columns += 1
+
+    return {
+        "rows": pc.sum(files["num_records"]).as_py() or 0,
+        "files": files.num_rows,
+        "file_bytes": pc.sum(files["size_bytes"]).as_py() or 0,
+        "largest_file_bytes": pc.max(files["size_bytes"]).as_py() or 0,
+        "fixed_row_bytes": fixed_row_bytes,
+        "variable_columns": variable_columns,
+    }
+
+
+def _table_bytes(stats):
+    fixed = stats["rows"] * stats["fixed_row_bytes"]
+    variable = (
+        stats["file_bytes"] * PARQUET_EXPANSION if stats["variable_columns"] else 0
+    )
+    return fixed + variable
+
+
+def _available_bytes():
+    # Set by Lambda; without it there is no known limit. What's in use now
+    # counts against it, not the peak of earlier invocations of a warm
+    # function.
+    memory_size = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    if not memory_size:
+        return None
+    return int(int(memory_size) * 1024 * 1024 * MEMORY_HEADROOM) - rss_bytes()
+
+
+def plan(table, events_bytes, merge_on, expansion=EVENTS_EXPANSION):
+    """Plan adding `events_bytes` of events to the dataset's Delta `table`.
+
+    `table` is `None` if the dataset has no table yet.
+
+    `expansion` is the in-memory size of the parsed events relative to
+    `events_bytes`; the default is for events as JSON.
+
+    Return a dictionary with the chosen `strategy`, its `estimated_bytes`,
+    the estimates for both strategies, and the `available_bytes`.
+    """
+    events = events_bytes * expansion
+    available = _available_bytes()
+
+    # Without a known limit there's nothing to plan for.
+    stats = None if available is None else table_stats(table)
+
+    if stats is None:
+        in_memory = chunked = events
+    else:
+        table = _table_bytes(stats)
+        largest_file = (
+            table * stats["largest_file_bytes"] // stats["file_bytes"]
+            if stats["file_bytes"]
+            else table
+        )
+        in_memory = table * (MERGE_FACTOR if merge_on else APPEND_FACTOR) + events
+        chunked = largest_file * CHUNK_FACTOR + events * MERGE_FACTOR
+
+    if stats is None or in_memory <= available:
+        strategy, estimated = IN_MEMORY, in_memory
+    elif chunked <= available:
+        strategy, estimated = CHUNKED, chunked
+    else:
+        strategy, estimated = REJECTED, chunked
+
+    return {
+        "strategy": strategy,
+        "estimated_bytes": estimated,
+        "in_memory_bytes": in_memory,
+        "chunked_bytes": chunked,
+        "available_bytes": available,
+        "rows": stats["rows"] if stats else 0,
+    }
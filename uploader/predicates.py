@@ -0,0 +1,91 @@
+"""Predicates on Delta tables, as SQL for deltalake and as pyarrow expressions.
+
+Both forms of a predicate built here match the same rows, so that rows read
+through the pyarrow expression are exactly the ones a deltalake operation
+given the SQL touches.
+"""
+
+import datetime
+import math
+
+import pyarrow.compute as pc
+
+from uploader.errors import InvalidTypeError
+
+
+def sql_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def sql_literal(value):
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float) and math.isfinite(value):
+        return repr(value)
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return f"DATE '{value.isoformat()}'"
+    raise InvalidTypeError(f"Unsupported value in predicate: {value!r}")
+
+
+def _sql_equals(column, value):
+    if value is None:
+        return f"{sql_identifier(column)} IS NULL"
+    return f"{sql_identifier(column)} = {sql_literal(value)}"
+
+
+def _equals(column, value):
+    if value is None:
+        return pc.field(column).is_null()
+    return pc.field(column) == value
+
+
+def _single_column(keys, columns):
+    # Keys on a single column are matched with `IN` rather than a long chain
+    # of `OR`s.
+    values = {key[columns[0]] for key in keys}
+    return None in values, sorted(values - {None}, key=lambda v: (type(v).__name__, v))
+
+
+def keys_predicate(keys, columns):
+    """Return SQL matching rows whose `columns` equal any of `keys`.
+
+    `keys` are dictionaries with a value for each of `columns`.
+    """
+    if len(columns) == 1:
+        column = sql_identifier(columns[0])
+        has_null, values = _single_column(keys, columns)
+        terms = []
+        if values:
+            terms.append(
+                "{} IN ({})".format(column, ", ".join(map(sql_literal, values)))
+            )
+        if has_null:
+            terms.append(f"{column} IS NULL")
+        return " OR ".join(terms)
+
+    return " OR ".join(
+        "({})".format(" AND ".join(_sql_equals(c, key[c]) for c in columns))
+        for key in keys
+    )
+
+
+def keys_filter(keys, columns):
+    """Return a pyarrow expression matching the same rows as `keys_predicate`."""
+    if len(columns) == 1:
+        has_null, values = _single_column(keys, columns)
+        expression = pc.field(columns[0]).isin(values)
+        return expression | pc.field(columns[0]).is_null() if has_null else expression
+
+    expression = None
+
+    for key in keys:
+        match = None
+        for c in columns:
+            match = _equals(c, key[c]) if match is None else match & _equals(c, key[c])
+        expression = match if expression is None else expression | match
+
+    return expression
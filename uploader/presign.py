@@ -0,0 +1,117 @@
+"""Native SigV4 signing of presigned S3 POST policies.
+
+Produces the same URL and form fields as boto3's `generate_presigned_post`
+(with path style addressing), without the overhead of building an S3 client
+and running it through botocore's request pipeline on every call.
+
+Signing keys are derived once per day, region and credential set, and cached
+for the lifetime of the container.
+"""
+
+import base64
+import functools
+import hashlib
+import hmac
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import boto3
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+SERVICE = "s3"
+
+
+@functools.cache
+def _credential_provider():
+    return boto3.Session().get_credentials()
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+@functools.lru_cache(maxsize=8)
+def signing_key(secret_key, date_stamp, region, service=SERVICE):
+    """Return the SigV4 signing key for `date_stamp` (formatted `%Y%m%d`)."""
+    k_date = _hmac(f"AWS4{secret_key}".encode("utf-8"), date_stamp)
+    k_region = _hmac(k_date, region)
+    k_service = _hmac(k_region, service)
+    return _hmac(k_service, "aws4_request")
+
+
+def generate_presigned_post(
+    bucket,
+    key,
+    fields=None,
+    conditions=None,
+    expires_in=3600,
+    region=None,
+    credentials=None,
+):
+    """Return a presigned POST for uploading `key` to `bucket`.
+
+    Mirrors boto3's `generate_presigned_post`: `fields` and `conditions` are
+    prefilled form fields and extra policy conditions, e.g.
+    `["content-length-range", 1, 1024]` or `{"Content-Type": "text/csv"}`.
+    The returned dictionary has the same `url` and `fields` as boto3 returns
+    for a path style addressed client.
+
+    `credentials` defaults to the frozen credentials of the default boto3
+    session, and `region` to the `AWS_REGION` environment variable.
+    """
+    region = region or os.environ["AWS_REGION"]
+    credentials = credentials or _credential_provider().get_frozen_credentials()
+
+    fields = {} if fields is None else fields.copy()
+    conditions = [] if conditions is None else list(conditions)
+
+    conditions.append({"bucket": bucket})
+
+    if key.endswith("${filename}"):
+        conditions.append(["starts-with", "$key", key[: -len("${filename}")]])
+    else:
+        conditions.append({"key": key})
+
+    fields["key"] = key
+
+    now = datetime.now(timezone.utc)
+    timestamp = now.strftime("%Y%m%dT%H%M%SZ")
+    date_stamp = timestamp[0:8]
+    credential = "/".join(
+        [credentials.access_key, date_stamp, region, SERVICE, "aws4_request"]
+    )
+
+    fields["x-amz-algorithm"] = ALGORITHM
+    fields["x-amz-credential"] = credential
+    fields["x-amz-date"] = timestamp
+
+    conditions.append({"x-amz-algorithm": ALGORITHM})
+    conditions.append({"x-amz-credential": credential})
+    conditions.append({"x-amz-date": timestamp})
+
+    if credentials.token is not None:
+        fields["x-amz-security-token"] = credentials.token
+        conditions.append({"x-amz-security-token": credentials.token})
+
+    policy = {
+        "expiration": (now + timedelta(seconds=expires_in)).strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        ),
+        "conditions": conditions,
+    }
+    fields["policy"] = base64.b64encode(json.dumps(policy).encode("utf-8")).decode(
+        "utf-8"
+    )
+    fields["x-amz-signature"] = hmac.new(
+        signing_key(credentials.secret_key, date_stamp, region),
+        fields["policy"].encode("utf-8"),
+        hashlib.sha256,
+    ).hexdigest()
+
+    # Path adressing style (which needs region specified) used because CORS
+    # doesn't propagate on global URIs immediately.
+    return {
+        "url": f"https://s3.{region}.amazonaws.com/{bucket}",
+        "fields": fields,
+    }
@@ -0,0 +1,170 @@
+"""Per-stage profiling of the dataset pipeline.
+
+`profile` wraps one run of a pipeline, and `stage` each of its stages:
+
+    with profile(dataset_id=dataset_id):
+        with stage("read") as metrics:
+            df = read()
+            metrics["rows"] = len(df)
+
+For every stage the duration, any row and byte counts the stage reports, and
+the process' memory high-water mark are recorded. When the run ends, each
+stage is emitted as a CloudWatch embedded metric format (EMF) record, with
+the stage and the profile's dimensions (e.g. the dataset ID) as dimensions,
+and the stages are added to the log. Each stage is also traced as an X-Ray
+subsegment.
+
+Set `PROFILE_TRACEMALLOC=true` to also record the peak memory allocated
+through Python during each stage; this slows down allocation heavy stages
+noticeably, so it's off by default.
+
+Outside of `profile`, `stage` records nothing.
+"""
+
+import json
+import os
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from aws_xray_sdk.core import xray_recorder
+from okdata.aws.logging import log_add
+
+METRICS_NAMESPACE = "DataUploader"
+
+PROFILE_TRACEMALLOC = os.environ.get("PROFILE_TRACEMALLOC", "false") == "true"
+
+# Metric name and unit for each recorded measurement.
+METRICS = {
+    "duration_ms": ("Duration", "Milliseconds"),
+    "rows": ("Rows", "Count"),
+    "bytes": ("Bytes", "Bytes"),
+    "max_rss_bytes": ("MaxRSS", "Bytes"),
+    "max_rss_increase_bytes": ("MaxRSSIncrease", "Bytes"),
+    "tracemalloc_peak_bytes": ("TracemallocPeak", "Bytes"),
+}
+
+_profile = None
+
+
+def max_rss_bytes():
+    """Return the peak resident set size of the process so far, in bytes."""
+    # ru_maxrss is in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def rss_bytes():
+    """Return the resident set size of the process right now, in bytes.
+
+    Unlike `max_rss_bytes`, this goes down again as memory is freed, e.g.
+    between invocations of a warm function. Fall back to the peak where
+    `/proc` isn't available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return max_rss_bytes()
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def memory_usage(df):
+    """Return the bytes held by the columns of frame `df`.
+
+    Cheap for pyarrow backed columns; the buffers report their own size.
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+
+@contextmanager
+def profile(**dimensions):
+    """Profile the stages run within the block.
+
+    `dimensions` are added as dimensions to every metric, e.g.
+    `dataset_id="my-dataset"` becomes the dimension `DatasetId`.
+    """
+    global _profile
+
+    started_tracemalloc = PROFILE_TRACEMALLOC and not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+
+    _profile = {"dimensions": dimensions, "stages": []}
+    try:
+        yield
+    finally:
+        stages = _profile["stages"]
+        _profile = None
+        if started_tracemalloc:
+            tracemalloc.stop()
+        _emit(dimensions, stages)
+
+
+@contextmanager
+def stage(name):
+    """Profile the stage `name` of the current profile.
+
+    Yield a dictionary to which the stage can add its `rows` and `bytes`
+    counts.
+    """
+    metrics = {}
+
+    if _profile is None:
+        yield metrics
+        return
+
+    stages = _profile["stages"]
+    max_rss_before = max_rss_bytes()
+    if PROFILE_TRACEMALLOC:
+        tracemalloc.reset_peak()
+
+    with xray_recorder.in_subsegment(name) as subsegment:
+        start = time.perf_counter_ns()
+        try:
+            yield metrics
+        finally:
+            metrics["duration_ms"] = (time.perf_counter_ns() - start) / 1000000.0
+            metrics["max_rss_bytes"] = max_rss_bytes()
+            metrics["max_rss_increase_bytes"] = (
+                metrics["max_rss_bytes"] - max_rss_before
+            )
+            if PROFILE_TRACEMALLOC:
+                metrics["tracemalloc_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+
+            stages.append({"stage": name, **metrics})
+            if subsegment is not None:
+                subsegment.put_metadata("metrics", metrics, "profile")
+
+
+def _dimension_name(key):
+    return "".join(part.capitalize() for part in key.split("_"))
+
+
+def _emit(dimensions, stages):
+    dimension_values = {_dimension_name(k): v for k, v in dimensions.items()}
+    timestamp = int(time.time() * 1000)
+
+    for s in stages:
+        metrics = {METRICS[k]: v for k, v in s.items() if k in METRICS}
+        record = {
+            "_aws": {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [["Stage"], [*dimension_values, "Stage"]],
+                        "Metrics": [
+                            {"Name": metric, "Unit": unit} for metric, unit in metrics
+                        ],
+                    }
+                ],
+            },
+            **dimension_values,
+            "Stage": s["stage"],
+            **{metric: value for (metric, _unit), value in metrics.items()},
+        }
+        # Lambda ships stdout to CloudWatch Logs, which extracts the metrics.
+        print(json.dumps(record), flush=True)
+
+    log_add(profile=stages)
@@ -1,6 +1,47 @@
 import json
+import os
+
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+MODELS_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "doc", "models")
+
+
+def _load_models():
+    models = {}
+    for filename in sorted(os.listdir(MODELS_DIR)):
+        name, ext = os.path.splitext(filename)
+        if ext == ".json":
+            with open(os.path.join(MODELS_DIR, filename)) as f:
+                models[name] = json.loads(f.read())
+    return models
+
+
+def _compile_validators(models):
+    validators = {}
+    for name, schema in models.items():
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        validators[name] = cls(schema)
+    return validators
+
+
+# Models and their validators are loaded once per container, and the schemas
+# checked up front instead of on every request.
+MODELS = _load_models()
+VALIDATORS = _compile_validators(MODELS)
 
 
 def get_model_schema(name):
-    with open(f"doc/models/{name}.json") as f:
-        return json.loads(f.read())
+    return MODELS[name]
+
+
+def validate(instance, model_name):
+    """Validate `instance` against the model named `model_name`.
+
+    Raise `jsonschema.ValidationError` with the most relevant error if
+    `instance` doesn't conform to the model, like `jsonschema.validate` does.
+    """
+    error = best_match(VALIDATORS[model_name].iter_errors(instance))
+    if error is not None:
+        raise error
@@ -0,0 +1,120 @@
+"""Cached secrets from the SSM Parameter Store.
+
+The first lookup fetches all of `SECRETS` (plus the one asked for) in one
+batched call. Secrets among them that are missing or can't be read only fail
+lookups of those very secrets. Secrets are then served from the cache; once
+they're older than `SECRET_TTL` the cached values keep being served while
+fresh ones are fetched in the background. Rotated secrets are picked up that
+way, without lookups in warm containers ever waiting on SSM.
+"""
+
+import functools
+import logging
+import os
+import threading
+import time
+
+import boto3
+from botocore.client import Config as BotoConfig
+from botocore.exceptions import ClientError
+
+from uploader.errors import SecretNotFoundError
+
+logger = logging.getLogger()
+
+# Seconds before a cached secret is refreshed.
+SECRET_TTL = 300
+
+# Secrets used by the service, fetched together on the first lookup.
+SECRETS = [
+    "/dataplatform/data-uploader/keycloak-client-secret",
+    "/dataplatform/shared/email-api-key",
+]
+
+# `GetParameters` accepts at most 10 names per call.
+BATCH_SIZE = 10
+
+_cache = {}
+_lock = threading.Lock()
+_refreshing = False
+
+
+@functools.cache
+def _ssm_client():
+    return boto3.client(
+        "ssm",
+        region_name=os.environ["AWS_REGION"],
+        config=BotoConfig(
+            connect_timeout=2, read_timeout=5, retries={"max_attempts": 3}
+        ),
+    )
+
+
+def _fetch(names):
+    # Cache the values of `names`, returning the names without a value.
+    names = list(dict.fromkeys(names))
+    invalid = []
+
+    for i in range(0, len(names), BATCH_SIZE):
+        res = _ssm_client().get_parameters(
+            Names=names[i : i + BATCH_SIZE], WithDecryption=True
+        )
+        fetched_at = time.monotonic()
+        with _lock:
+            for parameter in res["Parameters"]:
+                _cache[parameter["Name"]] = (parameter["Value"], fetched_at)
+        invalid += res["InvalidParameters"]
+
+    if invalid:
+        logger.warning(f"No such secret(s): {', '.join(invalid)}")
+    return invalid
+
+
+def _refresh(names):
+    global _refreshing
+
+    try:
+        _fetch(names)
+    except Exception:
+        # Keep serving the cached values; the next lookup tries again.
+        logger.exception("Could not refresh secrets")
+    finally:
+        _refreshing = False
+
+
+def get_secret(name):
+    """Return the secret (SecureString) stored in SSM under `name`.
+
+    Raise `SecretNotFoundError` if there is no such secret, and
+    `botocore.exceptions.ClientError` if it couldn't be fetched for some other
+    reason, such as missing permissions. Failing background refreshes are
+    only logged.
+    """
+    global _refreshing
+
+    with _lock:
+        cached = _cache.get(name)
+        refresh = (
+            cached is not None
+            and time.monotonic() - cached[1] > SECRET_TTL
+            and not _refreshing
+        )
+        if refresh:
+            _refreshing = True
+            names = list(_cache)
+
+    if cached is None:
+        try:
+            missing = _fetch([*SECRETS, name])
+        except ClientError:
+            # A single secret we may not read fails the whole batch.
+            logger.exception("Could not fetch secrets in a batch")
+            missing = _fetch([name])
+        if name in missing:
+            raise SecretNotFoundError(f"No such secret: {name}")
+        return _cache[name][0]
+
+    if refresh:
+        threading.Thread(target=_refresh, args=(names,), daemon=True).start()
+
+    return cached[0]
@@ -0,0 +1,232 @@
+"""Local cache of Delta table snapshots for warm Lambda containers.
+
+Consecutive writes to a dataset often land on the same container. Rather than
+downloading all of `latest` each time, the Delta log and data files of the
+most recently used tables are mirrored under `/tmp`, and read from there by
+deltalake like any local table. On the next read only the commits and data
+files added since are fetched. Data files in a Delta table are never
+modified, only added and removed, so a cached file stays valid as long as
+the table references it.
+
+Before a cached table is used, the newest commit in it is checked against
+the one in S3, so that a table that has been cleared out and written anew
+(e.g. when repartitioned) isn't mistaken for the cached one.
+
+Tables are evicted least recently used first to keep the cache within a
+share of the ephemeral storage. A Lambda container handles one event at a
+time, so the cache isn't guarded against concurrent use.
+"""
+
+import functools
+import hashlib
+import os
+import shutil
+import tempfile
+from urllib.parse import unquote
+
+import boto3
+import deltalake as dl
+import pyarrow as pa
+from botocore.exceptions import BotoCoreError, ClientError
+from deltalake.exceptions import DeltaError
+from okdata.aws.logging import log_add, log_exception
+
+from uploader.profiling import stage
+from uploader.storage import storage_options
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "delta-snapshots")
+
+# Share of the ephemeral storage the cache may take up.
+CACHE_SHARE = 0.5
+
+LOG_DIR = "_delta_log"
+
+
+@functools.cache
+def _s3_client():
+    return boto3.client("s3", region_name=os.environ["AWS_REGION"])
+
+
+def _split_s3_path(s3_path):
+    bucket, _, prefix = s3_path.removeprefix("s3://").partition("/")
+    return bucket, prefix.rstrip("/")
+
+
+def _commit_name(version):
+    return f"{version:020}.json"
+
+
+def _cache_budget():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return int(shutil.disk_usage(CACHE_DIR).total * CACHE_SHARE)
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _dirs, files in os.walk(path)
+        for f in files
+    )
+
+
+def _remote_table(s3_path, version):
+    return dl.DeltaTable(s3_path, version=version, storage_options=storage_options())
+
+
+def snapshot(s3_path, version):
+    """Return the Delta table at `s3_path` as of `version`.
+
+    The table is read from the local cache, brought up to date with `version`
+    first. If the table doesn't fit in the cache, or caching it fails, the
+    table in S3 is returned instead.
+    """
+    local_path = os.path.join(CACHE_DIR, hashlib.sha256(s3_path.encode()).hexdigest())
+
+    try:
+        with stage("snapshot") as metrics:
+            table, fetched_files, fetched_bytes = _sync(s3_path, local_path, version)
+            metrics.update(rows=fetched_files, bytes=fetched_bytes)
+    except (BotoCoreError, ClientError, DeltaError, OSError) as e:
+        log_exception(e)
+        shutil.rmtree(local_path, ignore_errors=True)
+        return _remote_table(s3_path, version)
+
+    if table is None:
+        log_add(snapshot_cached=False)
+        shutil.rmtree(local_path, ignore_errors=True)
+        return _remote_table(s3_path, version)
+
+    log_add(
+        snapshot_cached=True,
+        snapshot_fetched_files=fetched_files,
+        snapshot_fetched_bytes=fetched_bytes,
+    )
+    _evict(keep=local_path)
+    return table
+
+
+def _sync(s3_path, local_path, version):
+    # Bring the cached table at `local_path` up to date with `version` of the
+    # table at `s3_path`. Return the cached table (`None` if it's too large to
+    # cache) and the number of files and bytes fetched.
+    bucket, prefix = _split_s3_path(s3_path)
+    s3 = _s3_client()
+    log_path = os.path.join(local_path, LOG_DIR)
+    fetched_files = fetched_bytes = 0
+
+    cached = _cached_version(log_path)
+    if cached is not None and not _matches(
+        bucket, prefix, log_path, min(cached, version)
+    ):
+        shutil.rmtree(local_path)
+        cached = None
+
+    if cached is None:
+        # Fetch the whole log, starting from any checkpoint.
+        os.makedirs(log_path)
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/{LOG_DIR}/"):
+            for obj in page.get("Contents", []):
+                if "/" in obj["Key"].removeprefix(f"{prefix}/{LOG_DIR}/"):
+                    continue
+                s3.download_file(
+                    bucket,
+                    obj["Key"],
+                    os.path.join(log_path, os.path.basename(obj["Key"])),
+                )
+                fetched_files += 1
+                fetched_bytes += obj["Size"]
+    else:
+        # Fetch only the commits since the cached version.
+        for v in range(cached + 1, version + 1):
+            response = s3.get_object(
+                Bucket=bucket, Key=f"{prefix}/{LOG_DIR}/{_commit_name(v)}"
+            )
+            body = response["Body"].read()
+            with open(os.path.join(log_path, _commit_name(v)), "wb") as f:
+                f.write(body)
+            fetched_files += 1
+            fetched_bytes += len(body)
+
+    table = dl.DeltaTable(local_path, version=version)
+    add_actions = pa.table(table.get_add_actions(flatten=True))
+    files = dict(
+        zip(
+            (unquote(p) for p in add_actions["path"].to_pylist()),
+            add_actions["size_bytes"].to_pylist(),
+        )
+    )
+
+    if sum(files.values()) > _cache_budget():
+        return None, fetched_files, fetched_bytes
+
+    _remove_unreferenced(local_path, files)
+
+    for path, size in files.items():
+        file_path = os.path.join(local_path, path)
+        if os.path.exists(file_path) and os.path.getsize(file_path) == size:
+            continue
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        s3.download_file(bucket, f"{prefix}/{path}", file_path)
+        fetched_files += 1
+        fetched_bytes += size
+
+    # Mark the table as the most recently used one.
+    os.utime(local_path)
+    return table, fetched_files, fetched_bytes
+
+
+def _cached_version(log_path):
+    # Return the newest version of the cached table with its log at
+    # `log_path`, or `None` if the table isn't cached.
+    try:
+        names = os.listdir(log_path)
+    except FileNotFoundError:
+        return None
+    versions = [int(n.split(".")[0]) for n in names if n.endswith(".json")]
+    return max(versions, default=None)
+
+
+def _matches(bucket, prefix, log_path, version):
+    # Return whether commit `version` in the cached log at `log_path` is the
+    # same as the one in S3.
+    try:
+        response = _s3_client().get_object(
+            Bucket=bucket, Key=f"{prefix}/{LOG_DIR}/{_commit_name(version)}"
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return False
+        raise
+    with open(os.path.join(log_path, _commit_name(version)), "rb") as f:
+        return f.read() == response["Body"].read()
+
+
+def _remove_unreferenced(local_path, files):
+    # Remove the cached data files that are no longer part of the table.
+    for root, _dirs, names in os.walk(local_path):
+        if os.path.basename(root) == LOG_DIR:
+            continue
+        for name in names:
+            file_path = os.path.join(root, name)
+            if os.path.relpath(file_path, local_path) not in files:
+                os.remove(file_path)
+
+
+def _evict(keep):
+    # Evict the least recently used tables until the cache is within budget,
+    # but never the table at `keep`.
+    budget = _cache_budget()
+    tables = sorted(
+        (os.path.join(CACHE_DIR, name) for name in os.listdir(CACHE_DIR)),
+        key=os.path.getmtime,
+    )
+    sizes = {path: _dir_size(path) for path in tables}
+    total = sum(sizes.values())
+
+    for path in tables:
+        if total <= budget:
+            break
+        if path != keep:
+            shutil.rmtree(path)
+            total -= sizes[path]
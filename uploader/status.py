@@ -0,0 +1,66 @@
+"""Asynchronous creation of status traces.
+
+Trace IDs are generated locally and returned to the caller right away, while
+the status record itself is put on a queue and delivered to the status API by
+`uploader.handlers.handle_status_queue`. Neither a slow nor a failing status
+API (or queue) can hold up or fail the request that started the trace.
+"""
+
+import functools
+import json
+import os
+
+import boto3
+from botocore.client import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
+from okdata.aws.logging import log_add, log_duration, log_exception
+
+from uploader.common import generate_uuid
+
+
+@functools.cache
+def _sqs_client():
+    # Rather lose a trace than keep the caller waiting on a struggling queue.
+    return boto3.client(
+        "sqs",
+        region_name=os.environ["AWS_REGION"],
+        config=BotoConfig(
+            connect_timeout=1, read_timeout=2, retries={"max_attempts": 2}
+        ),
+    )
+
+
+@functools.cache
+def _queue_url():
+    return _sqs_client().get_queue_url(QueueName=os.environ["STATUS_QUEUE_NAME"])[
+        "QueueUrl"
+    ]
+
+
+def create_status_trace(status_data, trace_id=None):
+    """Start a new status trace described by `status_data`.
+
+    Return the ID of the new trace, which is `trace_id` if given. The trace is
+    created asynchronously; if queueing it fails, the error is logged and the
+    ID returned nonetheless.
+    """
+    if trace_id is None:
+        dataset_id = status_data["domain_id"].split("/")[0]
+        trace_id = generate_uuid(status_data.get("s3_path"), dataset_id)
+
+    log_add(trace_id=trace_id)
+
+    try:
+        log_duration(
+            lambda: _sqs_client().send_message(
+                QueueUrl=_queue_url(),
+                MessageBody=json.dumps(
+                    {"trace_status": "STARTED", **status_data, "trace_id": trace_id}
+                ),
+            ),
+            "duration_queue_status_trace",
+        )
+    except (BotoCoreError, ClientError) as e:
+        log_exception(e)
+
+    return trace_id
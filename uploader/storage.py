@@ -0,0 +1,40 @@
+import os
+
+import boto3
+import deltalake as dl
+from deltalake.exceptions import TableNotFoundError
+
+
+def storage_options():
+    """Return deltalake storage options for the current AWS credentials.
+
+    Commits are made with S3 conditional writes, so that concurrent writers
+    to a table can't overwrite each other's commits (where `awswrangler`
+    would allow an unsafe rename instead).
+    """
+    credentials = boto3.Session().get_credentials().get_frozen_credentials()
+    return {
+        "AWS_REGION": os.environ["AWS_REGION"],
+        "AWS_ACCESS_KEY_ID": credentials.access_key,
+        "AWS_SECRET_ACCESS_KEY": credentials.secret_key,
+        "AWS_SESSION_TOKEN": credentials.token or "",
+        "AWS_CONDITIONAL_PUT": "etag",
+    }
+
+
+def open_table(s3_path, version=None, without_files=False):
+    """Return the Delta table at `s3_path`, or `None` if there is none.
+
+    The table is loaded as of `version` if given, else its latest version.
+    If `without_files`, only its metadata (schema, partitioning) is loaded,
+    not the list of its files.
+    """
+    try:
+        return dl.DeltaTable(
+            s3_path,
+            version=version,
+            storage_options=storage_options(),
+            without_files=without_files,
+        )
+    except TableNotFoundError:
+        return None
@@ -0,0 +1,225 @@
+"""Early schema checks of uploaded files, from a few ranged reads.
+
+Only a bounded part of a file is ever read: the footer of a Parquet file, or
+the first chunk of a CSV or JSON file. The schema of the file is inferred
+from that the same way as for events pushed to a dataset (see
+`uploader.inference`), and compared with the schema of the dataset's Delta
+table. A check thus takes the same time however large the file is.
+
+For Parquet files the column types are taken from the footer, and dates and
+timestamps in string columns recognized from the column statistics.
+"""
+
+import csv
+import functools
+import io
+import json
+import os
+import struct
+
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from uploader.errors import InvalidEventsError, UnreadableFileError
+from uploader.formats import NDJSON, read_events
+from uploader.inference import dataframe_from_dict, infer_column_dtype_from_input
+from uploader.storage import open_table
+
+# Bytes to read from the start of CSV and JSON files.
+HEAD_SIZE = 1024 * 1024
+
+# Bytes to read from the end of Parquet files, enough for the footer of most
+# files in a single request.
+FOOTER_SIZE = 64 * 1024
+
+PARQUET_MAGIC = b"PAR1"
+
+FORMATS = {
+    ".parquet": "parquet",
+    ".csv": "csv",
+    ".json": "json",
+    ".jsonl": "ndjson",
+    ".ndjson": "ndjson",
+}
+
+CSV_DELIMITERS = ",;\t|"
+
+
+@functools.cache
+def _s3_client():
+    return boto3.client("s3", region_name=os.environ["AWS_REGION"])
+
+
+def file_format(key):
+    """Return the format of the file at `key`, or `None` if unsupported."""
+    return FORMATS.get(os.path.splitext(key)[1].lower())
+
+
+def _get_range(bucket, key, start, end):
+    response = _s3_client().get_object(
+        Bucket=bucket, Key=key, Range=f"bytes={start}-{end}"
+    )
+    return response["Body"].read()
+
+
+def file_schema(bucket, key, size):
+    """Return the inferred schema of the file at `key` of `size` bytes.
+
+    The schema is a dictionary of column names to pyarrow types (`None` for
+    columns of mixed types), or `None` for a JSON document too large to tell
+    the schema of from its start. Raise `UnreadableFileError` if the file
+    can't be read.
+    """
+    fmt = file_format(key)
+
+    if size == 0:
+        raise UnreadableFileError(f"Empty file: {key}")
+
+    if fmt == "parquet":
+        return _parquet_schema(bucket, key, size)
+
+    head = _get_range(bucket, key, 0, min(size, HEAD_SIZE) - 1)
+    truncated = size > HEAD_SIZE
+    if truncated:
+        if fmt == "json" and head.lstrip()[:1] == b"[":
+            return None
+        # Only keep whole lines.
+        head = head[: head.rfind(b"\n") + 1]
+
+    try:
+        if fmt == "csv":
+            df = _read_csv(head)
+        elif fmt == "json" and not truncated:
+            df = _read_json(head)
+        elif fmt in ("json", "ndjson"):
+            df = dataframe_from_dict(read_events(head, NDJSON))
+        else:
+            raise UnreadableFileError(f"Unsupported file format: {key}")
+    except (InvalidEventsError, ValueError, csv.Error) as e:
+        raise UnreadableFileError(f"Could not read {key}: {e}")
+
+    # Columns of mixed types have no single type.
+    return {c: getattr(df[c].dtype, "pyarrow_dtype", None) for c in df}
+
+
+def _read_csv(head):
+    try:
+        text = head.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        # Any bytes are valid Latin-1, as exported by older spreadsheets.
+        text = head.decode("latin-1")
+    dialect = csv.Sniffer().sniff(text.split("\n", 1)[0], delimiters=CSV_DELIMITERS)
+    df = pd.read_csv(io.StringIO(text), sep=dialect.delimiter, dtype_backend="pyarrow")
+    return dataframe_from_dict(pa.Table.from_pandas(df, preserve_index=False))
+
+
+def _read_json(head):
+    data = json.loads(head)
+    if not isinstance(data, list):
+        raise ValueError("Not a list of objects")
+    return dataframe_from_dict(data)
+
+
+def _parquet_schema(bucket, key, size):
+    footer = _get_range(bucket, key, max(size - FOOTER_SIZE, 0), size - 1)
+    if len(footer) < 12 or footer[-4:] != PARQUET_MAGIC:
+        raise UnreadableFileError(f"Not a Parquet file: {key}")
+
+    metadata_size = struct.unpack("<I", footer[-8:-4])[0]
+    if metadata_size + 8 > size - len(PARQUET_MAGIC):
+        raise UnreadableFileError(f"Corrupt Parquet footer: {key}")
+    if metadata_size + 8 > len(footer):
+        # A large footer; fetch the rest of it.
+        start = size - metadata_size - 8
+        footer = _get_range(bucket, key, start, size - len(footer) - 1) + footer
+
+    try:
+        metadata = pq.read_metadata(
+            io.BytesIO(PARQUET_MAGIC + footer[-(metadata_size + 8) :])
+        )
+    except (pa.ArrowException, OSError) as e:
+        raise UnreadableFileError(f"Could not read {key}: {e}")
+
+    schema = metadata.schema.to_arrow_schema()
+    types = {}
+
+    for i, field in enumerate(schema):
+        types[field.name] = field.type
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            values = _string_statistics(metadata, i)
+            if values:
+                col = infer_column_dtype_from_input(
+                    pd.Series(values, dtype=pd.ArrowDtype(pa.string()))
+                )
+                types[field.name] = col.dtype.pyarrow_dtype
+
+    return types
+
+
+def _string_statistics(metadata, column):
+    # Return the min and max values of string `column` in every row group.
+    values = []
+    for i in range(metadata.num_row_groups):
+        statistics = metadata.row_group(i).column(column).statistics
+        if statistics is not None and statistics.has_min_max:
+            values += [statistics.min, statistics.max]
+    return values
+
+
+def dataset_schema(s3_path):
+    """Return the schema of the Delta table at `s3_path`.
+
+    Only the log of the table is read. Return `None` if there is no table at
+    `s3_path`.
+    """
+    table = open_table(s3_path, without_files=True)
+    if table is None:
+        return None
+    return {f.name: f.type for f in pa.schema(table.schema().to_arrow())}
+
+
+def _kind(t):
+    if pa.types.is_integer(t):
+        return "integer"
+    if pa.types.is_floating(t) or pa.types.is_decimal(t):
+        return "float"
+    if pa.types.is_string(t) or pa.types.is_large_string(t):
+        return "string"
+    if pa.types.is_date(t):
+        return "date"
+    if pa.types.is_timestamp(t):
+        return "timestamp"
+    return str(t)
+
+
+def type_name(t):
+    return "mixed" if t is None else str(t)
+
+
+def _compatible(file_type, dataset_type):
+    if file_type is None:
+        return False
+    file_kind, dataset_kind = _kind(file_type), _kind(dataset_type)
+    return (
+        file_kind == dataset_kind
+        or pa.types.is_null(file_type)
+        or (file_kind, dataset_kind) == ("integer", "float")
+    )
+
+
+def schema_mismatches(file_types, dataset_types):
+    """Return the columns of `file_types` incompatible with `dataset_types`.
+
+    Each mismatch is a dictionary of the column name, its type in the file
+    and its type in the dataset. Integers are compatible with floats, and
+    different widths and units of the same kind of type with each other.
+    Columns of mixed types never are. Columns new to the dataset aren't
+    mismatches.
+    """
+    return [
+        {"column": c, "type": type_name(t), "expected": type_name(dataset_types[c])}
+        for c, t in file_types.items()
+        if c in dataset_types and not _compatible(t, dataset_types[c])
+    ]